@@ -0,0 +1,246 @@
+# Global budget for connections to the production server, shared by the API and all ETL processes
+# The production server is shared and read-only, every process used to open up to 30 connections
+# of its own. Each production connection in use now holds one slot: a lock file under SLOT_DIR
+# locked with flock(). The slot is taken when the pool checks the connection out and released when
+# it is checked in, so idle pooled connections hold no slot. The kernel releases the lock when the
+# process dies, so a crashed ETL never leaks a slot.
+#
+# API priority: the last API_RESERVED_SLOTS slots are only used by the API, and while an API
+# request is waiting for a slot, batch processes do not take a freed slot.
+# Adaptive throttling: batch processes time a `SELECT 1` probe every PROBE_INTERVAL seconds and pause
+# before each query while the average probe latency is above LATENCY_TARGET_MS, longer the slower
+# the server gets. A fixed probe measures the load of the server, the run time of the ETL queries
+# themselves would mostly measure how much data they read.
+
+import logging
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, the governor is disabled
+    fcntl = None
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+
+CONNECTION_BUDGET = int(os.getenv("PROD_CONNECTION_BUDGET", "8"))      # All processes together
+API_RESERVED_SLOTS = int(os.getenv("PROD_API_RESERVED_SLOTS", "2"))   # Only for the API
+SLOT_DIR = os.getenv("PROD_SLOT_DIR", os.path.join(tempfile.gettempdir(), "prod_connection_slots"))
+ACQUIRE_TIMEOUT = float(os.getenv("PROD_SLOT_TIMEOUT", "120"))        # Seconds waiting for a slot
+ENABLED = os.getenv("PROD_CONNECTION_GOVERNOR", "1") != "0"
+
+LATENCY_TARGET_MS = float(os.getenv("PROD_LATENCY_TARGET_MS", "50"))    # Round trip of the probe
+PROBE_INTERVAL = float(os.getenv("PROD_PROBE_INTERVAL", "5"))           # Seconds between two probes
+MAX_PAUSE_SECONDS = 10.0
+LATENCY_SMOOTHING = 0.2            # Weight of the newest probe in the moving average
+
+ROLE_API = "api"
+ROLE_BATCH = "batch"
+
+
+class ConnectionGovernor:
+    """
+    Hands out connection slots across processes and throttles batch queries.
+
+    Usage (see database.py):
+        governor = ConnectionGovernor()
+        engine = create_engine("postgresql+psycopg://...")
+        governor.attach(engine)
+
+    The API sets governor.role = ROLE_API, everything else runs as ROLE_BATCH.
+    """
+
+    def __init__(self, budget=CONNECTION_BUDGET, api_reserved=API_RESERVED_SLOTS, slot_dir=SLOT_DIR,
+                 role=ROLE_BATCH, timeout=ACQUIRE_TIMEOUT, latency_target_ms=LATENCY_TARGET_MS,
+                 probe_interval=PROBE_INTERVAL, enabled=ENABLED):
+        self.budget = max(1, budget)
+        self.api_reserved = min(max(0, api_reserved), self.budget - 1)
+        self.slot_dir = slot_dir
+        self.role = role
+        self.timeout = timeout
+        self.latency_target_ms = latency_target_ms
+        self.probe_interval = probe_interval
+        self.enabled = enabled and fcntl is not None
+        self.latency_ms = None
+        self._throttling = False
+        self._next_probe = 0.0        # time.monotonic() of the next probe
+        self._slots = {}              # id(connection record) -> slot file descriptor
+        self._lock = threading.Lock()  # Slots and latency, queries run on several threads
+
+    @property
+    def batch_slots(self):
+        """Slots batch processes may hold together"""
+        return self.budget - self.api_reserved
+
+    def _path(self, name):
+        return os.path.join(self.slot_dir, name)
+
+    def _try_lock(self, name, mode=None):
+        # Returns the open file descriptor if the lock was taken, else None
+        fd = os.open(self._path(name), os.O_CREAT | os.O_RDWR, 0o666)
+        try:
+            fcntl.flock(fd, (mode or fcntl.LOCK_EX) | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            os.close(fd)
+            return None
+
+    def _api_waiting(self):
+        fd = self._try_lock("api-wait.lock")
+        if fd is None:
+            return True
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        return False
+
+    def _candidate_slots(self):
+        if self.role == ROLE_API:
+            # Reserved slots first, the shared ones are the batch processes' budget
+            return list(range(self.budget - 1, -1, -1))
+        return list(range(self.batch_slots))
+
+    def acquire(self):
+        """
+        Block until a slot is free and take it.
+        Returns the slot file descriptor (None if the governor is disabled).
+        Raises TimeoutError after timeout seconds.
+        """
+        if not self.enabled:
+            return None
+
+        os.makedirs(self.slot_dir, exist_ok=True)
+        wait_fd = self._try_lock("api-wait.lock", fcntl.LOCK_SH) if self.role == ROLE_API else None
+        started = time.monotonic()
+        delay = 0.05
+        try:
+            while True:
+                if self.role == ROLE_API or not self._api_waiting():
+                    for slot in self._candidate_slots():
+                        fd = self._try_lock(f"slot-{slot}.lock")
+                        if fd is not None:
+                            return fd
+
+                if time.monotonic() - started > self.timeout:
+                    raise TimeoutError(f"No production connection slot free after {self.timeout:.0f} s "
+                                       f"(budget {self.budget}, role {self.role})")
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+        finally:
+            if wait_fd is not None:
+                fcntl.flock(wait_fd, fcntl.LOCK_UN)
+                os.close(wait_fd)
+
+    def release(self, fd):
+        if fd is None:
+            return
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        # Raising here hands the connection back to the pool, no slot is held then
+        fd = self.acquire()
+        with self._lock:
+            self._slots[id(connection_record)] = fd
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            fd = self._slots.pop(id(connection_record), None)
+        self.release(fd)
+
+    def _on_detach(self, dbapi_connection, connection_record):
+        # A detached connection leaves its record, it keeps the slot until it is closed
+        with self._lock:
+            fd = self._slots.pop(id(connection_record), None)
+            if fd is not None:
+                self._slots[id(dbapi_connection)] = fd
+
+    def _on_close_detached(self, dbapi_connection):
+        with self._lock:
+            fd = self._slots.pop(id(dbapi_connection), None)
+        self.release(fd)
+
+    def _probe(self, cursor):
+        # Round trip of a trivial statement on the connection about to run a query, in ms
+        started = time.perf_counter()
+        with cursor.connection.cursor() as probe:
+            probe.execute("SELECT 1")
+            probe.fetchone()
+        return (time.perf_counter() - started) * 1000
+
+    def _measure(self, cursor):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_probe:
+                return
+            # Claimed before probing, concurrent queries do not probe as well
+            self._next_probe = now + self.probe_interval
+
+        try:
+            elapsed_ms = self._probe(cursor)
+        except Exception as e:
+            logger.debug(f"Latency probe failed: {str(e)}")
+            return
+
+        with self._lock:
+            if self.latency_ms is None:
+                self.latency_ms = elapsed_ms
+            else:
+                self.latency_ms += LATENCY_SMOOTHING * (elapsed_ms - self.latency_ms)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.role != ROLE_BATCH:
+            return
+        self._measure(cursor)
+
+        with self._lock:
+            latency_ms = self.latency_ms
+            throttle = latency_ms is not None and latency_ms > self.latency_target_ms
+            changed = throttle != self._throttling
+            self._throttling = throttle
+
+        if throttle:
+            if changed:
+                logger.warning(f"Production latency {latency_ms:.0f} ms above {self.latency_target_ms:.0f} ms, "
+                               f"throttling batch queries")
+            time.sleep(min(MAX_PAUSE_SECONDS, (latency_ms / self.latency_target_ms - 1) * 0.5))
+        elif changed:
+            logger.info(f"Production latency back to {latency_ms:.0f} ms, throttling stopped")
+
+    def attach(self, engine):
+        """Hold a slot while a connection is checked out of the pool and throttle batch queries"""
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "detach", self._on_detach)
+        event.listen(engine, "close_detached", self._on_close_detached)
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        return engine
+
+    def status(self):
+        """Slots currently held by any process, as a list of booleans"""
+        if not self.enabled:
+            return []
+        os.makedirs(self.slot_dir, exist_ok=True)
+        busy = []
+        for slot in range(self.budget):
+            fd = self._try_lock(f"slot-{slot}.lock")
+            busy.append(fd is None)
+            self.release(fd)
+        return busy
+
+
+if __name__ == "__main__":
+    governor = ConnectionGovernor()
+    if not governor.enabled:
+        print("Connection governor disabled")
+    else:
+        busy = governor.status()
+        print(f"{sum(busy)}/{governor.budget} production connection slots in use "
+              f"({governor.api_reserved} reserved for the API) in {governor.slot_dir}")
+        for slot, in_use in enumerate(busy):
+            kind = "api" if slot >= governor.batch_slots else "shared"
+            print(f"  slot {slot} ({kind}): {'in use' if in_use else 'free'}")
@@ -7,6 +7,12 @@ from sqlalchemy.orm import sessionmaker, Session
 from dotenv import load_dotenv
 load_dotenv()
 
+# The API imports this module as `database`, the ETL scripts as `backend.database`
+try:
+    from backend.connection_governor import ConnectionGovernor
+except ImportError:
+    from connection_governor import ConnectionGovernor
+
 
 # PRODUCTION DATABASE (Read-Only) - Remote server with raw sensor data
 
@@ -18,13 +24,24 @@ db_port = os.getenv("DB_PORT", "2345")
 
 PROD_DATABASE_URL = f'postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}'
 
+# Connection budget of this process. Parallel backfill workers lower it (see scripts/etl_backfill.py)
+# Together the defaults match the default budget of all processes (PROD_CONNECTION_BUDGET=8)
+prod_pool_size = int(os.getenv("PROD_POOL_SIZE", "4"))
+prod_max_overflow = int(os.getenv("PROD_MAX_OVERFLOW", "4"))
+
+# Every checked-out production connection also needs a slot of the budget shared by all
+# processes (see connection_governor.py). The API switches the role to ROLE_API in main.py.
+prod_governor = ConnectionGovernor()
+
+
 prod_engine = create_engine(
     PROD_DATABASE_URL,
-    pool_size=10,          # Number of persistent connections in the pool
-    max_overflow=20,       # Additional temporary connections allowed
+    pool_size=prod_pool_size,          # Number of persistent connections in the pool
+    max_overflow=prod_max_overflow,    # Additional temporary connections allowed
     pool_pre_ping=True,    # Check connections before use
     pool_recycle=1800      # Recycle connections every 30 minutes
 )
+prod_governor.attach(prod_engine)
 
 ProductionSession = sessionmaker(autocommit=False, autoflush=False, bind=prod_engine)
 
@@ -2,11 +2,14 @@
 from typing import List, Optional 
 from fastapi import FastAPI, HTTPException, Depends   
 from fastapi.middleware.cors import CORSMiddleware 
-from database import prod_engine, get_prod_db, get_agg_db
+from database import prod_engine, prod_governor, get_prod_db, get_agg_db
+from connection_governor import ROLE_API
+from quantile_sketch import DDSketch
+from variable_catalog import VariableCatalog
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 from sqlalchemy import text
-from datetime import date as DateType
+from datetime import date as DateType, datetime, timedelta, timezone
 
 # Create our API app instance, with versioning
 app = FastAPI(title="Variable Monitoring API", version="1.0.0")
@@ -20,6 +23,12 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
+# API requests get the reserved production connection slots and are never throttled
+prod_governor.role = ROLE_API
+
+# Production variables (id, name, datatype) and their coverage, cached in memory
+variable_catalog = VariableCatalog(prod_engine)
+
 # We use BaseModel from pydantic to enforce and shape the GET response
 
 class SensorStatsOut(BaseModel):
@@ -30,6 +39,17 @@ class SensorStatsOut(BaseModel):
     std_dev:   Optional[float]
     readings_count: Optional[int]
 
+class SensorQuantilesOut(BaseModel):
+    dt: str
+    readings_count: int
+    min_value: Optional[float]
+    p5: Optional[float]
+    p25: Optional[float]
+    p50: Optional[float]
+    p75: Optional[float]
+    p95: Optional[float]
+    max_value: Optional[float]
+
 class MachineUtilOut(BaseModel):
     dt: str
     state_running: Optional[float]
@@ -37,6 +57,18 @@ class MachineUtilOut(BaseModel):
     running_percentage: Optional[float]
     down_percentage : Optional[float]
 
+class MachineUtilHourlyOut(BaseModel):
+    hour_ts: str
+    running_seconds: int
+    running_percentage: float
+    readings_count: int
+
+class MachineStateBlockOut(BaseModel):
+    state: str
+    start_ts: str
+    end_ts: str
+    duration_seconds: int
+
 class DataStatusOut(BaseModel):
     first_date: str
     last_date: str
@@ -45,6 +77,20 @@ class DataStatusOut(BaseModel):
     alert_records: int
     program_records: int
     energy_records: int
+    source_first_date: Optional[str]
+    source_last_date: Optional[str]
+    source_days: int
+
+class AvailableDateOut(BaseModel):
+    dt: str
+    readings_count: int
+
+class VariableOut(BaseModel):
+    id: int
+    name: str
+    datatype: Optional[str]
+    first_ts: Optional[str]
+    last_ts: Optional[str]
 
 
 class MachineChangeOut(BaseModel):
@@ -73,6 +119,18 @@ class EnergyConsumptionOut(BaseModel):
     hour_ts: str
     energy_kwh: float
 
+class ProgramEnergyOut(BaseModel):
+    program: int
+    runtime_seconds: int
+    energy_kwh: float
+    avg_power_kw: float
+
+class MotorEnergyOut(BaseModel):
+    motor: str
+    nominal_kw: Optional[float]
+    energy_kwh: float
+    share_percentage: float
+
 # When you visit http://localhost:8000/ you'll see this message
 @app.get("/")
 def home():
@@ -159,6 +217,103 @@ def get_temperature_stats(
 
 
 
+@app.get("/api/v1/temperature_quantiles", response_model=List[SensorQuantilesOut])
+def get_temperature_quantiles(
+    start_date: DateType,
+    end_date: Optional[DateType] = None,
+    sensor_name: str = "TEMPERATURA_BASE",
+    group_by: str = "range",
+    db: Session = Depends(get_agg_db)
+):
+    """
+    Percentiles (p5/p25/p50/p75/p95) of a sensor for any date range.
+    Computed by merging the hourly quantile sketches, without touching raw data.
+    
+    Params:
+        start_date: First date of the range, e.g. "2021-09-14"
+        end_date:   Last date of the range (inclusive), defaults to start_date
+        sensor_name: Name of the sensor, e.g. "TEMPERATURA_BASE"
+        group_by:   "range" (one result), "day" or "hour" (one result per box)
+    
+    Returns:
+        List of percentile summaries, each labelled with the start of its group.
+    """
+    if group_by not in ("range", "day", "hour"):
+        raise HTTPException(status_code=400, detail="group_by must be 'range', 'day' or 'hour'")
+
+    end_date = end_date or start_date
+
+    query = text("""
+        SELECT 
+            dt,
+            min_value,
+            max_value,
+            value_sketch
+        FROM agg_sensor_stats a
+        WHERE a.dt >= :start_ts
+        AND a.dt < :end_ts
+        AND a.sensor_name = :sensor_name
+        AND a.value_sketch IS NOT NULL
+        ORDER BY dt ASC
+    """)
+
+    try:
+        rows = db.execute(query, {
+            "start_ts": str(start_date),
+            "end_ts": str(end_date + timedelta(days=1)),
+            "sensor_name": sensor_name
+        }).fetchall()
+
+        if not rows:
+            raise HTTPException(
+                status_code=404,
+                detail=f"No quantile data found for {sensor_name} between {start_date} and {end_date}"
+            )
+
+        # Merge the hourly sketches of each group
+        groups = {}
+        for r in rows:
+            if group_by == "hour":
+                key = str(r.dt)
+            elif group_by == "day":
+                key = str(r.dt.date())
+            else:
+                key = str(start_date)
+
+            if key not in groups:
+                groups[key] = {"sketch": DDSketch.from_dict(r.value_sketch), "min": r.min_value, "max": r.max_value}
+            else:
+                group = groups[key]
+                group["sketch"].merge(DDSketch.from_dict(r.value_sketch))
+                group["min"] = min(group["min"], r.min_value)
+                group["max"] = max(group["max"], r.max_value)
+
+        def estimate(group, q):
+            # Keep estimates inside the observed range
+            value = group["sketch"].quantile(q)
+            return round(min(max(value, group["min"]), group["max"]), 2)
+
+        return [
+            SensorQuantilesOut(
+                dt=key,
+                readings_count=group["sketch"].count,
+                min_value=group["min"],
+                p5=estimate(group, 0.05),
+                p25=estimate(group, 0.25),
+                p50=estimate(group, 0.50),
+                p75=estimate(group, 0.75),
+                p95=estimate(group, 0.95),
+                max_value=group["max"]
+            )
+            for key, group in groups.items()
+        ]
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+
 @app.get('/api/v1/machine_util', response_model=List[MachineUtilOut])
 def get_machine_util(
     target_date: DateType,
@@ -217,6 +372,110 @@ def get_machine_util(
 
 
 
+@app.get('/api/v1/machine_util_hourly', response_model=List[MachineUtilHourlyOut])
+def get_machine_util_hourly(
+    target_date: DateType,
+    db: Session = Depends(get_agg_db)
+):
+    """
+    Hourly machine utilization for a given day.
+    
+    Params:
+        target_date: Date to query, e.g. "2021-09-14"
+    
+    Returns:
+        Running seconds, running percentage and number of log entries for each hour (UTC).
+    """
+    query = text('''
+    SELECT
+        hour_ts,
+        running_seconds,
+        readings_count
+    FROM agg_machine_activity_hourly
+    WHERE hour_ts >= :start_ts
+    AND hour_ts < :end_ts
+    ORDER BY hour_ts ASC;
+    ''')
+
+    try:
+        rows = db.execute(query, {
+            'start_ts': target_date,
+            'end_ts': target_date + timedelta(days=1)
+        }).fetchall()
+
+        if not rows:
+            raise HTTPException(
+                status_code=404,
+                detail=f"No hourly utilization data found for {target_date}"
+            )
+        return [
+            MachineUtilHourlyOut(
+                hour_ts=str(row.hour_ts),
+                running_seconds=row.running_seconds,
+                running_percentage=round(row.running_seconds / 36.0, 2),
+                readings_count=row.readings_count
+            ) for row in rows
+        ]
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+
+@app.get('/api/v1/machine_state_timeline', response_model=List[MachineStateBlockOut])
+def get_machine_state_timeline(
+    start_date: DateType,
+    end_date: Optional[DateType] = None,
+    db: Session = Depends(get_agg_db)
+):
+    """
+    Machine state Gantt (PARADA, IDLE, OPERACION) from the 10-minute activity buckets.
+    
+    Params:
+        start_date: First day, e.g. "2021-09-14"
+        end_date:   Last day (inclusive), defaults to start_date
+    
+    Returns:
+        Merged state blocks with start, end and duration, ordered by time.
+    """
+    query = text('''
+    SELECT
+        state,
+        start_ts,
+        end_ts,
+        duration_seconds
+    FROM agg_machine_state_timeline
+    WHERE dt BETWEEN :start_date AND :end_date
+    ORDER BY start_ts ASC;
+    ''')
+
+    try:
+        rows = db.execute(query, {
+            'start_date': start_date,
+            'end_date': end_date or start_date
+        }).fetchall()
+
+        if not rows:
+            raise HTTPException(
+                status_code=404,
+                detail=f"No state timeline found for {start_date} to {end_date or start_date}"
+            )
+        return [
+            MachineStateBlockOut(
+                state=row.state,
+                start_ts=str(row.start_ts),
+                end_ts=str(row.end_ts),
+                duration_seconds=row.duration_seconds
+            ) for row in rows
+        ]
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+
 @app.get("/api/v1/data_status", response_model=DataStatusOut)
 def get_data_status(
     db: Session = Depends(get_agg_db)
@@ -235,7 +494,10 @@ def get_data_status(
         utilization_records,
         alert_records,
         program_records,
-        energy_records
+        energy_records,
+        source_first_date,
+        source_last_date,
+        source_days
     FROM v_data_status;
     '''
     try:
@@ -251,7 +513,10 @@ def get_data_status(
             utilization_records=row.utilization_records,
             alert_records=row.alert_records,
             program_records=row.program_records,
-            energy_records=row.energy_records
+            energy_records=row.energy_records,
+            source_first_date=str(row.source_first_date) if row.source_first_date else None,
+            source_last_date=str(row.source_last_date) if row.source_last_date else None,
+            source_days=row.source_days
         )
     
     except HTTPException as e:
@@ -260,6 +525,77 @@ def get_data_status(
         raise HTTPException(status_code=500, detail="Database error")
 
 
+@app.get("/api/v1/available_dates", response_model=List[AvailableDateOut])
+def get_available_dates(
+    start_date: Optional[DateType] = None,
+    end_date: Optional[DateType] = None,
+    db: Session = Depends(get_agg_db)
+):
+    """
+    Days with raw data, from the source coverage index. Used by the date picker
+    to disable the days where the machine logged nothing.
+    
+    Params:
+        start_date: First day (optional)
+        end_date:   Last day (optional)
+    
+    Returns:
+        Every day with at least one log entry and its number of log entries.
+    """
+    query = text("""
+        SELECT dt, SUM(readings_count) AS readings_count
+        FROM source_coverage
+        WHERE (CAST(:start_date AS date) IS NULL OR dt >= :start_date)
+        AND (CAST(:end_date AS date) IS NULL OR dt <= :end_date)
+        GROUP BY dt
+        ORDER BY dt;
+    """)
+
+    try:
+        rows = db.execute(query, {"start_date": start_date, "end_date": end_date}).fetchall()
+
+        return [
+            AvailableDateOut(
+                dt=str(r.dt),
+                readings_count=r.readings_count
+            )
+            for r in rows
+        ]
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+
+@app.get("/api/v1/variables", response_model=List[VariableOut])
+def get_variables():
+    """
+    Catalog of the production variables with the time range covered by their readings.
+    Served from memory, the catalog and the coverage are refreshed periodically.
+    
+    Returns:
+        Id, name and datatype of every variable, with its first and last reading (UTC).
+    """
+    def to_ts(ms):
+        return str(datetime.fromtimestamp(ms / 1000, tz=timezone.utc)) if ms is not None else None
+
+    try:
+        coverage = variable_catalog.coverage()
+
+        return [
+            VariableOut(
+                id=var['id'],
+                name=var['name'],
+                datatype=str(var['datatype']) if var['datatype'] is not None else None,
+                first_ts=to_ts(coverage.get(var['id'], {}).get('first_ms')),
+                last_ts=to_ts(coverage.get(var['id'], {}).get('last_ms'))
+            )
+            for var in variable_catalog.variables()
+        ]
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+
 @app.get("/api/v1/machine_changes", response_model=List[MachineChangeOut])
 def get_machine_changes(
     start: str,
@@ -485,4 +821,112 @@ def get_energy_consumption(
         ]
 
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+
+@app.get("/api/v1/energy_consumption_by_motor", response_model=List[MotorEnergyOut])
+def get_energy_consumption_by_motor(
+    start_date: DateType,
+    end_date: Optional[DateType] = None,
+    db: Session = Depends(get_agg_db)
+):
+    """
+    Energy consumption per motor for a date range, largest consumer first.
+    
+    Params:
+        start_date: First date of the range, e.g. "2022-02-01"
+        end_date:   Last date of the range (inclusive), defaults to start_date
+    
+    Returns:
+        Each motor with its nominal power, energy in kWh and share of the total.
+    """
+
+    query = text("""
+        SELECT 
+            m.motor,
+            c.nominal_kw,
+            SUM(m.energy_kwh) AS energy_kwh
+        FROM energy_consumption_motor_hourly m
+        LEFT JOIN energy_motor_config c ON c.motor = m.motor
+        WHERE m.hour_ts >= :start_ts
+        AND m.hour_ts < :end_ts
+        GROUP BY m.motor, c.nominal_kw
+        ORDER BY energy_kwh DESC;
+    """)
+
+    end_date = end_date or start_date
+
+    try:
+        rows = db.execute(query, {
+            "start_ts": str(start_date),
+            "end_ts": str(end_date + timedelta(days=1))
+        }).fetchall()
+
+        if not rows:
+            return []
+
+        total = sum(float(r.energy_kwh) for r in rows)
+
+        return [
+            MotorEnergyOut(
+                motor=r.motor,
+                nominal_kw=r.nominal_kw,
+                energy_kwh=round(float(r.energy_kwh), 3),
+                share_percentage=round(float(r.energy_kwh) / total * 100, 2) if total else 0.0
+            )
+            for r in rows
+        ]
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+
+@app.get("/api/v1/program_energy", response_model=List[ProgramEnergyOut])
+def get_program_energy(
+    start_date: DateType,
+    end_date: Optional[DateType] = None,
+    db: Session = Depends(get_agg_db)
+):
+    """
+    Runtime and energy demand per program for a date range, largest consumer first.
+    
+    Params:
+        start_date: First date of the range, e.g. "2022-02-01"
+        end_date:   Last date of the range (inclusive), defaults to start_date
+    
+    Returns:
+        Each program with its runtime in seconds, energy in kWh and average power in kW.
+    """
+
+    query = text("""
+        SELECT 
+            program,
+            SUM(runtime_seconds) AS runtime_seconds,
+            SUM(energy_kwh) AS energy_kwh
+        FROM program_energy_daily
+        WHERE dt BETWEEN :start_date AND :end_date
+        GROUP BY program
+        ORDER BY energy_kwh DESC;
+    """)
+
+    try:
+        rows = db.execute(query, {
+            "start_date": str(start_date),
+            "end_date": str(end_date or start_date)
+        }).fetchall()
+
+        if not rows:
+            return []
+
+        return [
+            ProgramEnergyOut(
+                program=r.program,
+                runtime_seconds=int(r.runtime_seconds),
+                energy_kwh=round(float(r.energy_kwh), 3),
+                avg_power_kw=round(float(r.energy_kwh) / (r.runtime_seconds / 3600), 3) if r.runtime_seconds else 0.0
+            )
+            for r in rows
+        ]
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
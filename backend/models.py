@@ -84,6 +84,52 @@ class AggMachineActivityDaily(Base):
     state_unplanned_down: Mapped[float] 
     last_updated_at: Mapped[Optional[datetime]]
 
+
+class AggActivity10min(Base):
+    """
+    Log entries of all variables per 10-minute bucket (UTC), with their first and last raw timestamp
+    Example row:
+    bucket_ts=2021-01-15 08:10:00, dt=2021-01-15, readings_count=412,
+    first_ms=1610698200123, last_ms=1610698799870
+    """
+    __tablename__ = "agg_activity_10min"
+
+    bucket_ts: Mapped[datetime] = mapped_column(primary_key=True)
+    dt: Mapped[date]
+    readings_count: Mapped[int]
+    first_ms: Mapped[int]
+    last_ms: Mapped[int]
+
+
+class AggMachineActivityHourly(Base):
+    """
+    Running seconds and log entries per hour, derived from agg_activity_10min
+    Example row:
+    hour_ts=2021-01-15 08:00:00, running_seconds=3240, readings_count=2310
+    """
+    __tablename__ = "agg_machine_activity_hourly"
+
+    hour_ts: Mapped[datetime] = mapped_column(primary_key=True)
+    running_seconds: Mapped[int]
+    readings_count: Mapped[int]
+
+
+class AggMachineStateTimeline(Base):
+    """
+    Merged machine state blocks per day (PARADA, IDLE, OPERACION), derived from agg_activity_10min
+    Example row:
+    id=1, dt=2021-01-15, state='OPERACION', start_ts=2021-01-15 08:10:00,
+    end_ts=2021-01-15 11:40:00, duration_seconds=12600
+    """
+    __tablename__ = "agg_machine_state_timeline"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    dt: Mapped[date]
+    state: Mapped[str]
+    start_ts: Mapped[datetime]
+    end_ts: Mapped[datetime]
+    duration_seconds: Mapped[int]
+
 # Class that matches our table structure in the aggregated DB.
 class AggSensorStats(Base):
     """
@@ -103,6 +149,12 @@ class AggSensorStats(Base):
     max_value: Mapped[Optional[float]]
     std_dev  : Mapped[Optional[float]]
     readings_count: Mapped[Optional[int]]
+    # Mergeable state, lets new readings be folded in without re-reading the hour
+    mean_value: Mapped[Optional[float]]
+    m2_value: Mapped[Optional[float]]
+    last_reading_ms: Mapped[Optional[int]]
+    # Serialized DDSketch of the hour's readings, see backend/quantile_sketch.py
+    value_sketch: Mapped[Optional[Any]] = mapped_column(JSONB)
     last_updated_at: Mapped[Optional[datetime]]
 
 class DataStatus(Base):
@@ -135,6 +187,23 @@ class MachineProgramData(Base):
     duration_seconds: Mapped[int]
 
 
+class ProgramHistoryCheckpoint(Base):
+    """
+    Program active at the end of every window processed by the program history ETL.
+    window_end is exclusive: the row holds the state at 00:00 of that day.
+    Example row:
+    window_end=2022-02-01, window_start=2022-01-01, last_program=123,
+    last_change_ms=1643668800000, updated_at=2022-02-01 06:00:00
+    """
+    __tablename__ = "program_history_checkpoint"
+
+    window_end: Mapped[date] = mapped_column(primary_key=True)
+    window_start: Mapped[date]
+    last_program: Mapped[Optional[int]]
+    last_change_ms: Mapped[Optional[int]]
+    updated_at: Mapped[datetime]
+
+
 class AlertsDailyCount(Base):
     """
     Daily count of alerts by type
@@ -165,6 +234,23 @@ class AlertsDetail(Base):
     raw_elem_json: Mapped[Optional[Any]] = mapped_column(JSONB)  # JSONB type
 
 
+class AlertClassification(Base):
+    """
+    Lookup of already classified alarms, one row per distinct code/description.
+    Example row:
+    alarm_code='1012', alarm_description='Emergency stop', alert_type='emergency',
+    rules_version='3f2a9c1b7d40', classified_at='2022-02-23 14:30:00'
+    """
+    __tablename__ = "alert_classification"
+
+    # Empty string instead of NULL, so both can be part of the primary key
+    alarm_code: Mapped[str] = mapped_column(primary_key=True)
+    alarm_description: Mapped[str] = mapped_column(primary_key=True)
+    alert_type: Mapped[str]
+    rules_version: Mapped[str]
+    classified_at: Mapped[Optional[datetime]]
+
+
 class EnergyConsumptionHourly(Base):
     """
     Hourly energy consumption aggregated from motor utilization data.
@@ -174,4 +260,94 @@ class EnergyConsumptionHourly(Base):
     __tablename__ = "energy_consumption_hourly"
     
     hour_ts: Mapped[datetime] = mapped_column(primary_key=True)
-    energy_kwh: Mapped[float]
\ No newline at end of file
+    energy_kwh: Mapped[float]
+
+
+class EnergyMotorConfig(Base):
+    """
+    Motor catalog used by the energy ETL.
+    Example row:
+    motor='SPINDLE_LOAD_1', nominal_kw=37.0, enabled=True
+    """
+    __tablename__ = "energy_motor_config"
+
+    # Name of the utilization variable in production
+    motor: Mapped[str] = mapped_column(primary_key=True)
+    nominal_kw: Mapped[float]
+    enabled: Mapped[bool]
+
+
+class EnergyConsumptionMotorHourly(Base):
+    """
+    Hourly energy consumption per motor, filled in the same pass as the totals.
+    Example row:
+    hour_ts='2022-02-23 14:00:00', motor='SPINDLE_LOAD_1', energy_kwh=8.214
+    """
+    __tablename__ = "energy_consumption_motor_hourly"
+
+    hour_ts: Mapped[datetime] = mapped_column(primary_key=True)
+    motor: Mapped[str] = mapped_column(primary_key=True)
+    energy_kwh: Mapped[float]
+
+
+class ProgramEnergyDaily(Base):
+    """
+    Runtime and estimated energy attributed to each program per day.
+    Example row:
+    dt=2022-02-23, program=123, runtime_seconds=3600, energy_kwh=14.512
+    """
+    __tablename__ = "program_energy_daily"
+
+    dt: Mapped[date] = mapped_column(primary_key=True)
+    program: Mapped[int] = mapped_column(primary_key=True)
+    runtime_seconds: Mapped[int]
+    energy_kwh: Mapped[float]
+
+
+class EtlWatermark(Base):
+    """
+    Per-ETL, per-day processing state, used to resume each ETL where it stopped
+    Example row:
+    etl_name='etl_agg_alerts', partition_date=2022-02-23, range_start_ms=1645574400000,
+    range_end_ms=1645660800000, rows_loaded=42, source_fingerprint='3f2a9c0e51b7d844',
+    status='done', updated_at=2022-02-24 06:00:00
+    """
+    __tablename__ = "etl_watermark"
+
+    etl_name: Mapped[str] = mapped_column(primary_key=True)
+    partition_date: Mapped[date] = mapped_column(primary_key=True)
+    range_start_ms: Mapped[int]
+    range_end_ms: Mapped[int]
+    rows_loaded: Mapped[Optional[int]]
+    source_fingerprint: Mapped[Optional[str]]
+    status: Mapped[str]  # 'running', 'done', 'failed', 'stale'
+    updated_at: Mapped[datetime]
+
+
+class EtlStreamWatermark(Base):
+    """
+    Last raw epoch-ms timestamp folded in by a micro-batch stream
+    Example row:
+    stream_name='energy', last_ms=1645660785000, updated_at=2022-02-24 00:00:05
+    """
+    __tablename__ = "etl_stream_watermark"
+
+    stream_name: Mapped[str] = mapped_column(primary_key=True)
+    last_ms: Mapped[int]
+    updated_at: Mapped[datetime]
+
+
+class SourceCoverage(Base):
+    """
+    Raw log entries per UTC day and variable, with their first and last raw timestamp
+    Example row:
+    dt=2022-02-23, id_var=597, readings_count=318,
+    first_ms=1645574412000, last_ms=1645660790000
+    """
+    __tablename__ = "source_coverage"
+
+    dt: Mapped[date] = mapped_column(primary_key=True)
+    id_var: Mapped[int] = mapped_column(primary_key=True)
+    readings_count: Mapped[int]
+    first_ms: Mapped[int]
+    last_ms: Mapped[int]
@@ -0,0 +1,126 @@
+# Compact, mergeable quantile sketch (DDSketch style)
+# Used by the sensor ETL to summarise each sensor-hour and by the API to answer
+# percentile queries for any range by merging the stored sketches.
+
+import math
+import json
+
+
+DEFAULT_RELATIVE_ACCURACY = 0.01   # Quantiles are within 1% of the true value
+DEFAULT_MAX_BINS = 2048            # Upper bound on stored bins per sign
+
+
+class DDSketch:
+    """
+    Values are mapped to logarithmic buckets: key = ceil(log_gamma(|v|)).
+    Every bucket covers values within the relative accuracy of each other, so a
+    quantile estimate is never further than `relative_accuracy` from a real reading.
+    Two sketches are merged by adding the bucket counts, which makes hourly sketches
+    combinable into daily or range-wide ones.
+
+    Example serialized form:
+    {"alpha": 0.01, "zero": 0, "pos": {"161": 12, "162": 40}, "neg": {}}
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.zero_count = 0
+        self.positive = {}
+        self.negative = {}
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.positive.values()) + sum(self.negative.values())
+
+    def _key(self, value):
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, key):
+        # Midpoint of the bucket (gamma^(k-1), gamma^k] in the relative sense
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        '''Add a reading (non finite values are ignored)'''
+        if not math.isfinite(value):
+            return
+        if value > 0:
+            key = self._key(value)
+            self.positive[key] = self.positive.get(key, 0) + count
+            self._collapse(self.positive)
+        elif value < 0:
+            key = self._key(-value)
+            self.negative[key] = self.negative.get(key, 0) + count
+            self._collapse(self.negative)
+        else:
+            self.zero_count += count
+
+    def _collapse(self, bins):
+        # Folds the smallest magnitudes together, keeping the upper tail accurate
+        while len(bins) > self.max_bins:
+            lowest, second = sorted(bins)[:2]
+            bins[second] += bins.pop(lowest)
+
+    def merge(self, other):
+        '''Add the counts of another sketch with the same relative accuracy'''
+        if not math.isclose(self.relative_accuracy, other.relative_accuracy):
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+        self.zero_count += other.zero_count
+        for key, count in other.positive.items():
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in other.negative.items():
+            self.negative[key] = self.negative.get(key, 0) + count
+        self._collapse(self.positive)
+        self._collapse(self.negative)
+        return self
+
+    def quantile(self, q):
+        '''
+        Estimated value at quantile q (0 <= q <= 1), or None for an empty sketch.
+        '''
+        if not 0 <= q <= 1:
+            raise ValueError("Quantile must be between 0 and 1")
+        total = self.count
+        if total == 0:
+            return None
+
+        rank = q * (total - 1)
+        seen = 0
+
+        # Ascending order: most negative first, then zeros, then positives
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive))
+
+    def to_dict(self):
+        return {
+            'alpha': self.relative_accuracy,
+            'zero': self.zero_count,
+            'pos': {str(key): count for key, count in self.positive.items()},
+            'neg': {str(key): count for key, count in self.negative.items()},
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), separators=(',', ':'))
+
+    @classmethod
+    def from_dict(cls, data):
+        '''Build a sketch from its serialized form (dict or JSON string)'''
+        if isinstance(data, str):
+            data = json.loads(data)
+        sketch = cls(relative_accuracy=data.get('alpha', DEFAULT_RELATIVE_ACCURACY))
+        sketch.zero_count = int(data.get('zero', 0))
+        sketch.positive = {int(key): int(count) for key, count in data.get('pos', {}).items()}
+        sketch.negative = {int(key): int(count) for key, count in data.get('neg', {}).items()}
+        return sketch
@@ -0,0 +1,147 @@
+'''
+Alert classifier used by the alerts ETL.
+
+Replaces the SQL CASE of ILIKE '%...%' patterns that used to run on the production server for
+every expanded alarm element. The rules are compiled once into one regular expression per alert
+type, and every distinct (alarm_code, alarm_description) pair is classified only once:
+results are memoized in memory and persisted to the alert_classification table of the
+aggregation DB, so later runs start with everything that was already seen.
+
+Rules are checked in order, the first match wins. A rule matches when one of its patterns is
+found in the description (case-insensitive, like ILIKE '%pattern%') or when the numeric alarm
+code falls in one of its code ranges (inclusive). Unmatched alarms get DEFAULT_ALERT_TYPE.
+
+    Example rules file (set ALERT_RULES_FILE=path/to/rules.json):
+    [
+        {"alert_type": "emergency", "patterns": ["emerg"], "code_ranges": [[1000, 1099]]},
+        {"alert_type": "error", "patterns": ["error", "fallo"]}
+    ]
+'''
+
+import hashlib
+import json
+import logging
+import os
+import re
+from datetime import datetime
+
+from sqlalchemy import text
+
+from backend.database import agg_engine
+from backend.models import AlertClassification
+from backend.scripts.bulk_loader import upsert
+
+logger = logging.getLogger(__name__)
+
+
+# Same categories and order as the original SQL classification
+DEFAULT_RULES = [
+    {'alert_type': 'emergency', 'patterns': ['emerg']},
+    {'alert_type': 'error', 'patterns': ['error', 'err', 'fallo', 'fault']},
+    {'alert_type': 'warning', 'patterns': ['alert', 'alarm', 'warn', 'aviso', 'attention']},
+]
+
+DEFAULT_ALERT_TYPE = 'other'
+
+
+def load_rules(path=None):
+    '''
+    Rules from a JSON file (path or ALERT_RULES_FILE), DEFAULT_RULES if none is configured.
+    '''
+    path = path or os.getenv("ALERT_RULES_FILE")
+    if not path:
+        return DEFAULT_RULES
+    with open(path) as f:
+        return json.load(f)
+
+
+def _parse_code(alarm_code):
+    # Alarm codes are text in the source JSON, only numeric ones can fall in a range
+    try:
+        return int(alarm_code)
+    except (TypeError, ValueError):
+        return None
+
+
+class AlertClassifier:
+    """
+    Compiled, memoized alert classification.
+
+    Usage:
+        classifier = AlertClassifier()
+        classifier.load_lookup()                    # Reuse earlier classifications
+        classifier.classify('1012', 'Emergency stop')  # -> 'emergency'
+        classifier.save_new()                       # Persist the newly seen descriptions
+    """
+
+    def __init__(self, rules=None):
+        self.rules = rules if rules is not None else load_rules()
+
+        # Classifications depend on the rules, a changed rule set gets a new version
+        self.version = hashlib.sha1(json.dumps(self.rules, sort_keys=True).encode()).hexdigest()[:12]
+
+        self._compiled = [
+            (
+                rule['alert_type'],
+                re.compile('|'.join(re.escape(p) for p in rule.get('patterns', [])), re.IGNORECASE)
+                    if rule.get('patterns') else None,
+                [(int(low), int(high)) for low, high in rule.get('code_ranges', [])]
+            )
+            for rule in self.rules
+        ]
+        self._memo = {}
+        self._new = {}
+
+    def _match(self, alarm_code, alarm_description):
+        code = _parse_code(alarm_code)
+        for alert_type, pattern, code_ranges in self._compiled:
+            if pattern is not None and alarm_description and pattern.search(alarm_description):
+                return alert_type
+            if code is not None and any(low <= code <= high for low, high in code_ranges):
+                return alert_type
+        return DEFAULT_ALERT_TYPE
+
+    def classify(self, alarm_code, alarm_description):
+        '''Alert type for an alarm, computed at most once per distinct code/description'''
+        key = (alarm_code or '', alarm_description or '')
+        alert_type = self._memo.get(key)
+        if alert_type is None:
+            alert_type = self._match(alarm_code, alarm_description)
+            self._memo[key] = alert_type
+            self._new[key] = alert_type
+        return alert_type
+
+    def load_lookup(self, engine=None):
+        '''Fill the memo with the persisted classifications made with the current rules'''
+        engine = engine or agg_engine
+        with engine.connect() as conn:
+            rows = conn.execute(text('''
+                SELECT alarm_code, alarm_description, alert_type
+                FROM alert_classification
+                WHERE rules_version = :version
+            '''), {'version': self.version}).fetchall()
+
+        for row in rows:
+            self._memo[(row.alarm_code, row.alarm_description)] = row.alert_type
+        logger.info(f"Loaded {len(rows)} known alarm classifications (rules {self.version})")
+        return len(rows)
+
+    def save_new(self, engine=None):
+        '''Persist the classifications made since the last save'''
+        if not self._new:
+            return 0
+
+        records = [
+            {
+                'alarm_code': code,
+                'alarm_description': description,
+                'alert_type': alert_type,
+                'rules_version': self.version,
+                'classified_at': datetime.now()
+            }
+            for (code, description), alert_type in self._new.items()
+        ]
+        saved = upsert(AlertClassification, records,
+                       conflict_columns=['alarm_code', 'alarm_description'], engine=engine)
+        self._new = {}
+        return saved
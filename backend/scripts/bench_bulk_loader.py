@@ -0,0 +1,98 @@
+'''
+Benchmark: per-row session.merge() vs. the shared bulk loader (bulk_loader.upsert).
+
+Creates a scratch table in the aggregation DB with the same layout as energy_consumption_hourly,
+loads synthetic hourly records with both paths (first as inserts, then as updates of the same keys)
+and prints the rows per second of each. The scratch table is dropped afterwards.
+
+Usage:
+    python -m backend.scripts.bench_bulk_loader                # 10000 rows
+    python -m backend.scripts.bench_bulk_loader 50000 2000     # rows, batch size
+
+Args:
+    rows       : Number of synthetic records (default 10000)
+    batch_size : Batch size for the bulk loader (default ETL_LOAD_BATCH_SIZE)
+'''
+
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import Session, Mapped, mapped_column
+
+from backend.database import agg_engine
+from backend.models import Base
+from backend.scripts.bulk_loader import upsert, DEFAULT_BATCH_SIZE
+
+
+class BenchEnergyHourly(Base):
+    """Scratch copy of energy_consumption_hourly, only used by this benchmark"""
+    __tablename__ = "bench_energy_consumption_hourly"
+
+    hour_ts: Mapped[datetime] = mapped_column(primary_key=True)
+    energy_kwh: Mapped[float]
+
+
+def make_records(n):
+    start = datetime(2021, 1, 1)
+    return [
+        {'hour_ts': start + timedelta(hours=i), 'energy_kwh': round(random.uniform(0, 50), 3)}
+        for i in range(n)
+    ]
+
+
+def load_with_merge(records):
+    '''The path every ETL used before: one ORM object and one merge() per record'''
+    session = Session(agg_engine)
+    try:
+        for record in records:
+            session.merge(BenchEnergyHourly(**record))
+        session.commit()
+    finally:
+        session.close()
+
+
+def load_with_upsert(records, batch_size):
+    upsert(BenchEnergyHourly, records, conflict_columns=['hour_ts'], batch_size=batch_size)
+
+
+def timed(label, fn, n):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed:8.2f} s  {n / elapsed:12.0f} rows/s")
+    return elapsed
+
+
+def truncate():
+    with agg_engine.begin() as conn:
+        conn.execute(BenchEnergyHourly.__table__.delete())
+
+
+def main(n, batch_size):
+    table = BenchEnergyHourly.__table__
+    table.drop(agg_engine, checkfirst=True)
+    table.create(agg_engine)
+
+    try:
+        records = make_records(n)
+        updated = [{**r, 'energy_kwh': r['energy_kwh'] + 1} for r in records]
+
+        print(f"\n{n} rows, bulk batch size {batch_size}\n")
+
+        merge_insert = timed("session.merge (insert)", lambda: load_with_merge(records), n)
+        merge_update = timed("session.merge (update)", lambda: load_with_merge(updated), n)
+        truncate()
+        bulk_insert = timed("bulk upsert (insert)", lambda: load_with_upsert(records, batch_size), n)
+        bulk_update = timed("bulk upsert (update)", lambda: load_with_upsert(updated, batch_size), n)
+
+        print(f"\nSpeed-up: insert x{merge_insert / bulk_insert:.1f}, update x{merge_update / bulk_update:.1f}")
+    finally:
+        table.drop(agg_engine, checkfirst=True)
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    batch = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_BATCH_SIZE
+    main(rows, batch)
@@ -0,0 +1,106 @@
+'''
+Benchmark: fetchall() + a dict per row vs. binary COPY into column arrays (copy_extract.py).
+
+Reads the readings of the sensor of etl_agg_sensor_stats for a range of days from the production
+server with both paths and prints the rows per second of each, extraction alone and extraction
+plus transform (transform_data vs. transform_columns). The fetchall path is the one of
+etl_agg_sensor_stats.extract_data(), with a UTC ts built for every reading.
+A warm-up read runs first, so neither path pays for cold pages. Nothing is written.
+
+Usage:
+    python -m backend.scripts.bench_copy_extract                          # Last 7 days with data
+    python -m backend.scripts.bench_copy_extract 2022-02-01 2022-02-07    # Date range
+
+Args:
+    start_date : First day (optional)
+    end_date   : Last day (optional, defaults to start_date)
+'''
+
+import sys
+import time
+from datetime import timedelta
+
+from sqlalchemy import text
+
+from backend.database import prod_engine
+from backend.scripts.copy_extract import copy_columns
+from backend.scripts.etl_common import day_bounds_ms, parse_date
+from backend.scripts import etl_agg_sensor_stats, etl_watermark
+
+
+QUERY = '''
+    SELECT date::int8 AS date_ms, value::float8 AS value
+    FROM variable_log_float
+    WHERE id_var = ANY({ids})
+    AND date >= {start_ms}
+    AND date < {end_ms}
+    AND value IS NOT NULL
+'''
+
+
+def extract_with_fetchall(params):
+    '''The path every extract function uses: Row objects, then a dict per row'''
+    with prod_engine.connect() as conn:
+        rows = conn.execute(text(QUERY.format(ids=':ids', start_ms=':start_ms', end_ms=':end_ms')), params).fetchall()
+    return [{'ts': etl_agg_sensor_stats.reading_ts(row.date_ms), 'value': row.value, 'date_ms': row.date_ms}
+            for row in rows]
+
+
+def extract_with_copy(params):
+    return copy_columns(QUERY.format(ids='%(ids)s', start_ms='%(start_ms)s', end_ms='%(end_ms)s'),
+                        params, [('date_ms', 'int8'), ('value', 'float8')])
+
+
+def timed(label, fn, n=None):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    n = n if n is not None else len(result['value'] if isinstance(result, dict) else result)
+    print(f"{label:<34} {elapsed:8.2f} s  {n / elapsed if elapsed else 0:12.0f} rows/s")
+    return elapsed, result
+
+
+def default_range():
+    _, last_day = etl_agg_sensor_stats.get_date_range()
+    if last_day is None:
+        return None, None
+    last_day = parse_date(last_day)
+    return last_day - timedelta(days=6), last_day
+
+
+def main(start_date, end_date):
+    start_ms, end_ms = day_bounds_ms(start_date, end_date)
+    params = {
+        'ids': etl_watermark.variable_ids([etl_agg_sensor_stats.SENSOR_OF_CHOICE]),
+        'start_ms': start_ms,
+        'end_ms': end_ms
+    }
+
+    # Warm-up, so neither path pays for cold pages or the first connection
+    extract_with_copy(params)
+
+    fetch_time, records = timed("fetchall + dicts", lambda: extract_with_fetchall(params))
+    copy_time, columns = timed("binary COPY to arrays", lambda: extract_with_copy(params))
+    n = len(records)
+    if n != len(columns['value']):
+        print(f"Row counts differ: {n} vs {len(columns['value'])}")
+        return
+
+    print(f"\n{n} readings from {start_date} to {end_date}\n")
+    fetch_total, _ = timed("fetchall + dicts + transform",
+                           lambda: etl_agg_sensor_stats.transform_data(extract_with_fetchall(params)), n)
+    copy_total, _ = timed("binary COPY + transform_columns",
+                          lambda: etl_agg_sensor_stats.transform_columns(extract_with_copy(params)), n)
+
+    print(f"\nSpeed-up: extraction x{fetch_time / copy_time:.1f}, with transform x{fetch_total / copy_total:.1f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        start, end = sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else sys.argv[1]
+    else:
+        start, end = default_range()
+        if start is None:
+            print("No sensor readings found")
+            sys.exit(1)
+    main(start, end)
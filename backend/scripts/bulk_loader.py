@@ -0,0 +1,161 @@
+'''
+Shared bulk loader for the ETL scripts.
+
+Replaces the "one ORM object + session.merge() per record" pattern, which issues a SELECT
+per row before its INSERT/UPDATE. Two load modes are available:
+
+    upsert():       Batches of multi-row INSERT ... ON CONFLICT DO UPDATE statements,
+                    for tables with a natural primary key (hour, day + type, ...).
+    replace_days(): Streams the rows with COPY into a staging table and, in the same transaction,
+                    deletes and re-inserts exactly the affected days. Used for the append-only
+                    tables with surrogate ids (alerts_detail, machine_program_data),
+                    so re-running a date never duplicates rows.
+
+    EXAMPLE BELOW:
+    from backend.scripts.bulk_loader import upsert, replace_days
+    upsert(EnergyConsumptionHourly, records, conflict_columns=['hour_ts'])
+    replace_days(MachineProgramData, records, day_column='dt', days=['2022-02-23'])
+
+The batch size defaults to 1000 rows and can be changed with the ETL_LOAD_BATCH_SIZE
+environment variable or per call. See bench_bulk_loader.py for a comparison with session.merge().
+'''
+
+import json
+import logging
+import os
+from datetime import date
+
+from psycopg import sql
+from sqlalchemy import literal_column
+from sqlalchemy.dialects.postgresql import insert
+
+from backend.database import agg_engine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = int(os.getenv("ETL_LOAD_BATCH_SIZE", "1000"))
+
+
+def batched(records, batch_size):
+    '''Yield consecutive slices of at most batch_size records'''
+    for i in range(0, len(records), batch_size):
+        yield records[i:i + batch_size]
+
+
+def upsert(model, records, conflict_columns, update_columns=None, update_set=None,
+           batch_size=None, engine=None):
+    '''
+    Insert records into the table of a model, updating the rows that already exist.
+
+    Params:
+        model:            ORM model of the target table, e.g. AlertsDailyCount
+        records:          List of dicts keyed by column name
+        conflict_columns: Columns of the primary key / unique index used for ON CONFLICT
+        update_columns:   Columns overwritten with the new value on conflict.
+                          Defaults to every column in the records that is not a conflict column.
+        update_set:       Optional dict of column -> SQL expression for custom updates,
+                          e.g. {'amount': 'alerts_daily_count.amount + EXCLUDED.amount'}
+        batch_size:       Rows per INSERT statement (DEFAULT_BATCH_SIZE if None)
+        engine:           Target engine, the aggregation DB by default
+
+    Returns:
+        Number of records sent to the database.
+    '''
+    if not records:
+        return 0
+
+    batch_size = batch_size or DEFAULT_BATCH_SIZE
+    engine = engine or agg_engine
+    table = model.__table__
+
+    if update_columns is None:
+        update_columns = [column for column in records[0] if column not in conflict_columns]
+
+    try:
+        # engine.begin() commits once at the end, or rolls back everything on error
+        with engine.begin() as conn:
+            for batch in batched(records, batch_size):
+                stmt = insert(table).values(batch)
+
+                set_ = {column: stmt.excluded[column] for column in update_columns}
+                for column, expression in (update_set or {}).items():
+                    set_[column] = literal_column(expression)
+
+                if set_:
+                    stmt = stmt.on_conflict_do_update(index_elements=conflict_columns, set_=set_)
+                else:
+                    stmt = stmt.on_conflict_do_nothing(index_elements=conflict_columns)
+
+                conn.execute(stmt)
+
+        return len(records)
+
+    except Exception as e:
+        logger.error(f"Bulk upsert into {table.name} failed: {str(e)}")
+        raise
+
+
+def _copy_value(value):
+    # COPY in text format has no adapter for dicts/lists, JSONB columns receive their JSON text
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def replace_days(model, records, day_column, days, columns=None, engine=None):
+    '''
+    Atomically replace all rows of the given days with the new records.
+
+    The records are streamed with COPY into a temporary staging table, then the target rows
+    of those days are deleted and the staged rows inserted, all in a single transaction.
+    Days without records are still cleared, so a rerun always leaves exactly one copy.
+
+    Params:
+        model:      ORM model of the target table, e.g. AlertsDetail
+        records:    List of dicts keyed by column name
+        day_column: DATE column identifying the partition, e.g. 'day' or 'dt'
+        days:       Days (date or 'YYYY-MM-DD') covered by this load
+        columns:    Columns to copy, defaults to the keys of the first record
+        engine:     Target engine, the aggregation DB by default
+
+    Returns:
+        Number of rows inserted.
+    '''
+    days = [date.fromisoformat(day) if isinstance(day, str) else day for day in days]
+    if not days:
+        return 0
+
+    engine = engine or agg_engine
+    table_name = model.__table__.name
+    columns = columns or (list(records[0]) if records else [])
+
+    table = sql.Identifier(table_name)
+    staging = sql.Identifier(f"staging_{table_name}")
+    column_list = sql.SQL(', ').join(sql.Identifier(column) for column in columns)
+
+    try:
+        with engine.begin() as conn:
+            # Raw psycopg connection, inside the transaction opened by engine.begin()
+            with conn.connection.driver_connection.cursor() as cur:
+                if records:
+                    cur.execute(sql.SQL(
+                        "CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT {columns} FROM {table} WITH NO DATA"
+                    ).format(staging=staging, columns=column_list, table=table))
+
+                    with cur.copy(sql.SQL("COPY {staging} ({columns}) FROM STDIN").format(
+                            staging=staging, columns=column_list)) as copy:
+                        for record in records:
+                            copy.write_row([_copy_value(record[column]) for column in columns])
+
+                cur.execute(sql.SQL("DELETE FROM {table} WHERE {day} = ANY(%s)").format(
+                    table=table, day=sql.Identifier(day_column)), (days,))
+
+                if records:
+                    cur.execute(sql.SQL("INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging}").format(
+                        table=table, columns=column_list, staging=staging))
+
+        return len(records)
+
+    except Exception as e:
+        logger.error(f"Day replace of {table_name} failed: {str(e)}")
+        raise
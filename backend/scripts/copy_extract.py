@@ -0,0 +1,131 @@
+'''
+Column extraction from the production server through binary COPY.
+
+conn.execute(text(query)).fetchall() builds a Row object per row, and the ETLs then build a dict
+from every Row. For scans of millions of readings this row materialization is most of the client
+CPU. copy_columns() runs the query as `COPY (SELECT ...) TO STDOUT (FORMAT BINARY)` through psycopg
+and decodes the stream straight into typed arrays (array module), one per column:
+no Row, tuple or dict per reading.
+
+Only fixed-width columns are supported (int2, int4, int8, float4, float8, bool), so every row
+has the same size and a block of rows is unpacked by a single precompiled struct. Cast the
+columns in the query and filter out NULLs, e.g.
+
+    SELECT date::int8, value::float8
+    FROM variable_log_float
+    WHERE id_var = ANY(%(ids)s) AND date >= %(start_ms)s AND date < %(end_ms)s
+    AND value IS NOT NULL
+
+The parameters use the psycopg placeholder style (%(name)s) and are bound client side,
+COPY does not accept server-side parameters. See bench_copy_extract.py for the speed-up.
+'''
+
+import logging
+import struct
+from array import array
+
+from backend.database import prod_engine
+
+logger = logging.getLogger(__name__)
+
+# Rows unpacked per struct call
+CHUNK_ROWS = 8192
+
+# PostgreSQL type -> (struct code, array typecode, size in bytes)
+COLUMN_TYPES = {
+    'int2': ('h', 'h', 2),
+    'int4': ('i', 'i', 4),
+    'int8': ('q', 'q', 8),
+    'float4': ('f', 'f', 4),
+    'float8': ('d', 'd', 8),
+    'bool': ('?', 'b', 1),
+}
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+COPY_TRAILER = b'\xff\xff'
+
+
+class _RowDecoder:
+    '''Unpacks whole blocks of fixed-width binary COPY rows into column arrays'''
+
+    def __init__(self, columns, chunk_rows):
+        self.names = [name for name, _ in columns]
+        self.types = [COLUMN_TYPES[pg_type] for _, pg_type in columns]
+        # Every row: field count (int16), then length (int32) and value of every field
+        self.row_format = 'h' + ''.join('i' + code for code, _, _ in self.types)
+        self.row_size = 2 + sum(4 + size for _, _, size in self.types)
+        self.stride = 1 + 2 * len(self.types)
+        self.chunk_rows = chunk_rows
+        self.chunk = struct.Struct('>' + self.row_format * chunk_rows)
+        self.arrays = {name: array(typecode) for name, (_, typecode, _) in zip(self.names, self.types)}
+
+    def decode(self, buffer, offset, rows):
+        '''Append `rows` rows starting at buffer[offset], returns the offset after them'''
+        while rows:
+            n = min(rows, self.chunk_rows)
+            unpacker = self.chunk if n == self.chunk_rows else struct.Struct('>' + self.row_format * n)
+            values = unpacker.unpack_from(buffer, offset)
+
+            # A NULL or a variable-width value shifts the layout, the counts no longer match
+            if values[0::self.stride].count(len(self.types)) != n or any(
+                    values[1 + 2 * i::self.stride].count(size) != n for i, (_, _, size) in enumerate(self.types)):
+                raise ValueError("Unexpected row layout in COPY output: cast every column to a fixed-width "
+                                 "type and filter out NULLs in the query")
+
+            for i, name in enumerate(self.names):
+                self.arrays[name].extend(values[2 + 2 * i::self.stride])
+            offset += n * self.row_size
+            rows -= n
+        return offset
+
+
+def copy_columns(query, params, columns, engine=prod_engine, chunk_rows=CHUNK_ROWS):
+    '''
+    Run a SELECT through binary COPY and return its columns as typed arrays.
+
+    Params:
+        query:   SELECT statement with psycopg placeholders (%(name)s), no trailing semicolon
+        params:  Dict of parameters, or None
+        columns: List of (name, type) in select order, type one of COLUMN_TYPES
+        engine:  Engine whose pool provides the connection (production by default)
+
+    Returns:
+        Dict name -> array, all of the same length.
+    '''
+    decoder = _RowDecoder(columns, chunk_rows)
+    buffer = bytearray()
+    offset = None          # Start of the first undecoded row, None until the header is read
+
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            with cursor.copy(f"COPY ({query}) TO STDOUT (FORMAT BINARY)", params) as copy:
+                for block in copy:
+                    buffer += block
+                    if offset is None:
+                        if len(buffer) < 19:
+                            continue
+                        if bytes(buffer[:11]) != COPY_SIGNATURE:
+                            raise ValueError("Not a binary COPY stream")
+                        extension = struct.unpack_from('>i', buffer, 15)[0]
+                        if len(buffer) < 19 + extension:
+                            continue
+                        offset = 19 + extension
+
+                    # Decode whole chunks while streaming, the rest once the stream has ended
+                    rows = (len(buffer) - offset) // decoder.row_size // chunk_rows * chunk_rows
+                    if rows:
+                        offset = decoder.decode(buffer, offset, rows)
+                        del buffer[:offset]
+                        offset = 0
+    finally:
+        connection.close()
+
+    if offset is None or bytes(buffer[-2:]) != COPY_TRAILER:
+        raise ValueError("Incomplete binary COPY stream")
+    rows, rest = divmod(len(buffer) - offset - 2, decoder.row_size)
+    if rest:
+        raise ValueError("Unexpected row layout in COPY output: cast every column to a fixed-width "
+                         "type and filter out NULLs in the query")
+    decoder.decode(buffer, offset, rows)
+    return decoder.arrays
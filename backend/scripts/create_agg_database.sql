@@ -1,6 +1,6 @@
 
 -- Script: create_agg_database.sql
--- Version: 1.0
+-- Version: 1.1
 -- Description: Creates aggregation database tables for pre-computed metrics
 -- Usage: psql machine_monitoring_agg -f create_agg_database.sql
 
@@ -24,6 +24,45 @@ CREATE TABLE IF NOT EXISTS agg_machine_activity_daily (
 );
 
 
+-- Table: agg_activity_10min
+-- Purpose: Log entries of all variables per 10-minute bucket (UTC), with first/last raw timestamp
+-- The only utilization input read from the raw logs, see etl_agg_activity_buckets.py
+
+CREATE TABLE IF NOT EXISTS agg_activity_10min (
+    bucket_ts TIMESTAMP PRIMARY KEY,
+    dt DATE NOT NULL,
+    readings_count INT NOT NULL CHECK (readings_count > 0),
+    first_ms BIGINT NOT NULL,
+    last_ms BIGINT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_activity_10min_dt ON agg_activity_10min (dt);
+
+-- Table: agg_machine_activity_hourly
+-- Purpose: Running seconds and log entries per hour, derived from agg_activity_10min
+
+CREATE TABLE IF NOT EXISTS agg_machine_activity_hourly (
+    hour_ts TIMESTAMP PRIMARY KEY,
+    running_seconds INT NOT NULL CHECK (running_seconds BETWEEN 0 AND 3600),
+    readings_count INT NOT NULL DEFAULT 0
+);
+
+-- Table: agg_machine_state_timeline
+-- Purpose: Merged PARADA / IDLE / OPERACION blocks per day (state Gantt)
+-- 0 log entries in a 10-minute bucket = PARADA, up to 30 = IDLE, more = OPERACION
+
+CREATE TABLE IF NOT EXISTS agg_machine_state_timeline (
+    id SERIAL PRIMARY KEY,
+    dt DATE NOT NULL,
+    state VARCHAR(10) NOT NULL CHECK (state IN ('PARADA', 'IDLE', 'OPERACION')),
+    start_ts TIMESTAMP NOT NULL,
+    end_ts TIMESTAMP NOT NULL,
+    duration_seconds INT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_machine_state_timeline_dt ON agg_machine_state_timeline (dt);
+
+
 -- Table: agg_sensor_stats
 -- Purpose: Stores hourly aggregated sensor readings (temperature, pressure, etc.)
 -- Example: For TEMPERATURE_BASE, we average all readings within each hour
@@ -36,10 +75,56 @@ CREATE TABLE IF NOT EXISTS agg_sensor_stats (
     max_value FLOAT,                         -- Maximum value during the hour
     std_dev   FLOAT,                         -- Needed for the Nivo BoxPlot
     readings_count INT,                      -- Number of raw readings aggregated
+    mean_value FLOAT,                        -- Unrounded mean (mergeable state)
+    m2_value FLOAT,                          -- Sum of squared deviations from the mean (mergeable state)
+    last_reading_ms BIGINT,                  -- Raw epoch-ms of the newest reading folded into the row
+    value_sketch JSONB,                      -- Mergeable DDSketch of the readings (quantiles)
     last_updated_at TIMESTAMP DEFAULT NOW(), -- Timestamp of last aggregation
     PRIMARY KEY (sensor_name, dt)
 );
 
+-- Mergeable state for databases created before version 1.1.
+-- Existing rows are seeded from their rounded values; a backfill restores full precision.
+ALTER TABLE agg_sensor_stats ADD COLUMN IF NOT EXISTS mean_value FLOAT;
+ALTER TABLE agg_sensor_stats ADD COLUMN IF NOT EXISTS m2_value FLOAT;
+ALTER TABLE agg_sensor_stats ADD COLUMN IF NOT EXISTS last_reading_ms BIGINT;
+ALTER TABLE agg_sensor_stats ADD COLUMN IF NOT EXISTS value_sketch JSONB;
+
+UPDATE agg_sensor_stats
+SET mean_value = avg_value,
+    m2_value = COALESCE(POWER(std_dev, 2) * (readings_count - 1), 0)
+WHERE mean_value IS NULL;
+
+-- Functions: sketch_merge_bins / sketch_merge
+-- Purpose: Merge two serialized DDSketches ({"alpha", "zero", "pos", "neg"}) by adding
+-- their bucket counts. Used when new readings are folded into an existing hour.
+
+CREATE OR REPLACE FUNCTION sketch_merge_bins(a JSONB, b JSONB) RETURNS JSONB AS $$
+    SELECT COALESCE(jsonb_object_agg(key, total), '{}'::jsonb)
+    FROM (
+        SELECT key, SUM(value::bigint) AS total
+        FROM (
+            SELECT * FROM jsonb_each_text(COALESCE(a, '{}'::jsonb))
+            UNION ALL
+            SELECT * FROM jsonb_each_text(COALESCE(b, '{}'::jsonb))
+        ) AS bins
+        GROUP BY key
+    ) AS merged
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION sketch_merge(a JSONB, b JSONB) RETURNS JSONB AS $$
+    SELECT CASE
+        WHEN a IS NULL THEN b
+        WHEN b IS NULL THEN a
+        ELSE jsonb_build_object(
+            'alpha', b -> 'alpha',
+            'zero', COALESCE((a ->> 'zero')::bigint, 0) + COALESCE((b ->> 'zero')::bigint, 0),
+            'pos', sketch_merge_bins(a -> 'pos', b -> 'pos'),
+            'neg', sketch_merge_bins(a -> 'neg', b -> 'neg')
+        )
+    END
+$$ LANGUAGE sql IMMUTABLE;
+
 -- B-Tree indexes for fast date-based lookups
 -- Tailored for our request: GET sensor X's data for date Y
 CREATE INDEX IF NOT EXISTS idx_sensor_date ON agg_sensor_stats(sensor_name, CAST(dt AS DATE));
@@ -70,7 +155,21 @@ CREATE TABLE IF NOT EXISTS alerts_detail(
     raw_elem_json JSONB
 );
 
-CREATE INDEX idx_alerts_detail_day_type ON alerts_detail (day, alert_type);
+CREATE INDEX IF NOT EXISTS idx_alerts_detail_day_type ON alerts_detail (day, alert_type);
+
+-- Table: alert_classification
+-- Purpose: Memoized alert types per distinct alarm code/description (see alert_classifier.py)
+-- Rows made with an older rule set (rules_version) are reclassified on the next ETL run
+
+CREATE TABLE IF NOT EXISTS alert_classification(
+    alarm_code TEXT NOT NULL DEFAULT '',
+    alarm_description TEXT NOT NULL DEFAULT '',
+    alert_type VARCHAR(20) NOT NULL
+        CHECK(alert_type in ('emergency', 'error', 'warning', 'other')),
+    rules_version VARCHAR(40) NOT NULL,
+    classified_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (alarm_code, alarm_description)
+);
 
 -- Table: machine_program_data
 -- Purpose: Program usage per day (P0, P1, etc. and their run duration)
@@ -82,6 +181,21 @@ CREATE TABLE IF NOT EXISTS machine_program_data(
     duration_seconds BIGINT NOT NULL CHECK (duration_seconds >= 0)
 );
 
+-- Used by the ETL to replace a whole day atomically on reruns
+CREATE INDEX IF NOT EXISTS idx_machine_program_dt ON machine_program_data (dt);
+
+-- Table: program_history_checkpoint
+-- Purpose: Program active at the end of each processed window (window_end exclusive),
+-- so the next window does not have to search the whole program history for its start state
+
+CREATE TABLE IF NOT EXISTS program_history_checkpoint (
+    window_end DATE PRIMARY KEY,
+    window_start DATE NOT NULL,
+    last_program INT,
+    last_change_ms BIGINT,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
 -- Table: energy_consumption_hourly
 -- Purpose: Estimated hourly energy consumption based on motor utilization
 
@@ -90,6 +204,90 @@ CREATE TABLE IF NOT EXISTS energy_consumption_hourly (
     energy_kwh NUMERIC NOT NULL
 );
 
+-- Table: energy_motor_config
+-- Purpose: Motors included in the energy estimate and their nominal power
+-- motor is the name of the utilization variable in the production DB
+
+CREATE TABLE IF NOT EXISTS energy_motor_config (
+    motor VARCHAR(100) PRIMARY KEY,
+    nominal_kw FLOAT NOT NULL CHECK (nominal_kw > 0),
+    enabled BOOLEAN NOT NULL DEFAULT TRUE
+);
+
+INSERT INTO energy_motor_config (motor, nominal_kw) VALUES
+    ('AXIS_X_MOTOR_UTILIZACION', 15.1),
+    ('AXIS_Y_MOTOR_UTILIZATION', 15.1),
+    ('AXIS_Z_MOTOR_UTILIZACION', 15.71),
+    ('SPINDLE_LOAD_1',           37.0)
+ON CONFLICT (motor) DO NOTHING;
+
+-- Table: energy_consumption_motor_hourly
+-- Purpose: Hourly energy per motor, answers "which axis burned the energy"
+
+CREATE TABLE IF NOT EXISTS energy_consumption_motor_hourly (
+    hour_ts TIMESTAMP NOT NULL,
+    motor VARCHAR(100) NOT NULL,
+    energy_kwh NUMERIC NOT NULL,
+    PRIMARY KEY (hour_ts, motor)
+);
+
+-- Table: program_energy_daily
+-- Purpose: Runtime and energy attributed to each program (variable 581) per day
+-- Filled by etl_agg_program_energy.py in one time-ordered sweep of programs and motors
+
+CREATE TABLE IF NOT EXISTS program_energy_daily (
+    dt DATE NOT NULL,
+    program INT NOT NULL,
+    runtime_seconds BIGINT NOT NULL CHECK (runtime_seconds >= 0),
+    energy_kwh NUMERIC NOT NULL,
+    PRIMARY KEY (dt, program)
+);
+
+-- Table: etl_watermark
+-- Purpose: Processing state of every ETL per day (partition), so each ETL resumes on its own
+-- source_fingerprint summarises the source rows of the day when it was processed
+
+CREATE TABLE IF NOT EXISTS etl_watermark (
+    etl_name VARCHAR(100) NOT NULL,
+    partition_date DATE NOT NULL,
+    range_start_ms BIGINT NOT NULL,
+    range_end_ms BIGINT NOT NULL,
+    rows_loaded INT,
+    source_fingerprint VARCHAR(64),
+    status VARCHAR(20) NOT NULL CHECK (status IN ('running', 'done', 'failed', 'stale')),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (etl_name, partition_date)
+);
+
+-- Databases created before the 'stale' status (etl_dirty_partitions.py)
+ALTER TABLE etl_watermark DROP CONSTRAINT IF EXISTS etl_watermark_status_check;
+ALTER TABLE etl_watermark ADD CONSTRAINT etl_watermark_status_check
+    CHECK (status IN ('running', 'done', 'failed', 'stale'));
+
+-- Table: etl_stream_watermark
+-- Purpose: Last raw epoch-ms timestamp folded in by every micro-batch stream (etl_microbatch.py)
+
+CREATE TABLE IF NOT EXISTS etl_stream_watermark (
+    stream_name VARCHAR(100) PRIMARY KEY,
+    last_ms BIGINT NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Table: source_coverage
+-- Purpose: Raw log entries per day and variable (both log tables), with first/last raw timestamp
+-- Lets the ETLs skip days without data and size their windows, see etl_source_coverage.py
+
+CREATE TABLE IF NOT EXISTS source_coverage (
+    dt DATE NOT NULL,
+    id_var INT NOT NULL,
+    readings_count INT NOT NULL CHECK (readings_count > 0),
+    first_ms BIGINT NOT NULL,
+    last_ms BIGINT NOT NULL,
+    PRIMARY KEY (dt, id_var)
+);
+
+CREATE INDEX IF NOT EXISTS idx_source_coverage_var ON source_coverage (id_var, dt);
+
 
 -- =============================================================================
 -- VIEWS
@@ -121,7 +319,10 @@ SELECT
     (SELECT COUNT(*) FROM agg_machine_activity_daily) as utilization_records,
     (SELECT COUNT(*) FROM alerts_detail) as alert_records,
     (SELECT COUNT(*) FROM machine_program_data) as program_records,
-    (SELECT COUNT(*) FROM energy_consumption_hourly) as energy_records
+    (SELECT COUNT(*) FROM energy_consumption_hourly) as energy_records,
+    (SELECT MIN(dt) FROM source_coverage) as source_first_date,
+    (SELECT MAX(dt) FROM source_coverage) as source_last_date,
+    (SELECT COUNT(DISTINCT dt) FROM source_coverage) as source_days
 FROM all_dates;
 
 
@@ -133,11 +334,22 @@ BEGIN
     RAISE NOTICE 'Aggregation database setup complete!';
     RAISE NOTICE 'Tables created:';
     RAISE NOTICE '  - agg_machine_activity_daily';
+    RAISE NOTICE '  - agg_activity_10min';
+    RAISE NOTICE '  - agg_machine_activity_hourly';
+    RAISE NOTICE '  - agg_machine_state_timeline';
     RAISE NOTICE '  - agg_sensor_stats';
     RAISE NOTICE '  - alerts_daily_count';
     RAISE NOTICE '  - alerts_detail';
+    RAISE NOTICE '  - alert_classification';
     RAISE NOTICE '  - machine_program_data';
+    RAISE NOTICE '  - program_history_checkpoint';
     RAISE NOTICE '  - energy_consumption_hourly';
+    RAISE NOTICE '  - energy_motor_config';
+    RAISE NOTICE '  - energy_consumption_motor_hourly';
+    RAISE NOTICE '  - program_energy_daily';
+    RAISE NOTICE '  - etl_watermark';
+    RAISE NOTICE '  - etl_stream_watermark';
+    RAISE NOTICE '  - source_coverage';
     RAISE NOTICE 'Views created:';
     RAISE NOTICE '  - v_data_status';
 END $$;
@@ -0,0 +1,154 @@
+'''
+ETL (Extract, Transform and Load) script for 10-minute activity buckets.
+Counts the log entries of every variable (variable_log_float and variable_log_string) per
+10-minute bucket and keeps the first and last raw timestamp of each bucket.
+
+This is the only stage that scans every raw log row. Daily and hourly utilization and the
+PARADA/IDLE/OPERACION state timeline are derived from agg_activity_10min by etl_agg_utilization.py.
+Only buckets with at least one log entry are stored. Buckets are aligned to UTC midnight.
+Windows whose days are all in the local raw cache (raw_cache.py) are aggregated from there.
+
+Usage:
+    python -m backend.scripts.etl_agg_activity_buckets                       # Full backfill
+    python -m backend.scripts.etl_agg_activity_buckets 2021-09-14            # Single day
+    python -m backend.scripts.etl_agg_activity_buckets 2021-09-01 2021-09-30 # Date range
+    python -m backend.scripts.etl_agg_activity_buckets 2021-09-01 2021-09-30 --resume
+
+Args:
+    start_date: Start date (optional). If missing, processes all available data.
+    end_date:   End date (optional). If missing, processes single day (start_date).
+    --resume:   Skip the days already processed according to etl_watermark.
+'''
+
+import logging
+import sys
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+from backend.database import prod_engine
+from backend.models import AggActivity10min
+from backend.scripts.bulk_loader import replace_days
+from backend.scripts.etl_common import ms_to_day, days_in_range
+from backend.scripts import etl_source_coverage, etl_watermark
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ETL_NAME = 'etl_agg_activity_buckets'
+
+# Days per extraction query
+ACTIVITY_WINDOW_DAYS = 7
+
+BUCKET_MS = 600 * 1000
+
+
+def get_date_range():
+    '''
+    Query the source DB for the min and max dates when no dates are provided.
+    Used for full backfill.
+    '''
+    try:
+        with prod_engine.connect() as conn:
+            row = conn.execute(text('''
+                SELECT MIN(min_ms) AS min_ms, MAX(max_ms) AS max_ms
+                FROM (
+                    SELECT MIN(date) AS min_ms, MAX(date) AS max_ms FROM variable_log_float
+                    UNION ALL
+                    SELECT MIN(date), MAX(date) FROM variable_log_string
+                ) bounds
+            ''')).fetchone()
+            if row and row.min_ms is not None and row.max_ms is not None:
+                return str(ms_to_day(row.min_ms)), str(ms_to_day(row.max_ms))
+            return None, None
+    except Exception as e:
+        logger.error(f"Failed to get date range: {str(e)}")
+        raise
+
+
+def extract_data(start_date, end_date=None):
+    '''
+    Aggregate the log entries of a range of days into 10-minute buckets.
+    Each table is pre-aggregated on its own, then both are combined per bucket
+    (see etl_source_coverage.extract_counts).
+
+    Returns:
+        (buckets, fingerprints): list of dicts with bucket_ms, readings_count, first_ms and last_ms,
+        ordered by bucket, and the source fingerprint of every day, derived from the same counts.
+    '''
+    end_date = end_date or start_date
+    counts = etl_source_coverage.extract_counts(start_date, end_date, BUCKET_MS)
+    buckets = etl_source_coverage.combine_tables(counts, ['bucket_ms'])
+    return buckets, etl_watermark.count_fingerprints(start_date, end_date, counts)
+
+
+def transform_data(buckets):
+    '''
+    Add the bucket start (naive UTC timestamp) and its day to every bucket.
+    '''
+    return [
+        {
+            'bucket_ts': datetime.fromtimestamp(bucket['bucket_ms'] / 1000, tz=timezone.utc).replace(tzinfo=None),
+            'dt': ms_to_day(bucket['bucket_ms']),
+            'readings_count': bucket['readings_count'],
+            'first_ms': bucket['first_ms'],
+            'last_ms': bucket['last_ms']
+        }
+        for bucket in buckets
+    ]
+
+
+def load_data(data, days):
+    '''
+    Load the buckets into the aggregated database.
+    Replaces all buckets of the given days, so re-running a range is idempotent.
+    '''
+    try:
+        loaded = replace_days(AggActivity10min, data, day_column='dt', days=days,
+                              columns=['bucket_ts', 'dt', 'readings_count', 'first_ms', 'last_ms'])
+        logger.info(f"Loaded {loaded} activity buckets")
+        return loaded
+    except Exception as e:
+        logger.error(f"Load failed: {str(e)}")
+        raise
+
+
+def run_etl(start_date=None, end_date=None, resume=False, window_days=ACTIVITY_WINDOW_DAYS):
+    '''
+    Main orchestration function.
+    '''
+    if start_date is None:
+        logger.info("No dates provided, fetching full date range...")
+        start_date, end_date = get_date_range()
+        if not start_date:
+            logger.error("Could not determine date range from database")
+            return
+        logger.info(f"Full backfill from {start_date} to {end_date}")
+    elif end_date is None:
+        logger.info(f"Processing single day: {start_date}")
+        end_date = start_date
+    else:
+        logger.info(f"Processing range: {start_date} to {end_date}")
+
+    total_records = 0
+    # Not skipped through the coverage index, it only counts the tracked variables
+    for first_day, last_day in etl_watermark.pending_windows(ETL_NAME, start_date, end_date, window_days, resume):
+        # Every variable counts as activity, the fingerprints come from the same counts
+        with etl_watermark.track(ETL_NAME, first_day, last_day, fingerprints_from_data=True) as partition:
+            buckets, partition.fingerprints = extract_data(first_day, last_day)
+            data = transform_data(buckets)
+            total_records += load_data(data, days_in_range(first_day, last_day))
+            partition.add_rows(data, 'dt')
+
+    logger.info(f"ETL complete. Total buckets loaded: {total_records}")
+
+
+if __name__ == "__main__":
+    resume = '--resume' in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if len(args) == 1:
+        run_etl(args[0], resume=resume)
+    elif len(args) == 2:
+        run_etl(args[0], args[1], resume=resume)
+    else:
+        run_etl(resume=resume)
@@ -1,40 +1,54 @@
 '''
 ETL (Extract, Transform and Load) script for alerts data.
 Populates two tables: alerts_daily_count and alerts_detail
+Alarm elements are classified in Python by alert_classifier.py, not on the production server.
 
 Use the Arguments to filter on date. If one data from one date is desired, use only one argument.
 If data between an interval of two dates is desired, use two arguments, respectively start_date and end_date.
 
+The source is read in windows of several days (ALERT_WINDOW_DAYS) per query, filtered on the
+raw epoch-ms `date` so the (id_var, date) index is used, and split into days in Python.
+Windows whose days are all in the local raw cache (raw_cache.py) are read from there instead.
+
 Tip: When running the script, run it as a module:
     
     EXAMPLE BELOW:
     python -m backend.scripts.etl_agg_alerts 2022-02-23
     python -m backend.scripts.etl_agg_alerts 2022-02-01 2022-02-28
+    python -m backend.scripts.etl_agg_alerts 2022-02-01 2022-02-28 --resume
+    python -m backend.scripts.etl_agg_alerts 2022-02-01 2022-02-28 --pipeline
 
 Args:
     start_date : None by default (will do full backfill)
     end_date   : None by default
+    --resume   : Skip the days already processed according to etl_watermark
+    --pipeline : Extract the next window while the current one is classified and loaded
 '''
 
 # IMPORTS
 import logging
 import sys
 import json
+from collections import Counter
 
-from backend.database import prod_engine, agg_engine
+from backend.database import prod_engine
 from backend.models import AlertsDailyCount, AlertsDetail
+from backend.scripts.bulk_loader import replace_days
+from backend.scripts.alert_classifier import AlertClassifier
+from backend.scripts.etl_common import PIPELINE_DEPTH, day_bounds_ms, ms_to_day, days_in_range, prefetch_windows
+from backend.scripts import etl_source_coverage, etl_watermark, raw_cache
 from sqlalchemy import text
-from sqlalchemy.orm import Session
-from datetime import datetime, timedelta
+from collections import defaultdict
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+ETL_NAME = 'etl_agg_alerts'
 
+# Days per extraction query. A two-year backfill needs ~25 queries instead of ~700.
+ALERT_WINDOW_DAYS = 31
 
-# Mapping from query categories to table values
-ALERT_TYPE_MAP = {
-    'Emergency': 'emergency',
-    'Error': 'error',
-    'Alert': 'warning',  # Alert category maps to warning
-    'Other': 'other',
-}
+ALARM_VAR_ID = 447
 
 
 # HELPER FUNCTION
@@ -47,230 +61,197 @@ def get_date_range():
         with prod_engine.connect() as conn:
             query = '''
             SELECT 
-                MIN(to_timestamp(date / 1000))::date AS min_date,
-                MAX(to_timestamp(date / 1000))::date AS max_date
+                MIN(date) AS min_ms,
+                MAX(date) AS max_ms
             FROM variable_log_string
-            WHERE id_var = 447
+            WHERE id_var = :alarm_var_id
             AND value IS NOT NULL
             AND value != '[]'
             '''
-            result = conn.execute(text(query))
+            result = conn.execute(text(query), {'alarm_var_id': ALARM_VAR_ID})
             row = result.fetchone()
-            if row and row.min_date and row.max_date:
-                return str(row.min_date), str(row.max_date)
+            if row and row.min_ms is not None and row.max_ms is not None:
+                return str(ms_to_day(row.min_ms)), str(ms_to_day(row.max_ms))
             return None, None
     except Exception as e:
         logger.error(f"Failed to get date range: {str(e)}")
         raise
 
 
-# EXTRACT FUNCTION FOR DAILY COUNT
-def extract_daily_count(target_date):
-    '''
-    Query source DB for alert counts by type for a single date.
-    Returns list of dicts with day, alert_type, and amount.
-    '''
-    try:
-        with prod_engine.connect() as conn:
-            query = '''
-            WITH alarm_data AS (
-                SELECT
-                    to_timestamp(a.date / 1000) AS timestamp,
-                    TRIM(elem ->> 0) AS alarm_code,
-                    TRIM(elem ->> 1) AS alarm_description
-                FROM variable_log_string a
-                JOIN variable b ON a.id_var = b.id
-                CROSS JOIN LATERAL jsonb_array_elements(a.value::jsonb) AS elem
-                WHERE b.id = 447
-                  AND a.value IS NOT NULL
-                  AND a.value != '[]'
-                  AND LENGTH(a.value) > 2
-                  AND a.value ~ '^\\[.*\\]$'
-                  AND to_timestamp(a.date / 1000)::date = CAST(:target_date AS date)
-            ),
-            categorized AS (
-                SELECT
-                    timestamp,
-                    alarm_code,
-                    alarm_description,
-                    CASE
-                        WHEN alarm_description ILIKE '%emerg%' THEN 'Emergency'
-                        WHEN alarm_description ILIKE '%error%' OR 
-                             alarm_description ILIKE '%err%' OR
-                             alarm_description ILIKE '%fallo%' OR
-                             alarm_description ILIKE '%fault%' THEN 'Error'
-                        WHEN alarm_description ILIKE '%alert%' OR 
-                             alarm_description ILIKE '%alarm%' OR 
-                             alarm_description ILIKE '%warn%' OR
-                             alarm_description ILIKE '%aviso%' OR
-                             alarm_description ILIKE '%attention%' THEN 'Alert'
-                        ELSE 'Other'
-                    END AS alert_type
-                FROM alarm_data
-            )
-            SELECT 
-                alert_type,
-                COUNT(*) AS total_occurrences
-            FROM categorized
-            WHERE alert_type IS NOT NULL
-            GROUP BY alert_type
-            ORDER BY alert_type;
-            '''
+# Alert types we keep individual records for in alerts_detail
+DETAIL_ALERT_TYPES = ('emergency', 'error')
 
-            result = conn.execute(text(query), {'target_date': target_date})
-            rows = result.fetchall()
-            
-            return [
-                {
-                    'day': target_date,
-                    'alert_type': ALERT_TYPE_MAP.get(row.alert_type),
-                    'amount': row.total_occurrences
-                } 
-                for row in rows
-                if row.alert_type in ALERT_TYPE_MAP
-            ]
-            
-    except Exception as e:
-        logger.error(f"Failed to extract daily count: {str(e)}")
-        raise
 
-
-# EXTRACT FUNCTION FOR ALERT DETAILS
-def extract_details(target_date):
+# EXTRACT FUNCTION
+def extract_alerts(start_date, end_date=None):
     '''
-    Query source DB for detailed alert records for a single date.
-    Returns list of dicts with dt, alert_type, alarm_code, alarm_description, raw_elem_json.
+    Query source DB once for every alarm element between start_date and end_date (inclusive).
+    The alarm snapshots of variable 447 are expanded in a single pass, both the daily counts
+    and the detail rows are derived from this result (see split_alerts).
+    Returns list of dicts with day, dt, alarm_code, alarm_description, raw_elem_json.
+    dt is the naive UTC time, so the day alerts_detail derives from it is the UTC day of `day`.
     '''
+    cached = raw_cache.read_rows('variable_log_string', start_date, end_date, [ALARM_VAR_ID])
+    if cached is not None:
+        return expand_alerts(cached)
+
     try:
         with prod_engine.connect() as conn:
-
-            # Only querying for Emergencies and Errors, as these are the only ones we are interested
-            # in showing details for.
             query = '''
             WITH alarm_data AS (
                 SELECT
-                    to_timestamp(a.date / 1000.0) AS ts,
+                    a.date AS date_ms,
+                    -- UTC wall time: alerts_detail.day is derived from dt and must be the UTC day
+                    to_timestamp(a.date / 1000.0) AT TIME ZONE 'UTC' AS ts,
                     elem AS raw_elem_jsonb,
                     NULLIF(TRIM(elem ->> 0), '') AS alarm_code,
                     NULLIF(TRIM(elem ->> 1), '') AS alarm_description
                 FROM variable_log_string a
-                JOIN variable b ON a.id_var = b.id
                 CROSS JOIN LATERAL jsonb_array_elements(a.value::jsonb) AS elem
-                WHERE b.id = 447
+                WHERE a.id_var = :alarm_var_id
+                  AND a.date >= :start_ms
+                  AND a.date < :end_ms
                   AND a.value IS NOT NULL
                   AND a.value <> '[]'
                   AND LENGTH(a.value) > 2
                   AND a.value ~ '^\\[.*\\]$'
-                  AND to_timestamp(a.date / 1000.0)::date = CAST(:target_date AS date)
-            ),
-            categorized AS (
-                SELECT
-                    ts,
-                    alarm_code,
-                    alarm_description,
-                    raw_elem_jsonb,
-                    CASE
-                        WHEN alarm_description ILIKE '%emerg%' THEN 'Emergency'
-                        WHEN alarm_description ILIKE '%error%'
-                          OR alarm_description ILIKE '%err%'
-                          OR alarm_description ILIKE '%fallo%'
-                          OR alarm_description ILIKE '%fault%' THEN 'Error'
-                        ELSE NULL
-                    END AS alert_type
-                FROM alarm_data
             )
             SELECT
+                date_ms,
                 ts,
-                alert_type,
                 alarm_code,
                 alarm_description,
                 raw_elem_jsonb::text AS raw_elem_json
-            FROM categorized
-            WHERE alert_type IS NOT NULL
+            FROM alarm_data
             ORDER BY ts DESC;
             '''
 
-            result = conn.execute(text(query), {'target_date': target_date})
+            start_ms, end_ms = day_bounds_ms(start_date, end_date)
+            result = conn.execute(text(query), {'start_ms': start_ms, 'end_ms': end_ms, 'alarm_var_id': ALARM_VAR_ID})
             rows = result.fetchall()
             
             return [
                 {
+                    'day': ms_to_day(row.date_ms),
                     'dt': row.ts,
-                    'alert_type': ALERT_TYPE_MAP.get(row.alert_type),
                     'alarm_code': row.alarm_code,
                     'alarm_description': row.alarm_description,
-                    'raw_elem_json': json.loads(row.raw_elem_json) if row.raw_elem_json else None
+                    'raw_elem_json': row.raw_elem_json
                 } 
                 for row in rows
-                if row.alert_type in ALERT_TYPE_MAP
             ]
             
     except Exception as e:
-        logger.error(f"Failed to extract details: {str(e)}")
+        logger.error(f"Failed to extract alerts: {str(e)}")
         raise
 
 
+def _elem_text(elem, index):
+    # elem ->> index, trimmed, empty as None
+    if not isinstance(elem, list) or len(elem) <= index or elem[index] is None:
+        return None
+    value = elem[index] if isinstance(elem[index], str) else json.dumps(elem[index], ensure_ascii=False)
+    return value.strip() or None
+
+
+def expand_alerts(rows):
+    '''
+    Same result as the query of extract_alerts(), from cached (id_var, date_ms, value) rows.
+    json.dumps writes the elements the way PostgreSQL prints jsonb (", " and ": " separators).
+    '''
+    alerts = []
+    for _, date_ms, value in rows:
+        if not value or len(value) <= 2 or not (value.startswith('[') and value.endswith(']')):
+            continue
+        # Naive UTC, like `to_timestamp(...) AT TIME ZONE 'UTC'` in the query
+        ts = datetime.fromtimestamp(date_ms / 1000, tz=timezone.utc).replace(tzinfo=None)
+        for elem in json.loads(value):
+            alerts.append({
+                'day': ms_to_day(date_ms),
+                'dt': ts,
+                'alarm_code': _elem_text(elem, 0),
+                'alarm_description': _elem_text(elem, 1),
+                'raw_elem_json': json.dumps(elem, ensure_ascii=False)
+            })
+    alerts.sort(key=lambda alert: alert['dt'], reverse=True)
+    return alerts
+
+
+# TRANSFORM FUNCTION
+def split_alerts(alerts, target_date, classifier):
+    '''
+    Classify the alarm elements of one date and derive both outputs from them.
+    Params:
+        alerts:      alarm elements of target_date, from extract_alerts()
+        target_date: the day, as date or 'YYYY-MM-DD'
+    Returns (daily_count, details):
+        daily_count: list of dicts with day, alert_type and amount (all types)
+        details:     list of dicts for emergencies and errors only, with the parsed raw element
+    '''
+    for alert in alerts:
+        alert['alert_type'] = classifier.classify(alert['alarm_code'], alert['alarm_description'])
+
+    counts = Counter(alert['alert_type'] for alert in alerts)
+    daily_count = [
+        {'day': target_date, 'alert_type': alert_type, 'amount': amount}
+        for alert_type, amount in sorted(counts.items())
+    ]
+
+    # Only Emergencies and Errors are shown with details
+    details = [
+        {
+            'dt': alert['dt'],
+            'alert_type': alert['alert_type'],
+            'alarm_code': alert['alarm_code'],
+            'alarm_description': alert['alarm_description'],
+            'raw_elem_json': json.loads(alert['raw_elem_json']) if alert['raw_elem_json'] else None
+        }
+        for alert in alerts
+        if alert['alert_type'] in DETAIL_ALERT_TYPES
+    ]
+
+    return daily_count, details
+
+
 # LOAD FUNCTION FOR DAILY COUNT
-def load_daily_count(data):
-    '''Store daily count data in destination DB'''
-    if not data:
-        return 0
-        
-    session = Session(agg_engine)
+def load_daily_count(data, days):
+    '''
+    Store daily count data in destination DB.
+    Replaces every count of the given days like load_details(), so types that no longer
+    occur (rerun, new rules_version) do not keep their old counts.
+    '''
     try:
-        for record in data:
-            alert_count = AlertsDailyCount(
-                day=record['day'],
-                alert_type=record['alert_type'],
-                amount=record['amount']
-            )
-            session.merge(alert_count)  # Use merge for upsert behavior
-
-        session.commit()
-        return len(data)
+        return replace_days(AlertsDailyCount, data, day_column='day', days=days,
+                            columns=['day', 'alert_type', 'amount'])
             
     except Exception as e:
-        session.rollback()
         logger.error(f"Load of daily count failed: {str(e)}")
         raise
-        
-    finally:
-        session.close()
 
 
 # LOAD FUNCTION FOR ALERT DETAILS
-def load_details(data):
-    '''Store detail data in destination DB'''
-    if not data:
-        return 0
-        
-    session = Session(agg_engine)
+def load_details(data, days):
+    '''
+    Store detail data in destination DB.
+    Replaces every detail row of the given days, so reruns do not duplicate alerts.
+    '''
     try:
-        for record in data:
-            alert_detail = AlertsDetail(
-                dt=record['dt'],
-                alert_type=record['alert_type'],
-                alarm_code=record['alarm_code'],
-                alarm_description=record['alarm_description'],
-                raw_elem_json=record['raw_elem_json']
-            )
-            session.add(alert_detail)
-
-        session.commit()
-        return len(data)
+        return replace_days(
+            AlertsDetail, data, day_column='day', days=days,
+            columns=['dt', 'alert_type', 'alarm_code', 'alarm_description', 'raw_elem_json']
+        )
             
     except Exception as e:
-        session.rollback()
         logger.error(f"Load of details failed: {str(e)}")
         raise
-        
-    finally:
-        session.close()
 
 
 # ORCHESTRATION
-def run_etl(start_date=None, end_date=None):
-    '''Main function which combines all steps'''
+def run_etl(start_date=None, end_date=None, resume=False, window_days=ALERT_WINDOW_DAYS, pipeline=False):
+    '''
+    Main function which combines all steps.
+    With pipeline=True the next window is extracted while the current one is loaded.
+    '''
 
     # For full backfill, get min/max dates from source data
     if start_date is None and end_date is None:
@@ -288,41 +269,61 @@ def run_etl(start_date=None, end_date=None):
     
     logger.info(f"Started ETL script for {date_desc}")
     
-    # Process each date in the range
-    current_date = datetime.strptime(start_date, '%Y-%m-%d')
-    end_dt = datetime.strptime(end_date, '%Y-%m-%d')
-    
     total_daily_count = 0
     total_details = 0
     failed_dates = []
+
+    # Compiled once, already known alarm descriptions are not classified again
+    classifier = AlertClassifier()
+    classifier.load_lookup()
     
-    while current_date <= end_dt:
-        date_str = current_date.strftime('%Y-%m-%d')
+    # Process the range in multi-day windows, one production query each
+    # Days without alarm snapshots have no alerts
+    day_rows = etl_source_coverage.day_rows(start_date, end_date, [ALARM_VAR_ID])
+    windows = etl_watermark.pending_windows(ETL_NAME, start_date, end_date, window_days, resume, day_rows)
+    prefetched = prefetch_windows(
+        windows, extract_alerts,
+        depth=PIPELINE_DEPTH if pipeline else 0,
+        fingerprint=lambda first_day, last_day: etl_watermark.source_fingerprints(first_day, last_day, [ALARM_VAR_ID], cache=True)
+    )
+
+    for window in prefetched:
+        first_day, last_day = window.first_day, window.last_day
+        days = days_in_range(first_day, last_day)
         
         try:
-            # Extract and load daily count
-            daily_count_data = extract_daily_count(date_str)
-            if daily_count_data:
-                loaded = load_daily_count(daily_count_data)
-                total_daily_count += loaded
-            
-            # Extract and load details
-            details_data = extract_details(date_str)
-            if details_data:
-                loaded = load_details(details_data)
-                total_details += loaded
-                
+            with etl_watermark.track(ETL_NAME, first_day, last_day, id_vars=[ALARM_VAR_ID],
+                                     fingerprints=window.fingerprints) as partition:
+                # One extraction feeds both tables, split into days client side
+                alerts_by_day = defaultdict(list)
+                for alert in window.result():
+                    alerts_by_day[alert['day']].append(alert)
+
+                daily_count_data = []
+                details_data = []
+                for day in days:
+                    day_counts, day_details = split_alerts(alerts_by_day[day], day, classifier)
+                    daily_count_data += day_counts
+                    details_data += day_details
+
+                # Days without alerts still clear earlier counts and detail rows
+                total_daily_count += load_daily_count(daily_count_data, days)
+                total_details += load_details(details_data, days)
+                classifier.save_new()
+                partition.add_rows(daily_count_data, 'day')
+                logger.info(f"Processed {first_day} to {last_day}: {sum(len(a) for a in alerts_by_day.values())} alarm elements")
+
         except Exception as e:
-            logger.warning(f"Failed to process {date_str}: {str(e)}")
-            failed_dates.append(date_str)
-        
-        current_date += timedelta(days=1)
+            logger.warning(f"Failed to process {first_day} to {last_day}: {str(e)}")
+            failed_dates += [str(day) for day in days]
     
     logger.info(f"Successfully loaded {total_daily_count} daily count records")
     logger.info(f"Successfully loaded {total_details} detail records")
     
     if failed_dates:
         logger.warning(f"Failed to process {len(failed_dates)} dates: {failed_dates[:10]}{'...' if len(failed_dates) > 10 else ''}")
+        # The other windows are loaded, the caller (orchestrator, backfill) still sees the failure
+        raise RuntimeError(f"{ETL_NAME} failed for {len(failed_dates)} dates")
 
 
 # When run directly from CLI
@@ -330,15 +331,18 @@ if __name__ == "__main__":
 
     # Logging - Tracks what happens at every step
     logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger(__name__)
-
-    if len(sys.argv) == 2:
-        start_date = sys.argv[1]
-        run_etl(start_date)
-    elif len(sys.argv) == 3:
-        start_date = sys.argv[1]
-        end_date = sys.argv[2]
-        run_etl(start_date, end_date)
+
+    resume = '--resume' in sys.argv
+    pipeline = '--pipeline' in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if len(args) == 1:
+        start_date = args[0]
+        run_etl(start_date, resume=resume, pipeline=pipeline)
+    elif len(args) == 2:
+        start_date = args[0]
+        end_date = args[1]
+        run_etl(start_date, end_date, resume=resume, pipeline=pipeline)
     else:
         # Full backfill - no dates provided
-        run_etl()
+        run_etl(resume=resume, pipeline=pipeline)
@@ -4,30 +4,90 @@ Calculates estimated energy usage based on motor utilization percentages and nom
 
 The calculation: energy_kwh = (utilization% / 100) * nominal_kw * hours
 
+Every reading is held until the motor's next reading. The range is processed in windows of
+ENERGY_WINDOW_DAYS days, each integrated in a single scan: the last reading before a window is
+carried in from its start, and segments are split at hour boundaries, so energy crossing midnight
+(or a window edge) is attributed to the right hour and daily totals add up.
+
+The motors and their nominal power come from the energy_motor_config table of the aggregation DB.
+Each run fills both energy_consumption_hourly (total) and energy_consumption_motor_hourly (per motor).
+
 Usage:
     python -m backend.scripts.etl_agg_energy_daily                       # Full backfill
     python -m backend.scripts.etl_agg_energy_daily 2022-02-23            # Single day
     python -m backend.scripts.etl_agg_energy_daily 2022-02-01 2022-02-28 # Date range
+    python -m backend.scripts.etl_agg_energy_daily 2022-02-01 2022-02-28 --resume
+    python -m backend.scripts.etl_agg_energy_daily 2022-02-01 2022-02-28 --pipeline
+    python -m backend.scripts.etl_agg_energy_daily 2022-02-01 2022-02-28 --fan-out
 
 Args:
     start_date: Start date (optional). If missing, processes all available data.
     end_date:   End date (optional). If missing, processes single day (start_date).
+    --resume:   Skip the days already processed according to etl_watermark.
+    --pipeline: Extract the next window while the current one is loaded (etl_common.prefetch_windows).
+    --fan-out:  One concurrent query per motor instead of one query for all motors (etl_common.fan_out).
 '''
 
 import logging
+import math
 import sys
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
-from sqlalchemy.orm import Session
+from collections import defaultdict
 from sqlalchemy import text
 from backend.database import prod_engine, agg_engine
-from backend.models import EnergyConsumptionHourly
+from backend.models import EnergyConsumptionHourly, EnergyConsumptionMotorHourly
+from backend.scripts.bulk_loader import upsert
+from backend.scripts.etl_common import PIPELINE_DEPTH, catalog, fan_out, parse_date, day_bounds_ms, ms_to_day, prefetch_windows
+from backend.scripts import etl_source_coverage, etl_watermark
+from backend.scripts.shared_scan import ScanConsumer
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+ETL_NAME = 'etl_agg_energy_daily'
+
+# Days integrated per production query
+ENERGY_WINDOW_DAYS = 31
+
+
+def get_motor_config():
+    '''
+    Enabled motors from the motor catalog in the aggregation DB.
+    
+    Returns:
+        List of dicts with motor (production variable name) and nominal_kw.
+    '''
+    with agg_engine.connect() as conn:
+        rows = conn.execute(text('''
+            SELECT motor, nominal_kw
+            FROM energy_motor_config
+            WHERE enabled
+            ORDER BY motor
+        ''')).fetchall()
+    return [{'motor': row.motor, 'nominal_kw': float(row.nominal_kw)} for row in rows]
+
+
+def motor_params(motors):
+    '''
+    Bind parameters describing the motor catalog for the production queries.
+    Motor names are resolved to variable ids in memory, unknown motors are left out.
+    '''
+    ids = catalog.ids_of(m['motor'] for m in motors)
+    known = [m for m in motors if m['motor'] in ids]
+    return {
+        'motor_ids': [ids[m['motor']] for m in known],
+        'motors': [m['motor'] for m in known],
+        'nominal_kws': [m['nominal_kw'] for m in known]
+    }
+
+
+def get_motor_ids(motors):
+    '''Production variable id of every motor, as a dict id -> motor'''
+    return {id_var: motor for motor, id_var in catalog.ids_of(m['motor'] for m in motors).items()}
+
 
-def get_date_range():
+def get_date_range(motors):
     '''
     Query the source DB for the min and max dates when no dates are provided.
     Used for full backfill.
@@ -36,35 +96,39 @@ def get_date_range():
         with prod_engine.connect() as conn:
             query = '''
             SELECT 
-                MIN(to_timestamp(date / 1000))::date AS min_date,
-                MAX(to_timestamp(date / 1000))::date AS max_date
+                MIN(date) AS min_ms,
+                MAX(date) AS max_ms
             FROM variable_log_float
-            WHERE id_var IN (
-                SELECT id FROM variable 
-                WHERE name IN ('AXIS_X_MOTOR_UTILIZACION', 'AXIS_Y_MOTOR_UTILIZATION', 
-                               'AXIS_Z_MOTOR_UTILIZACION', 'SPINDLE_LOAD_1')
-            )
+            WHERE id_var = ANY(:motor_ids)
             '''
-            result = conn.execute(text(query))
+            result = conn.execute(text(query), motor_params(motors))
             row = result.fetchone()
-            if row and row.min_date and row.max_date:
-                return str(row.min_date), str(row.max_date)
+            if row and row.min_ms is not None and row.max_ms is not None:
+                return str(ms_to_day(row.min_ms)), str(ms_to_day(row.max_ms))
             return None, None
     except Exception as e:
         logger.error(f"Failed to get date range: {str(e)}")
         raise
 
 
-def extract_data(target_date):
+def extract_data(motors, start_date, end_date=None, fan_out_motors=False):
     '''
-    Extract hourly energy consumption for a single day.
+    Extract hourly energy consumption per motor for a range of days in a single scan.
     
     Params:
-        target_date: Date string, e.g. "2022-02-23"
+        motors:         Motor catalog from get_motor_config()
+        start_date:     First day, e.g. "2022-02-01"
+        end_date:       Last day (inclusive), defaults to start_date
+        fan_out_motors: One query per motor, run concurrently on separate connections.
+                        The motors are independent, the merged result is the same.
     
     Returns:
-        List of dicts with hour_ts and energy_kwh.
+        List of dicts with hour_ts, motor and energy_kwh (unrounded).
     '''
+    if fan_out_motors and len(motors) > 1:
+        per_motor = fan_out(extract_data, [([motor], start_date, end_date) for motor in motors])
+        return sorted((row for rows in per_motor for row in rows), key=lambda row: (row['hour_ts'], row['motor']))
+
     try:
         with prod_engine.connect() as conn:
             query = '''
@@ -77,18 +141,34 @@ def extract_data(target_date):
             ),
 
             motor_cfg AS (
+                SELECT id_var, motor, nominal_kw
+                FROM unnest(
+                    CAST(:motor_ids AS int[]),
+                    CAST(:motors AS text[]),
+                    CAST(:nominal_kws AS float8[])
+                ) AS cfg(id_var, motor, nominal_kw)
+            ),
+
+            -- Last valid reading of each motor before the window, carried forward from its start
+            carry_in AS (
                 SELECT
-                    v.id AS id_var,
-                    cfg.motor,
-                    cfg.nominal_kw
-                FROM (
-                    VALUES
-                        ('AXIS_X_MOTOR_UTILIZACION', 15.1::float8),
-                        ('AXIS_Y_MOTOR_UTILIZATION', 15.1::float8),
-                        ('AXIS_Z_MOTOR_UTILIZACION', 15.71::float8),
-                        ('SPINDLE_LOAD_1',           37.0::float8)
-                ) AS cfg(motor, nominal_kw)
-                JOIN variable v ON v.name = cfg.motor
+                    mc.motor,
+                    p.start_ts      AS ts,
+                    prev.util_pct,
+                    mc.nominal_kw
+                FROM motor_cfg mc
+                CROSS JOIN params p
+                CROSS JOIN LATERAL (
+                    SELECT f.value::float8 AS util_pct
+                    FROM variable_log_float f
+                    WHERE f.id_var = mc.id_var
+                        AND f.date < p.start_ms
+                        AND f.value IS NOT NULL
+                        AND f.value = f.value
+                        AND f.value NOT IN ('Infinity'::real, '-Infinity'::real)
+                    ORDER BY f.date DESC
+                    LIMIT 1
+                ) prev
             ),
 
             raw AS (
@@ -105,6 +185,11 @@ def extract_data(target_date):
                     AND f.value IS NOT NULL
                     AND f.value = f.value
                     AND f.value NOT IN ('Infinity'::real, '-Infinity'::real)
+
+                UNION ALL
+
+                SELECT motor, ts, util_pct, nominal_kw
+                FROM carry_in
             ),
 
             seg AS (
@@ -125,39 +210,46 @@ def extract_data(target_date):
                         WHEN s.ts_next IS NULL OR s.ts_next > p.end_ts THEN p.end_ts
                         ELSE s.ts_next
                     END AS ts_next,
-                    s.util_pct,
-                    s.nominal_kw
+                    s.util_pct / 100.0 * s.nominal_kw AS power_kw
                 FROM seg s
                 CROSS JOIN params p
             ),
 
+            -- Split every segment at hour boundaries, so each hour gets only its own share
             segments_energy AS (
                 SELECT
-                    motor,
-                    ts,
-                    ts_next,
-                    (util_pct / 100.0 * nominal_kw)
-                        * EXTRACT(EPOCH FROM (ts_next - ts)) / 3600.0 AS energy_kwh
-                FROM seg_clamped
-                WHERE ts_next > ts
+                    s.motor,
+                    h.hour_ts,
+                    s.power_kw
+                        * EXTRACT(EPOCH FROM (LEAST(s.ts_next, h.hour_ts + interval '1 hour')
+                                              - GREATEST(s.ts, h.hour_ts))) / 3600.0 AS energy_kwh
+                FROM seg_clamped s
+                CROSS JOIN LATERAL generate_series(
+                    date_trunc('hour', s.ts), s.ts_next, interval '1 hour'
+                ) AS h(hour_ts)
+                WHERE s.ts_next > s.ts
+                    AND h.hour_ts < s.ts_next
             )
 
             SELECT
-                date_trunc('hour', ts)             AS hour_ts,
-                ROUND(SUM(energy_kwh)::numeric, 3) AS energy_kwh
+                hour_ts,
+                motor,
+                SUM(energy_kwh) AS energy_kwh
             FROM segments_energy
-            GROUP BY 1
-            ORDER BY 1;
+            GROUP BY 1, 2
+            ORDER BY 1, 2;
             '''
             
-            # Build timestamp strings for the day
-            start_ts = f"{target_date} 00:00:00+00"
-            end_ts_date = datetime.strptime(target_date, "%Y-%m-%d") + timedelta(days=1)
-            end_ts = f"{end_ts_date.strftime('%Y-%m-%d')} 00:00:00+00"
+            # Window bounds in UTC: [start_date 00:00, end_date + 1 day 00:00)
+            first_day = parse_date(start_date)
+            last_day = parse_date(end_date or start_date)
+            start_ts = f"{first_day} 00:00:00+00"
+            end_ts = f"{last_day + timedelta(days=1)} 00:00:00+00"
             
             result = conn.execute(text(query), {
                 'start_ts': start_ts,
-                'end_ts': end_ts
+                'end_ts': end_ts,
+                **motor_params(motors)
             })
             rows = result.fetchall()
             
@@ -167,56 +259,152 @@ def extract_data(target_date):
             return [
                 {
                     'hour_ts': row.hour_ts,
+                    'motor': row.motor,
                     'energy_kwh': float(row.energy_kwh)
                 }
                 for row in rows
             ]
             
     except Exception as e:
-        logger.error(f"Extraction failed for {target_date}: {str(e)}")
+        logger.error(f"Extraction failed for {start_date} to {end_date or start_date}: {str(e)}")
         raise
 
 
-def load_data(data):
+def integrate_energy(readings, nominal_kws, start_ms, end_ms):
+    '''
+    Python version of the integration in extract_data(), for readings from a shared scan.
+    Every reading is held until the next reading of the motor (or end_ms) and split at hour boundaries.
+
+    Params:
+        readings:    Dict motor -> list of (date_ms, utilization %) ordered by date_ms,
+                     starting with the carried-in reading dated at start_ms
+        nominal_kws: Dict motor -> nominal power
+        start_ms:    Window start (epoch ms)
+        end_ms:      Window end (epoch ms)
+
+    Returns:
+        List of dicts with hour_ts, motor and energy_kwh (unrounded), like extract_data().
+    '''
+    energy = defaultdict(float)
+    for motor, points in readings.items():
+        power_kw = None
+        t = None
+        for date_ms, util_pct in points + [(end_ms, None)]:
+            until = min(max(date_ms, start_ms), end_ms)
+            # Energy of the previous reading, from t up to this one, hour by hour
+            while power_kw is not None and t < until:
+                hour_ms = t // 3600000 * 3600000
+                piece_end = min(until, hour_ms + 3600000)
+                energy[(hour_ms, motor)] += power_kw * (piece_end - t) / 3600000.0
+                t = piece_end
+            if util_pct is not None:
+                power_kw = util_pct / 100.0 * nominal_kws[motor]
+                t = until
+
+    return [
+        {
+            'hour_ts': datetime.fromtimestamp(hour_ms / 1000, tz=timezone.utc),
+            'motor': motor,
+            'energy_kwh': energy_kwh
+        }
+        for (hour_ms, motor), energy_kwh in sorted(energy.items())
+    ]
+
+
+def transform_data(motor_data):
+    '''
+    Round the per-motor records and derive the hourly totals from them.
+    
+    Params:
+        motor_data: List of dicts from extract_data()
+    
+    Returns:
+        (totals, per_motor): lists of dicts for energy_consumption_hourly
+        and energy_consumption_motor_hourly, rounded to 3 decimals.
+    '''
+    hourly_totals = defaultdict(float)
+    per_motor = []
+
+    for record in motor_data:
+        hourly_totals[record['hour_ts']] += record['energy_kwh']
+        per_motor.append({**record, 'energy_kwh': round(record['energy_kwh'], 3)})
+
+    totals = [
+        {'hour_ts': hour_ts, 'energy_kwh': round(energy_kwh, 3)}
+        for hour_ts, energy_kwh in sorted(hourly_totals.items())
+    ]
+    return totals, per_motor
+
+
+def load_data(data, motor_data=None):
     '''
     Load energy records into the aggregated database.
-    Uses merge to upsert (update if exists, insert if not).
+    Uses a batched upsert (update if exists, insert if not).
     
     Params:
-        data: List of dicts from extract_data()
+        data:       Hourly totals from transform_data()
+        motor_data: Hourly per-motor records from transform_data() (optional)
     '''
     if not data:
         logger.warning("No data to load")
-        return
+        return 0
         
-    session = Session(agg_engine)
     try:
-        for record in data:
-            energy_record = EnergyConsumptionHourly(
-                hour_ts=record['hour_ts'],
-                energy_kwh=record['energy_kwh']
-            )
-            session.merge(energy_record)
-        
-        session.commit()
-        logger.info(f"Loaded {len(data)} hourly records")
+        loaded = upsert(EnergyConsumptionHourly, data, conflict_columns=['hour_ts'])
+        if motor_data:
+            upsert(EnergyConsumptionMotorHourly, motor_data, conflict_columns=['hour_ts', 'motor'])
+        logger.info(f"Loaded {loaded} hourly records")
+        return loaded
         
     except Exception as e:
-        session.rollback()
         logger.error(f"Load failed: {str(e)}")
         raise
-    finally:
-        session.close()
 
 
-def run_etl(start_date=None, end_date=None):
+class EnergyConsumer(ScanConsumer):
+    '''Hourly energy per motor from the rows of a shared scan (see shared_scan.py)'''
+
+    etl_name = ETL_NAME
+    carry_in = True
+
+    def __init__(self):
+        motors = get_motor_config()
+        self.nominal_kws = {m['motor']: m['nominal_kw'] for m in motors}
+        self.motor_by_id = get_motor_ids(motors)
+        super().__init__(self.motor_by_id)
+        self.readings = defaultdict(list)
+
+    def consume(self, rows):
+        for id_var, date_ms, value in rows:
+            if value is not None and math.isfinite(value):
+                self.readings[self.motor_by_id[id_var]].append((date_ms, value))
+
+    def finish(self, first_day, last_day):
+        start_ms, end_ms = day_bounds_ms(first_day, last_day)
+        motor_data = integrate_energy(self.readings, self.nominal_kws, start_ms, end_ms)
+        self.readings = defaultdict(list)
+
+        data, per_motor = transform_data(motor_data)
+        load_data(data, per_motor)
+        return data, 'hour_ts'
+
+
+def run_etl(start_date=None, end_date=None, resume=False, window_days=ENERGY_WINDOW_DAYS, pipeline=False,
+            fan_out_motors=False):
     '''
     Main orchestration function.
+    With pipeline=True the next window is extracted while the current one is loaded.
+    With fan_out_motors=True every motor is extracted by its own concurrent query.
     '''
+    motors = get_motor_config()
+    if not motors:
+        logger.error("No enabled motors in energy_motor_config")
+        return
+
     # Determine date range
     if start_date is None:
         logger.info("No dates provided, fetching full date range...")
-        start_date, end_date = get_date_range()
+        start_date, end_date = get_date_range(motors)
         if not start_date:
             logger.error("Could not determine date range from database")
             return
@@ -227,32 +415,57 @@ def run_etl(start_date=None, end_date=None):
     else:
         logger.info(f"Processing range: {start_date} to {end_date}")
     
-    # Process each day
-    current = datetime.strptime(start_date, "%Y-%m-%d")
-    end = datetime.strptime(end_date, "%Y-%m-%d")
+    # Source variables of the watermark fingerprints
+    motor_ids = motor_params(motors)['motor_ids']
+
+    # Process the range in multi-day windows, one scan each
     total_records = 0
+    failed_windows = []
     
-    while current <= end:
-        date_str = current.strftime("%Y-%m-%d")
+    # Days without motor readings are not skipped, the last reading is held through them.
+    # The readings per day only close windows early on busy days
+    day_rows = etl_source_coverage.day_rows(start_date, end_date, motor_ids)
+    windows = etl_watermark.pending_windows(ETL_NAME, start_date, end_date, window_days, resume, day_rows,
+                                            skip_empty=False)
+    prefetched = prefetch_windows(
+        windows,
+        lambda first_day, last_day: extract_data(motors, first_day, last_day, fan_out_motors),
+        depth=PIPELINE_DEPTH if pipeline else 0,
+        fingerprint=lambda first_day, last_day: etl_watermark.source_fingerprints(first_day, last_day, motor_ids)
+    )
+
+    for window in prefetched:
+        first_day, last_day = window.first_day, window.last_day
         try:
-            data = extract_data(date_str)
-            if data:
-                load_data(data)
-                total_records += len(data)
-            else:
-                logger.info(f"No data for {date_str}")
+            with etl_watermark.track(ETL_NAME, first_day, last_day, id_vars=motor_ids,
+                                     fingerprints=window.fingerprints) as partition:
+                motor_data = window.result()
+                if motor_data:
+                    data, per_motor = transform_data(motor_data)
+                    total_records += load_data(data, per_motor)
+                    partition.add_rows(data, 'hour_ts')
+                else:
+                    logger.info(f"No data for {first_day} to {last_day}")
         except Exception as e:
-            logger.error(f"Failed for {date_str}: {str(e)}")
-        
-        current += timedelta(days=1)
+            logger.error(f"Failed for {first_day} to {last_day}: {str(e)}")
+            failed_windows.append(f"{first_day} to {last_day}")
     
     logger.info(f"ETL complete. Total records loaded: {total_records}")
 
+    # The other windows are loaded, the caller (orchestrator, backfill) still sees the failure
+    if failed_windows:
+        raise RuntimeError(f"{ETL_NAME} failed for {len(failed_windows)} windows: {', '.join(failed_windows)}")
+
 
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        run_etl(sys.argv[1])
-    elif len(sys.argv) == 3:
-        run_etl(sys.argv[1], sys.argv[2])
+    resume = '--resume' in sys.argv
+    pipeline = '--pipeline' in sys.argv
+    fan_out_motors = '--fan-out' in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if len(args) == 1:
+        run_etl(args[0], resume=resume, pipeline=pipeline, fan_out_motors=fan_out_motors)
+    elif len(args) == 2:
+        run_etl(args[0], args[1], resume=resume, pipeline=pipeline, fan_out_motors=fan_out_motors)
     else:
-        run_etl()
+        run_etl(resume=resume, pipeline=pipeline, fan_out_motors=fan_out_motors)
@@ -0,0 +1,334 @@
+'''
+ETL (Extract, Transform and Load) script for energy per program.
+Attributes runtime and estimated motor energy to the active program (variable 581) for every day.
+
+Program changes and motor utilization readings are read together, ordered by time, and swept in a
+single pass: between two consecutive events the active program and the power of every motor are
+constant, so the interval's runtime and energy go to that program. Intervals are cut at midnight (UTC).
+Program and motor values before a window are carried in from its start, like in the energy ETL.
+
+The calculation: energy_kwh = sum over motors of (utilization% / 100) * nominal_kw * hours
+
+Usage:
+    python -m backend.scripts.etl_agg_program_energy                       # Full backfill
+    python -m backend.scripts.etl_agg_program_energy 2022-02-23            # Single day
+    python -m backend.scripts.etl_agg_program_energy 2022-02-01 2022-02-28 # Date range
+    python -m backend.scripts.etl_agg_program_energy 2022-02-01 2022-02-28 --resume
+
+Args:
+    start_date: Start date (optional). If missing, processes all available data.
+    end_date:   End date (optional). If missing, processes single day (start_date).
+    --resume:   Skip the days already processed according to etl_watermark.
+'''
+
+import logging
+import math
+import sys
+from collections import defaultdict
+
+from sqlalchemy import text
+from backend.database import prod_engine
+from backend.models import ProgramEnergyDaily
+from backend.scripts.bulk_loader import replace_days
+from backend.scripts.etl_common import day_bounds_ms, date_to_ms, ms_to_day, days_in_range
+from backend.scripts import etl_source_coverage, etl_watermark
+from backend.scripts.etl_agg_energy_daily import get_motor_config, get_motor_ids, motor_params
+from backend.scripts.etl_agg_program_history import PROGRAM_VAR_ID
+from backend.scripts.shared_scan import ScanConsumer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ETL_NAME = 'etl_agg_program_energy'
+
+# Motor readings are swept client side, so windows are kept shorter than in the energy ETL
+PROGRAM_ENERGY_WINDOW_DAYS = 7
+
+MS_PER_DAY = 86400 * 1000
+
+
+def get_date_range():
+    '''
+    Query the source DB for the min and max dates when no dates are provided.
+    Used for full backfill.
+    '''
+    try:
+        with prod_engine.connect() as conn:
+            query = '''
+            SELECT
+                MIN(date) AS min_ms,
+                MAX(date) AS max_ms
+            FROM variable_log_float
+            WHERE id_var = :program_var_id
+            AND value >= 0 AND value < 1000
+            '''
+            row = conn.execute(text(query), {'program_var_id': PROGRAM_VAR_ID}).fetchone()
+            if row and row.min_ms is not None and row.max_ms is not None:
+                return str(ms_to_day(row.min_ms)), str(ms_to_day(row.max_ms))
+            return None, None
+    except Exception as e:
+        logger.error(f"Failed to get date range: {str(e)}")
+        raise
+
+
+def extract_data(motors, start_date, end_date=None):
+    '''
+    Extract the time-ordered program changes and motor readings of a range of days.
+
+    Params:
+        motors:     Motor catalog from get_motor_config()
+        start_date: First day, e.g. "2022-02-01"
+        end_date:   Last day (inclusive), defaults to start_date
+
+    Returns:
+        List of dicts with date_ms, motor (None for program changes), nominal_kw and value,
+        ordered by date_ms. Carried-in values are dated at the window start.
+    '''
+    try:
+        with prod_engine.connect() as conn:
+            query = '''
+            WITH sources AS (
+                SELECT CAST(:program_var_id AS int) AS id_var, NULL::text AS motor, NULL::float8 AS nominal_kw
+
+                UNION ALL
+
+                SELECT cfg.id_var, cfg.motor, cfg.nominal_kw
+                FROM unnest(
+                    CAST(:motor_ids AS int[]),
+                    CAST(:motors AS text[]),
+                    CAST(:nominal_kws AS float8[])
+                ) AS cfg(id_var, motor, nominal_kw)
+            ),
+
+            -- Last valid value of every source before the window
+            carry_in AS (
+                SELECT s.motor, s.nominal_kw, CAST(:start_ms AS bigint) AS date, prev.value
+                FROM sources s
+                CROSS JOIN LATERAL (
+                    SELECT f.value::float8 AS value
+                    FROM variable_log_float f
+                    WHERE f.id_var = s.id_var
+                        AND f.date < :start_ms
+                        AND f.value IS NOT NULL
+                        AND f.value = f.value
+                        AND f.value NOT IN ('Infinity'::real, '-Infinity'::real)
+                        AND (f.id_var <> :program_var_id OR (f.value >= 0 AND f.value < 1000))
+                    ORDER BY f.date DESC
+                    LIMIT 1
+                ) prev
+            )
+
+            SELECT s.motor, s.nominal_kw, f.date, f.value::float8 AS value
+            FROM variable_log_float f
+            JOIN sources s ON s.id_var = f.id_var
+            WHERE f.date >= :start_ms
+                AND f.date < :end_ms
+                AND f.value IS NOT NULL
+                AND f.value = f.value
+                AND f.value NOT IN ('Infinity'::real, '-Infinity'::real)
+                AND (f.id_var <> :program_var_id OR (f.value >= 0 AND f.value < 1000))
+
+            UNION ALL
+
+            SELECT motor, nominal_kw, date, value
+            FROM carry_in
+
+            ORDER BY date;
+            '''
+
+            start_ms, end_ms = day_bounds_ms(start_date, end_date)
+            rows = conn.execute(text(query), {
+                'start_ms': start_ms,
+                'end_ms': end_ms,
+                'program_var_id': PROGRAM_VAR_ID,
+                **motor_params(motors)
+            }).fetchall()
+
+            return [
+                {
+                    'date_ms': row.date,
+                    'motor': row.motor,
+                    'nominal_kw': row.nominal_kw,
+                    'value': row.value
+                }
+                for row in rows
+            ]
+
+    except Exception as e:
+        logger.error(f"Extraction failed for {start_date} to {end_date or start_date}: {str(e)}")
+        raise
+
+
+def transform_data(events, start_ms, end_ms):
+    '''
+    Sweep the time-ordered events and attribute runtime and energy to the active program.
+
+    Params:
+        events:   List of dicts from extract_data(), ordered by date_ms
+        start_ms: Window start (epoch ms), the sweep starts here
+        end_ms:   Window end (epoch ms), the last values are held until here
+
+    Returns:
+        List of dicts with dt, program, runtime_seconds and energy_kwh.
+    '''
+    totals = defaultdict(lambda: {'runtime_ms': 0, 'energy_kwh': 0.0})
+    program = None
+    power_kw = {}          # Current power of every motor
+    t = start_ms
+
+    def advance(until_ms):
+        # Attribute [t, until_ms) to the active program, cut at every midnight
+        nonlocal t
+        while t < until_ms:
+            next_midnight = (t // MS_PER_DAY + 1) * MS_PER_DAY
+            piece_end = min(until_ms, next_midnight)
+            if program is not None:
+                total = totals[(ms_to_day(t), program)]
+                total['runtime_ms'] += piece_end - t
+                total['energy_kwh'] += sum(power_kw.values()) * (piece_end - t) / 3600000.0
+            t = piece_end
+
+    for event in events:
+        advance(max(event['date_ms'], t))
+        if event['motor'] is None:
+            # Rounded like CAST(value AS int) in the program history, the values are never negative
+            program = math.floor(event['value'] + 0.5)
+        else:
+            power_kw[event['motor']] = event['value'] / 100.0 * event['nominal_kw']
+
+    advance(end_ms)
+
+    return [
+        {
+            'dt': day,
+            'program': program,
+            'runtime_seconds': int(round(total['runtime_ms'] / 1000)),
+            'energy_kwh': round(total['energy_kwh'], 3)
+        }
+        for (day, program), total in sorted(totals.items())
+    ]
+
+
+def load_data(data, days):
+    '''
+    Load program energy records into the aggregated database.
+    Replaces all rows of the given days, so re-running a range is idempotent.
+
+    Params:
+        data: List of dicts from transform_data()
+        days: Days covered by data
+    '''
+    try:
+        loaded = replace_days(ProgramEnergyDaily, data, day_column='dt', days=days,
+                              columns=['dt', 'program', 'runtime_seconds', 'energy_kwh'])
+        logger.info(f"Loaded {loaded} program-day records")
+        return loaded
+    except Exception as e:
+        logger.error(f"Load failed: {str(e)}")
+        raise
+
+
+class ProgramEnergyConsumer(ScanConsumer):
+    '''Runtime and energy per program from the rows of a shared scan (see shared_scan.py)'''
+
+    etl_name = ETL_NAME
+    carry_in = True
+    # Same program filter as extract_data(), also for the carried-in program
+    carry_in_ranges = {PROGRAM_VAR_ID: (0, 1000)}
+
+    def __init__(self):
+        motors = get_motor_config()
+        self.nominal_kws = {m['motor']: m['nominal_kw'] for m in motors}
+        self.motor_by_id = get_motor_ids(motors)
+        super().__init__([PROGRAM_VAR_ID, *self.motor_by_id])
+        self.events = []
+
+    def consume(self, rows):
+        for id_var, date_ms, value in rows:
+            if value is None or not math.isfinite(value):
+                continue
+            if id_var == PROGRAM_VAR_ID:
+                # Same program filter as extract_data(), the carried-in program is filtered by the scan
+                if 0 <= value < 1000:
+                    self.events.append({'date_ms': date_ms, 'motor': None, 'nominal_kw': None, 'value': value})
+            else:
+                motor = self.motor_by_id[id_var]
+                self.events.append({'date_ms': date_ms, 'motor': motor,
+                                    'nominal_kw': self.nominal_kws[motor], 'value': value})
+
+    def finish(self, first_day, last_day):
+        start_ms, end_ms = day_bounds_ms(first_day, last_day)
+        # Carried-in events come first, a stable sort keeps them before same-time readings
+        events = sorted(self.events, key=lambda event: event['date_ms'])
+        self.events = []
+
+        data = transform_data(events, start_ms, end_ms)
+        load_data(data, days_in_range(first_day, last_day))
+        return data, 'dt'
+
+
+def run_etl(start_date=None, end_date=None, resume=False, window_days=PROGRAM_ENERGY_WINDOW_DAYS):
+    '''
+    Main orchestration function.
+    '''
+    motors = get_motor_config()
+    if not motors:
+        logger.error("No enabled motors in energy_motor_config")
+        return
+
+    # Determine date range
+    if start_date is None:
+        logger.info("No dates provided, fetching full date range...")
+        start_date, end_date = get_date_range()
+        if not start_date:
+            logger.error("Could not determine date range from database")
+            return
+        logger.info(f"Full backfill from {start_date} to {end_date}")
+    elif end_date is None:
+        logger.info(f"Processing single day: {start_date}")
+        end_date = start_date
+    else:
+        logger.info(f"Processing range: {start_date} to {end_date}")
+
+    # Source variables of the watermark fingerprints
+    source_ids = [PROGRAM_VAR_ID] + motor_params(motors)['motor_ids']
+
+    total_records = 0
+    failed_windows = []
+
+    # Days without readings are not skipped, the program and motor values are held through them.
+    # The readings per day only close windows early on busy days
+    day_rows = etl_source_coverage.day_rows(start_date, end_date, source_ids)
+    for first_day, last_day in etl_watermark.pending_windows(ETL_NAME, start_date, end_date, window_days, resume,
+                                                             day_rows, skip_empty=False):
+        try:
+            with etl_watermark.track(ETL_NAME, first_day, last_day, id_vars=source_ids) as partition:
+                events = extract_data(motors, first_day, last_day)
+                if not events:
+                    logger.info(f"No data for {first_day} to {last_day}")
+                    continue
+
+                data = transform_data(events, date_to_ms(first_day), day_bounds_ms(first_day, last_day)[1])
+                total_records += load_data(data, days_in_range(first_day, last_day))
+                partition.add_rows(data, 'dt')
+        except Exception as e:
+            logger.error(f"Failed for {first_day} to {last_day}: {str(e)}")
+            failed_windows.append(f"{first_day} to {last_day}")
+
+    logger.info(f"ETL complete. Total records loaded: {total_records}")
+
+    # The other windows are loaded, the caller (orchestrator, backfill) still sees the failure
+    if failed_windows:
+        raise RuntimeError(f"{ETL_NAME} failed for {len(failed_windows)} windows: {', '.join(failed_windows)}")
+
+
+if __name__ == "__main__":
+    resume = '--resume' in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if len(args) == 1:
+        run_etl(args[0], resume=resume)
+    elif len(args) == 2:
+        run_etl(args[0], args[1], resume=resume)
+    else:
+        run_etl(resume=resume)
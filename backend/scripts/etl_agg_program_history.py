@@ -3,27 +3,53 @@ ETL (Extract, Transform and Load) script for machine program history data.
 Use the Arguments to filter on date. If one data from one date is desired, use only one argument.
 If data between an interval of two dates is desired, use two arguments, respectively start_date and end_date.
 
+The range is processed in chunks of PROGRAM_CHUNK_DAYS days. Each chunk reads only the program
+changes (variable 581) inside its epoch-ms bounds, and the program active at its start is carried
+over from the previous chunk. After every chunk the last known program and the time of its change are
+stored in program_history_checkpoint, so the next run (or --incremental) starts from there
+instead of searching the whole history of variable 581 for the previous state.
+
 Tip: When running the script, run it as a module, this way our imports are properly handled (sys.path):
     
     EXAMPLE BELOW:
     (venv) (base) atlesund@Atles-MacBook-Pro 2025G2 % python -m backend.scripts.etl_agg_program_history 2021-01-07
     INFO:__main__:Started ETL script for only 2021-01-07
-    INFO:__main__:Extracted raw data consisting of 15 records
+    INFO:__main__:Extracted 15 program changes for 2021-01-07 to 2021-01-07
     INFO:__main__:Successfully loaded data.
 
+    python -m backend.scripts.etl_agg_program_history --incremental
+
 Args:
     start_date : None by default. 
     end_date   : None by default
+    --incremental : Continue from the latest checkpoint up to the latest source data
+    --resume      : Skip the days already processed according to etl_watermark
 '''
 
 # IMPORTS
 import logging
+import math
 import sys
+from collections import defaultdict
+from datetime import datetime, timedelta
 
 from backend.database import prod_engine, agg_engine
-from backend.models import MachineProgramData
+from backend.models import MachineProgramData, ProgramHistoryCheckpoint
+from backend.scripts.bulk_loader import replace_days, upsert
+from backend.scripts.etl_common import day_bounds_ms, date_to_ms, ms_to_day, days_in_range
+from backend.scripts import etl_watermark
+from backend.scripts.shared_scan import ScanConsumer
 from sqlalchemy import text
-from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+ETL_NAME = 'etl_agg_program_history'
+
+# Production variable of the active program
+PROGRAM_VAR_ID = 581
+
+# Days per extraction query, the carried state links the chunks
+PROGRAM_CHUNK_DAYS = 31
 
 
 # Using a  helper function to get the full range in case of a full backfill
@@ -34,171 +60,231 @@ def get_date_range():
     '''
     try:
         with prod_engine.connect() as conn:
+            # MIN/MAX on the raw column can be answered from the (id_var, date) index
             query = '''
             SELECT 
-                MIN(to_timestamp(trunc(cast(date AS bigint)/1000)))::date AS min_date,
-                MAX(to_timestamp(trunc(cast(date AS bigint)/1000)))::date AS max_date
+                MIN(date) AS min_ms,
+                MAX(date) AS max_ms
             FROM variable_log_float
-            WHERE id_var = 581
+            WHERE id_var = :program_var_id
             AND value >= 0 AND value < 1000
             '''
-            result = conn.execute(text(query))
+            result = conn.execute(text(query), {'program_var_id': PROGRAM_VAR_ID})
             row = result.fetchone()
-            if row and row.min_date and row.max_date:
-                return str(row.min_date), str(row.max_date)
+            if row and row.min_ms is not None and row.max_ms is not None:
+                return str(ms_to_day(row.min_ms)), str(ms_to_day(row.max_ms))
             return None, None
     except Exception as e:
         logger.error(f"Failed to get date range: {str(e)}")
         raise
 
 
-# EXTRACT FUNCTION
-def extract_data(start_date=None, end_date=None):
+# CHECKPOINTS
+def get_checkpoint(day):
+    '''
+    Program active at 00:00 of the given day, from the checkpoint of the window ending there.
+    Returns a dict with program and change_ms, or None if no such checkpoint exists.
+    '''
+    with agg_engine.connect() as conn:
+        row = conn.execute(text('''
+            SELECT last_program, last_change_ms
+            FROM program_history_checkpoint
+            WHERE window_end = :day
+        '''), {'day': day}).fetchone()
+    if row is None or row.last_program is None:
+        return None
+    return {'program': row.last_program, 'change_ms': row.last_change_ms}
+
+
+def get_latest_checkpoint_day():
+    '''
+    Start of the most recent checkpointed window, or None.
+    Its last day may have been partial when it was processed, so incremental runs redo that window.
+    '''
+    with agg_engine.connect() as conn:
+        row = conn.execute(text('''
+            SELECT window_start
+            FROM program_history_checkpoint
+            ORDER BY window_end DESC
+            LIMIT 1
+        ''')).fetchone()
+    return row.window_start if row else None
+
+
+def save_checkpoint(window_start, window_end, state):
+    '''Persist the state at the end of a processed window (window_end is exclusive)'''
+    upsert(ProgramHistoryCheckpoint, [{
+        'window_end': window_end,
+        'window_start': window_start,
+        'last_program': state['program'] if state else None,
+        'last_change_ms': state['change_ms'] if state else None,
+        'updated_at': datetime.now()
+    }], conflict_columns=['window_end'])
+
+
+# EXTRACT FUNCTIONS
+def extract_previous_state(start_date):
     '''
-    Query source DB for program history data.
-    Returns list of dicts with dt, program, and duration_seconds.
+    Last program change before start_date, used when no checkpoint exists.
+    A single index range scan on (id_var, date), read backwards.
     '''
     try:
         with prod_engine.connect() as conn:
-            
-            query = '''
-            WITH RangoTiempo AS (
-                SELECT
-                    CAST(:start_date AS timestamp) AS inicio,
-                    CAST(:end_date AS timestamp) + interval '1 day' AS fin
-            ),
-
-            EstadoPrevio AS (
-                SELECT
-                    (SELECT inicio FROM RangoTiempo) AS dt,
-                    CAST(value AS integer) AS estado_numerico
+            row = conn.execute(text('''
+                SELECT date, CAST(value AS integer) AS program
                 FROM variable_log_float
-                WHERE id_var = 581
-                AND to_timestamp(trunc(cast(date AS bigint)/1000)) < (SELECT inicio FROM RangoTiempo)
+                WHERE id_var = :program_var_id
+                AND date < :start_ms
                 AND value >= 0 AND value < 1000
                 ORDER BY date DESC
                 LIMIT 1
-            ),
+            '''), {'start_ms': date_to_ms(start_date), 'program_var_id': PROGRAM_VAR_ID}).fetchone()
+            if row is None:
+                return None
+            return {'program': row.program, 'change_ms': row.date}
+    except Exception as e:
+        logger.error(f"Connection failed when extracting previous state: {str(e)}")
+        raise
 
-            LogsRango AS (
-                SELECT
-                    to_timestamp(trunc(cast(date AS bigint)/1000)) AS dt,
-                    CAST(value AS integer) AS estado_numerico
-                FROM variable_log_float
-                WHERE id_var = 581
-                AND to_timestamp(trunc(cast(date AS bigint)/1000)) BETWEEN (SELECT inicio FROM RangoTiempo) AND (SELECT fin FROM RangoTiempo)
-                AND value >= 0 AND value < 1000
-            ),
-
-            LogsCompletos AS (
-                SELECT dt, estado_numerico FROM EstadoPrevio
-                UNION ALL
-                SELECT dt, estado_numerico FROM LogsRango
-            ),
-
-            Intervalos AS (
-                SELECT
-                    dt AS hora_inicio,
-                    LEAD(dt) OVER (ORDER BY dt) AS hora_fin_raw,
-                    estado_numerico
-                FROM LogsCompletos
-            ),
-
-            IntervalosCerrados AS (
-                SELECT
-                    hora_inicio,
-                    COALESCE(hora_fin_raw, (SELECT fin FROM RangoTiempo)) AS hora_fin,
-                    estado_numerico
-                FROM Intervalos
-            ),
-
-            SerieDias AS (
-                SELECT generate_series(
-                    (SELECT date_trunc('day', inicio) FROM RangoTiempo),
-                    (SELECT date_trunc('day', fin) FROM RangoTiempo),
-                    '1 day'
-                ) AS dia_referencia
-            ),
-
-            CortePorDias AS (
-                SELECT
-                    d.dia_referencia,
-                    i.estado_numerico,
-                    GREATEST(i.hora_inicio, d.dia_referencia) AS inicio_real,
-                    LEAST(i.hora_fin, d.dia_referencia + interval '1 day') AS fin_real
-                FROM IntervalosCerrados i
-                JOIN SerieDias d ON
-                    i.hora_inicio < (d.dia_referencia + interval '1 day') AND
-                    i.hora_fin > d.dia_referencia
-            )
 
+def extract_data(start_date, end_date=None):
+    '''
+    Query source DB for the program changes between start_date and end_date (inclusive).
+    Returns list of dicts with change_ms and program, ordered by time.
+    '''
+    try:
+        with prod_engine.connect() as conn:
+            query = '''
             SELECT
-                date(dia_referencia) AS fecha,
-                estado_numerico,
-                ROUND(SUM(EXTRACT(EPOCH FROM (fin_real - inicio_real))), 2) AS duracion_segundos
-            FROM CortePorDias
-            WHERE fin_real > inicio_real
-              AND EXISTS (SELECT 1 FROM LogsRango)  -- Only return data if actual logs exist in range
-            GROUP BY 1, 2
-            ORDER BY fecha, duracion_segundos DESC;
+                date,
+                CAST(value AS integer) AS program
+            FROM variable_log_float
+            WHERE id_var = :program_var_id
+            AND date >= :start_ms
+            AND date < :end_ms
+            AND value >= 0 AND value < 1000
+            ORDER BY date;
             '''
 
-            params = {
-                'start_date': start_date,
-                'end_date': end_date if end_date else start_date
-            }
+            start_ms, end_ms = day_bounds_ms(start_date, end_date)
+            rows = conn.execute(text(query), {'start_ms': start_ms, 'end_ms': end_ms, 'program_var_id': PROGRAM_VAR_ID}).fetchall()
 
-            result = conn.execute(text(query), params)
-            rows = result.fetchall()
-            
-            if not rows:
-                logger.warning("No data found for the specified date range")
-                return []
-            
-            return [
-                {
-                    'dt': row.fecha,
-                    'program': row.estado_numerico,
-                    'duration_seconds': int(row.duracion_segundos)
-                } 
-                for row in rows
-            ]
+            return [{'change_ms': row.date, 'program': row.program} for row in rows]
             
     except Exception as e:
         logger.error(f"Connection failed when extracting data: {str(e)}")
         raise
 
 
+# TRANSFORM FUNCTION
+def transform_data(changes, state, start_ms, end_ms):
+    '''
+    Turn program changes into the duration of every program per day.
+
+    Params:
+        changes:  List of dicts from extract_data(), ordered by change_ms
+        state:    Program active at start_ms (dict with program, change_ms) or None
+        start_ms: Window start, epoch ms
+        end_ms:   Window end (exclusive), the last program is held until here
+
+    Returns:
+        (records, state): list of dicts with dt, program and duration_seconds,
+        and the state at the end of the window to carry into the next one.
+    '''
+    durations = defaultdict(int)
+
+    def add_interval(program, begin_ms, finish_ms):
+        # Whole seconds, cut at every midnight
+        begin, finish = begin_ms // 1000, finish_ms // 1000
+        while begin < finish:
+            next_midnight = (begin // 86400 + 1) * 86400
+            piece_end = min(finish, next_midnight)
+            durations[(ms_to_day(begin * 1000), program)] += piece_end - begin
+            begin = piece_end
+
+    current = state
+    since_ms = start_ms
+    for change in changes:
+        if current is not None:
+            add_interval(current['program'], since_ms, change['change_ms'])
+        current = change
+        since_ms = change['change_ms']
+    if current is not None:
+        add_interval(current['program'], since_ms, end_ms)
+
+    # Same order as before: per day, longest program first
+    records = [
+        {'dt': day, 'program': program, 'duration_seconds': seconds}
+        for (day, program), seconds in sorted(durations.items(), key=lambda item: (item[0][0], -item[1]))
+    ]
+    return records, current
+
+
 # LOAD FUNCTION
-def load_data(transformed_data):
-    '''Store in destination DB'''
-    session = Session(agg_engine)
+def load_data(transformed_data, days):
+    '''
+    Store in destination DB
+    Replaces all rows of the given days, so re-running a date is idempotent.
+    '''
     try:
-        for record in transformed_data:
-            program_data = MachineProgramData(
-                dt=record['dt'],
-                program=record['program'],
-                duration_seconds=record['duration_seconds']
-            )
-            session.add(program_data)
-
-        session.commit()
+        return replace_days(
+            MachineProgramData, transformed_data, day_column='dt', days=days,
+            columns=['dt', 'program', 'duration_seconds']
+        )
             
     except Exception as e:
-        session.rollback()
         logger.error(f"Load of data failed: {str(e)}")
         raise
-        
-    finally:
-        session.close()
+
+
+# SHARED SCAN
+class ProgramHistoryConsumer(ScanConsumer):
+    '''Program durations per day from the rows of a shared scan (see shared_scan.py)'''
+
+    etl_name = ETL_NAME
+
+    def __init__(self):
+        super().__init__([PROGRAM_VAR_ID])
+        self.changes = []
+        self.state = None
+        self.next_day = None
+
+    def consume(self, rows):
+        for _, date_ms, value in rows:
+            # Same filter and integer cast as extract_data(): CAST(value AS int) rounds halves
+            # away from zero, round() would round them to even
+            if value is not None and 0 <= value < 1000:
+                self.changes.append({'change_ms': date_ms, 'program': math.floor(value + 0.5)})
+
+    def finish(self, first_day, last_day):
+        if first_day != self.next_day:
+            self.state = get_checkpoint(first_day) or extract_previous_state(first_day)
+
+        # Also without any logged change: the carried program ran the whole window
+        changes, self.changes = self.changes, []
+        start_ms, end_ms = day_bounds_ms(first_day, last_day)
+        records, self.state = transform_data(changes, self.state, start_ms, end_ms)
+        load_data(records, days_in_range(first_day, last_day))
+
+        self.next_day = last_day + timedelta(days=1)
+        save_checkpoint(first_day, self.next_day, self.state)
+        return records, 'dt'
 
 
 # ORCHESTRATION
-def run_etl(start_date=None, end_date=None):
+def run_etl(start_date=None, end_date=None, resume=False, incremental=False, chunk_days=PROGRAM_CHUNK_DAYS):
     '''Main function which combines all steps'''
 
+    if incremental:
+        checkpoint_day = get_latest_checkpoint_day()
+        _, end_date = get_date_range()
+        if checkpoint_day is None or not end_date:
+            logger.error("No checkpoint found, run a backfill first")
+            return
+        start_date = str(checkpoint_day)
+        date_desc = f"incremental run from {start_date} to {end_date}"
     # For full backfill, get min/max dates from source data
-    if start_date is None and end_date is None:
+    elif start_date is None and end_date is None:
         logger.info("No dates provided, querying date range for full backfill...")
         start_date, end_date = get_date_range()
         if not start_date or not end_date:
@@ -208,21 +294,37 @@ def run_etl(start_date=None, end_date=None):
     elif end_date is not None:
         date_desc = f"from {start_date} to {end_date}"
     else:
+        end_date = start_date
         date_desc = f"only {start_date}"
     
     logger.info(f"Started ETL script for {date_desc}")
     
     try:
-        raw_data = extract_data(start_date, end_date)
-        if not raw_data:
-            logger.warning("Could not find raw data.")
-            return
+        state = None
+        next_day = None
+        total_records = 0
+        for first_day, last_day in etl_watermark.pending_windows(ETL_NAME, start_date, end_date, chunk_days, resume):
+            # The state before a chunk comes from the previous chunk, or from a checkpoint when
+            # the chunk does not follow it (first chunk, or days skipped by --resume)
+            if first_day != next_day:
+                state = get_checkpoint(first_day)
+                if state is None:
+                    state = extract_previous_state(first_day)
 
-        logger.info(f"Extracted raw data consisting of {len(raw_data)} records")
-        
-        # No transformation needed - data is already in the correct format from the query
-        load_data(raw_data)
-        logger.info("Successfully loaded data.")
+            with etl_watermark.track(ETL_NAME, first_day, last_day, id_vars=[PROGRAM_VAR_ID]) as partition:
+                start_ms, end_ms = day_bounds_ms(first_day, last_day)
+                changes = extract_data(first_day, last_day)
+                logger.info(f"Extracted {len(changes)} program changes for {first_day} to {last_day}")
+
+                # Also without any logged change: the carried program ran the whole chunk
+                records, state = transform_data(changes, state, start_ms, end_ms)
+                total_records += load_data(records, days_in_range(first_day, last_day))
+                partition.add_rows(records, 'dt')
+
+                next_day = last_day + timedelta(days=1)
+                save_checkpoint(first_day, next_day, state)
+
+        logger.info(f"Successfully loaded data ({total_records} records).")
         
     except Exception as e:
         logger.error(f"ETL failed with error: {str(e)}")
@@ -235,15 +337,18 @@ if __name__ == "__main__":
 
     # Logging - Tracks what happens at every step
     logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger(__name__)
-
-    if len(sys.argv) == 2:
-        start_date = sys.argv[1]
-        run_etl(start_date)
-    elif len(sys.argv) == 3:
-        start_date = sys.argv[1]
-        end_date = sys.argv[2]
-        run_etl(start_date, end_date)
+
+    incremental = '--incremental' in sys.argv
+    resume = '--resume' in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if len(args) == 1:
+        start_date = args[0]
+        run_etl(start_date, resume=resume, incremental=incremental)
+    elif len(args) == 2:
+        start_date = args[0]
+        end_date = args[1]
+        run_etl(start_date, end_date, resume=resume, incremental=incremental)
     else:
         # Full backfill - no dates provided
-        run_etl()
\ No newline at end of file
+        run_etl(resume=resume, incremental=incremental)
@@ -3,6 +3,13 @@ ETL (Extract, Transform and Load) script for tracking of TEMPERATURA BASE
 Use the Arguments to filter on date. If one data from one date is desired, use only one argument.
 If data between an interval of two dates is desired, use two arguments, respectively start_date and end_date.
 
+Besides the rounded min/avg/max/std_dev, every hourly row keeps its mergeable state
+(readings_count, mean_value, m2_value, min_value, max_value and last_reading_ms).
+With --incremental only the readings newer than the last folded reading are extracted,
+and they are merged into the existing hours with Chan's parallel variance formula.
+Each hour also stores a DDSketch (value_sketch) of its readings, merged the same way,
+so that percentiles for any range can be answered from the aggregation DB.
+
 Tip: When running the script, run it as a module, this way our imports are properly handled (sys.path):
     
     EXAMPLE BELOW:
@@ -13,34 +20,83 @@ Tip: When running the script, run it as a module, this way our imports are prope
     INFO:__main__:Transformed into 13 hourly records.
     INFO:__main__:Succesfully loaded data.
 
+    python -m backend.scripts.etl_agg_sensor_stats --incremental
+    python -m backend.scripts.etl_agg_sensor_stats 2022-02-01 2022-02-28 --fan-out
+    python -m backend.scripts.etl_agg_sensor_stats 2022-02-01 2022-02-28 --copy
+
 Args:
     start_date : None by default. 
     end_date   : None by default
+    --incremental : Fold only new readings into the existing hourly rows
+    --resume      : Skip the days already processed according to etl_watermark
+    --fan-out     : Extract every sensor variable and part of the window with its own concurrent query
+    --copy        : Extract through binary COPY into column arrays (copy_extract.py), for large backfills
 '''
 
 # IMPORTS
 
 
 import logging
-import statistics
 import sys
 import math
 
 from backend.database import prod_engine, agg_engine
 from backend.models import AggSensorStats
+from backend.quantile_sketch import DDSketch
+from backend.scripts.bulk_loader import upsert
+from backend.scripts.copy_extract import copy_columns
+from backend.scripts.etl_common import day_bounds_ms, days_in_range, fan_out, fan_out_workers, ms_to_day
+from backend.scripts import etl_source_coverage, etl_watermark
+from backend.scripts.shared_scan import ScanConsumer
 from sqlalchemy import text
-from sqlalchemy.orm import Session
-from datetime import datetime
+from datetime import datetime, timezone
 from collections import defaultdict
 
 SENSOR_OF_CHOICE = 'TEMPERATURA_BASE'
 
+ETL_NAME = 'etl_agg_sensor_stats'
+
+# Days per extraction query for date ranges and backfills
+SENSOR_WINDOW_DAYS = 31
+
+logger = logging.getLogger(__name__)
+
+
+
+# HELPER FUNCTION
+def get_date_range():
+    '''
+    Query the source DB for the min and max dates of the sensor when no dates are provided.
+    Used for full backfill.
+    '''
+    try:
+        with prod_engine.connect() as conn:
+            row = conn.execute(text('''
+                SELECT MIN(vlf.date) AS min_ms, MAX(vlf.date) AS max_ms
+                FROM variable_log_float vlf
+                WHERE vlf.id_var = ANY(:sensor_ids)
+            '''), {'sensor_ids': etl_watermark.variable_ids([SENSOR_OF_CHOICE])}).fetchone()
+            if row and row.min_ms is not None and row.max_ms is not None:
+                return str(ms_to_day(row.min_ms)), str(ms_to_day(row.max_ms))
+            return None, None
+    except Exception as e:
+        logger.error(f"Failed to get date range: {str(e)}")
+        raise
 
 
 # EXTRACT FUNCTION
-def extract_data(start_date, end_date):
+def reading_ts(date_ms):
+    '''UTC time of a raw epoch-ms date, to the second like TO_TIMESTAMP(date/1000)'''
+    return datetime.fromtimestamp(date_ms // 1000, tz=timezone.utc)
+
+
+def extract_data(start_date, end_date, after_ms=None, cutoff_ms=None):
     '''
     Query source DB
+    start_date and end_date are UTC days, filtered on the raw epoch-ms date so the (id_var, date) index is used.
+    If after_ms is given, only readings with a raw epoch-ms date after it are returned.
+    If cutoff_ms is given, only readings with a raw epoch-ms date up to it (inclusive) are returned.
+    ts is the UTC time of the reading, the same hours transform_columns() uses.
     '''
     try:
         with prod_engine.connect() as conn:
@@ -49,28 +105,27 @@ def extract_data(start_date, end_date):
 
             query = f'''
             SELECT vlf.value, 
-                TO_TIMESTAMP(vlf.date/1000) AS ts 
+                vlf.date AS date_ms
             FROM variable_log_float vlf
-                LEFT JOIN variable v ON vlf.id_var = v.id
-                WHERE v.name = :sensor_name
+                WHERE vlf.id_var = ANY(:sensor_ids)
             '''
 
-            params = {'sensor_name' : SENSOR_OF_CHOICE}
+            params = {'sensor_ids' : etl_watermark.variable_ids([SENSOR_OF_CHOICE])}
+
+            if after_ms is not None:
+                query += " AND vlf.date > :after_ms"
+                params['after_ms'] = after_ms
+
+            if cutoff_ms is not None:
+                query += " AND vlf.date <= :cutoff_ms"
+                params['cutoff_ms'] = cutoff_ms
 
             if start_date is not None:
-                
-                if end_date is None:
-                    logger.info(f"Parameters start_date = True and end_date = False")
-                    query += " AND TO_TIMESTAMP(vlf.date/1000)::date = :start_date" 
-                    params = {'sensor_name' : SENSOR_OF_CHOICE, 'start_date' : start_date}
-                else:
-                    logger.info(f"Parameters start_date = True and end_date = True")
-                    #Can't use alias "ts" in WHERE clause
-                    query += " AND TO_TIMESTAMP(vlf.date/1000)::date >= :start_date" 
-                    query += " AND TO_TIMESTAMP(vlf.date/1000)::date <= :end_date"
-                    params = {'sensor_name' : SENSOR_OF_CHOICE, 'start_date' : start_date, 'end_date': end_date}
+                # A single day when end_date is None
+                query += " AND vlf.date >= :start_ms AND vlf.date < :end_ms"
+                params['start_ms'], params['end_ms'] = day_bounds_ms(start_date, end_date)
 
-            query += " ORDER BY ts DESC;"
+            query += " ORDER BY vlf.date DESC;"
             
             result = conn.execute(text(query), params)
             # Each row is an object with accessible column names
@@ -83,8 +138,9 @@ def extract_data(start_date, end_date):
             
             return [
                 {
-                    'ts': row.ts,
-                    'value': row.value
+                    'ts': reading_ts(row.date_ms),
+                    'value': row.value,
+                    'date_ms': row.date_ms
                 } 
                 for row in rows
             ]
@@ -94,16 +150,130 @@ def extract_data(start_date, end_date):
         raise
 
 
+def extract_slice(id_var, start_ms, end_ms):
+    '''Readings of one sensor variable in [start_ms, end_ms), a single index range scan on (id_var, date)'''
+    with prod_engine.connect() as conn:
+        rows = conn.execute(text('''
+            SELECT value, date AS date_ms
+            FROM variable_log_float
+            WHERE id_var = :id_var
+            AND date >= :start_ms
+            AND date < :end_ms
+        '''), {'id_var': id_var, 'start_ms': start_ms, 'end_ms': end_ms}).fetchall()
+    return [{'ts': reading_ts(row.date_ms), 'value': row.value, 'date_ms': row.date_ms} for row in rows]
+
+
+def extract_data_fan_out(start_date, end_date):
+    '''
+    Same readings as extract_data() for UTC days, read by concurrent queries: one per sensor
+    variable and contiguous part of the days, as many parts as the fan-out may run at once.
+    '''
+    sensor_ids = etl_watermark.variable_ids([SENSOR_OF_CHOICE])
+    days = days_in_range(start_date, end_date)
+    parts = fan_out_workers(len(days))
+    size = -(-len(days) // parts)
+
+    tasks = []
+    for id_var in sensor_ids:
+        for i in range(0, len(days), size):
+            start_ms, end_ms = day_bounds_ms(days[i], days[min(i + size, len(days)) - 1])
+            tasks.append((id_var, start_ms, end_ms))
+
+    raw_data = [row for rows in fan_out(extract_slice, tasks) for row in rows]
+    raw_data.sort(key=lambda row: row['date_ms'], reverse=True)
+    return raw_data
+
+
+def extract_columns(start_date, end_date):
+    '''
+    Readings of the sensor for UTC days through binary COPY, without a dict per reading.
+    Returns a dict with the arrays date_ms and value, for transform_columns().
+    '''
+    start_ms, end_ms = day_bounds_ms(start_date, end_date)
+    try:
+        return copy_columns(
+            '''
+            SELECT date::int8, value::float8
+            FROM variable_log_float
+            WHERE id_var = ANY(%(sensor_ids)s)
+            AND date >= %(start_ms)s
+            AND date < %(end_ms)s
+            AND value IS NOT NULL
+            ''',
+            {'sensor_ids': etl_watermark.variable_ids([SENSOR_OF_CHOICE]), 'start_ms': start_ms, 'end_ms': end_ms},
+            [('date_ms', 'int8'), ('value', 'float8')]
+        )
+    except Exception as e:
+        logger.error(f"COPY extraction failed for {start_date} to {end_date}: {str(e)}")
+        raise
+
+
 
     
 
+# MERGEABLE STATISTICS
+# Each hour is summarised by (count, mean, M2, min, max) so that two partial summaries
+# can be combined without the raw readings (Welford for adding, Chan et al. for merging).
+
+def new_state():
+    '''Empty mergeable state for one hour'''
+    return {'readings_count': 0, 'mean_value': 0.0, 'm2_value': 0.0,
+            'min_value': None, 'max_value': None, 'last_reading_ms': None}
+
+
+def add_reading(state, value, date_ms=None):
+    '''Fold a single reading into the state (Welford's online update)'''
+    state['readings_count'] += 1
+    delta = value - state['mean_value']
+    state['mean_value'] += delta / state['readings_count']
+    state['m2_value'] += delta * (value - state['mean_value'])
+    state['min_value'] = value if state['min_value'] is None else min(state['min_value'], value)
+    state['max_value'] = value if state['max_value'] is None else max(state['max_value'], value)
+    if date_ms is not None and (state['last_reading_ms'] is None or date_ms > state['last_reading_ms']):
+        state['last_reading_ms'] = date_ms
+
+
+def merge_states(a, b):
+    '''
+    Combine two states into a new one (Chan's parallel formula).
+    The same arithmetic is used by the SQL upsert in load_data(merge=True).
+    '''
+    if a['readings_count'] == 0:
+        return dict(b)
+    if b['readings_count'] == 0:
+        return dict(a)
+
+    n = a['readings_count'] + b['readings_count']
+    delta = b['mean_value'] - a['mean_value']
+    last_ms = [ms for ms in (a['last_reading_ms'], b['last_reading_ms']) if ms is not None]
+
+    return {
+        'readings_count': n,
+        'mean_value': a['mean_value'] + delta * b['readings_count'] / n,
+        'm2_value': a['m2_value'] + b['m2_value'] + delta * delta * a['readings_count'] * b['readings_count'] / n,
+        'min_value': min(a['min_value'], b['min_value']),
+        'max_value': max(a['max_value'], b['max_value']),
+        'last_reading_ms': max(last_ms) if last_ms else None,
+    }
+
+
+def finalize_state(state):
+    '''Derive the rounded values shown by the API from a state'''
+    n = state['readings_count']
+    return {
+        'avg_value': round(state['mean_value'], 2),
+        # Sample standard deviation, undefined for a single reading
+        'std_dev': round(math.sqrt(state['m2_value'] / (n - 1)), 2) if n > 1 else None,
+    }
+
+
 # TRANSFORM FUNCTION
 def transform_data(raw_data):
     '''
     Process data
     Args: 
         raw_data: List of dicts
-            Example: [{ts: '2022-02-23 18:59:59+00', value: 256 }, ...]
+            Example: [{ts: '2022-02-23 18:59:59+00', value: 256, date_ms: 1645642799000 }, ...]
 
     Returns:
         transformed_data: Array of the following deatils for every hour:
@@ -111,88 +281,242 @@ def transform_data(raw_data):
             min_value,
             max_value,
             avg_value,
-            readings_count
+            std_dev,
+            readings_count,
+            and the mergeable state: mean_value, m2_value, last_reading_ms, value_sketch
     '''
 
-    hourly_data = defaultdict(list)
-    
-    for record in raw_data:
-        value = record['value']
+    return summarise_readings(
+        (record['ts'].replace(minute=0, second=0, microsecond=0), record['value'], record.get('date_ms'))
+        for record in raw_data
+    )
 
+
+def transform_columns(columns):
+    '''
+    Same as transform_data() for the column arrays of extract_columns().
+    The hour of a reading is derived from its epoch ms, in UTC like the shared scan.
+    '''
+    hours = {}
+
+    def hour_of(date_ms):
+        hour_ms = date_ms // 3600000 * 3600000
+        hour = hours.get(hour_ms)
+        if hour is None:
+            hour = hours[hour_ms] = datetime.fromtimestamp(hour_ms / 1000, tz=timezone.utc)
+        return hour
+
+    return summarise_readings(
+        (hour_of(date_ms), value, date_ms) for date_ms, value in zip(columns['date_ms'], columns['value'])
+    )
+
+
+def summarise_readings(readings):
+    '''
+    Fold (hour, raw value, date_ms) readings into one row per hour, see transform_data().
+    '''
+    hourly_data = defaultdict(new_state)
+    hourly_sketches = defaultdict(DDSketch)
+    
+    for hour, value, date_ms in readings:
         # Skip invalid values
         if value is None or value == 0 or not math.isfinite(value):
             continue
 
-        # Appends all values to the appropriate hour
-        hour = record['ts'].replace(minute=0, second=0, microsecond=0)
-        hourly_data[hour].append(record['value']/100) # Divide by 100 to get the real value 
+        # Folds every value into the state of the appropriate hour
+        add_reading(hourly_data[hour], value/100, date_ms) # Divide by 100 to get the real value 
+        hourly_sketches[hour].add(value/100)
 
     transformed_data = []
 
-    for hour, values in hourly_data.items():
+    for hour, state in hourly_data.items():
         transformed_data.append({
             'dt': hour,
-            'min_value': min(values),
-            'max_value': max(values),
-            'avg_value': round(sum(values) / len(values),2),
-            'std_dev'  : round(statistics.stdev(values), 2),
-            'readings_count': len(values)
+            **state,
+            **finalize_state(state),
+            'value_sketch': hourly_sketches[hour].to_dict()
         })
 
     return transformed_data
- 
+
+
+# Shared pieces of the Chan merge used in the ON CONFLICT clause.
+# In a DO UPDATE SET, agg_sensor_stats.* always refers to the row before the update.
+_MERGED_N = "(agg_sensor_stats.readings_count + EXCLUDED.readings_count)::float8"
+_DELTA = "(EXCLUDED.mean_value - agg_sensor_stats.mean_value)"
+_MERGED_MEAN = f"(agg_sensor_stats.mean_value + {_DELTA} * EXCLUDED.readings_count / {_MERGED_N})"
+_MERGED_M2 = (f"(agg_sensor_stats.m2_value + EXCLUDED.m2_value + {_DELTA} * {_DELTA}"
+              f" * agg_sensor_stats.readings_count * EXCLUDED.readings_count / {_MERGED_N})")
+
+# Incremental: the new partial state is folded into the stored one
+MERGE_SET = {
+    'min_value': "LEAST(agg_sensor_stats.min_value, EXCLUDED.min_value)",
+    'max_value': "GREATEST(agg_sensor_stats.max_value, EXCLUDED.max_value)",
+    'readings_count': "agg_sensor_stats.readings_count + EXCLUDED.readings_count",
+    'mean_value': _MERGED_MEAN,
+    'm2_value': _MERGED_M2,
+    'avg_value': f"ROUND({_MERGED_MEAN}::numeric, 2)",
+    'std_dev': (f"CASE WHEN agg_sensor_stats.readings_count + EXCLUDED.readings_count > 1"
+                f" THEN ROUND(SQRT({_MERGED_M2} / ({_MERGED_N} - 1))::numeric, 2) END"),
+    'last_reading_ms': "GREATEST(agg_sensor_stats.last_reading_ms, EXCLUDED.last_reading_ms)",
+    'value_sketch': "sketch_merge(agg_sensor_stats.value_sketch, EXCLUDED.value_sketch)",
+}
+
+
 # LOAD FUNCTION
-def load_data(transformed_data):
-    '''Store in destination DB'''
+def load_data(transformed_data, merge=False):
+    '''
+    Store in destination DB
+    Args:
+        transformed_data: List of dicts from transform_data()
+        merge: If True, fold the records into existing hours instead of replacing them
+    '''
+    records = [
+        {
+            'sensor_name': SENSOR_OF_CHOICE,
+            'dt': record['dt'],
+            'min_value': record['min_value'],
+            'avg_value': record['avg_value'],
+            'max_value': record['max_value'],
+            'std_dev': record['std_dev'],
+            'readings_count': record['readings_count'],
+            'mean_value': record['mean_value'],
+            'm2_value': record['m2_value'],
+            'last_reading_ms': record['last_reading_ms'],
+            'value_sketch': record['value_sketch'],
+            'last_updated_at': datetime.now()
+        }
+        for record in transformed_data
+    ]
 
-    # The session represents a "holding zone"
-    session = Session(agg_engine)
     try:
-        for record in transformed_data:
-            # Creating an ORM object matching the model for each row
-            sensor_stat = AggSensorStats(
-                sensor_name = SENSOR_OF_CHOICE,
-                dt = record['dt'],
-                min_value = record['min_value'],
-                avg_value = record['avg_value'],
-                max_value = record['max_value'],
-                std_dev = record['std_dev'],
-                readings_count = record['readings_count'],
-                last_updated_at = datetime.now()
-            )
-
-            session.merge(sensor_stat)
-
-        session.commit()
+        if merge:
+            # Full recompute overwrites the hour, incremental loads fold into it
+            upsert(AggSensorStats, records, conflict_columns=['sensor_name', 'dt'],
+                   update_columns=['last_updated_at'], update_set=MERGE_SET)
+        else:
+            upsert(AggSensorStats, records, conflict_columns=['sensor_name', 'dt'])
 
-            
     except Exception as e:
-        # Undo everything if something went wrong
-        session.rollback()
         logger.error(f"Load of data failed: {str(e)}")
-        
-    finally:
-        session.close()
+        raise
 
 
- 
+def get_last_reading_ms():
+    '''
+    Latest raw epoch-ms reading already folded into agg_sensor_stats for the sensor.
+    Returns None if nothing has been loaded with mergeable state yet.
+    '''
+    with agg_engine.connect() as conn:
+        row = conn.execute(text('''
+            SELECT MAX(last_reading_ms) AS last_ms
+            FROM agg_sensor_stats
+            WHERE sensor_name = :sensor_name
+        '''), {'sensor_name': SENSOR_OF_CHOICE}).fetchone()
+        return row.last_ms if row else None
+
+
+# SHARED SCAN
+class SensorStatsConsumer(ScanConsumer):
+    '''Hourly sensor stats from the rows of a shared scan (see shared_scan.py)'''
+
+    etl_name = ETL_NAME
+
+    def __init__(self):
+        super().__init__(etl_watermark.variable_ids([SENSOR_OF_CHOICE]))
+        self.raw_data = []
+
+    def consume(self, rows):
+        for _, date_ms, value in rows:
+            self.raw_data.append({
+                'ts': reading_ts(date_ms),
+                'value': value,
+                'date_ms': date_ms
+            })
+
+    def finish(self, first_day, last_day):
+        transformed_data = transform_data(self.raw_data)
+        self.raw_data = []
+        load_data(transformed_data)
+        return transformed_data, 'dt'
+
 
 # ORCHESTRATION
-def run_etl(start_date=None, end_date=None):
-    '''main function which combines all steps'''
+def run_etl(start_date=None, end_date=None, resume=False, incremental=False, fan_out_reads=False,
+            copy_reads=False):
+    '''
+    main function which combines all steps
+    With fan_out_reads=True every window is extracted by concurrent queries (extract_data_fan_out).
+    With copy_reads=True every window is extracted through binary COPY (extract_columns).
+    '''
+
+    if incremental:
+        after_ms = get_last_reading_ms()
+        if after_ms is not None:
+            run_incremental(after_ms)
+            return
+        logger.info("No previous state, falling back to a full backfill")
+        start_date, end_date = None, None
 
-    # TernaDetermine date range description
     if start_date is None and end_date is None:
-        date_desc = "full backfill"
+        start_date, end_date = get_date_range()
+        if not start_date or not end_date:
+            logger.warning(f"Could not find raw data.")
+            return
+        date_desc = f"full backfill from {start_date} to {end_date}"
     elif end_date is not None:
         date_desc = f"from {start_date} to {end_date}"
     else:
+        end_date = start_date
         date_desc = f"only {start_date}"
     
     logger.info(f"Started ETL script for {date_desc}")
     
     try :
-        raw_data = extract_data(start_date, end_date)
+        sensor_ids = etl_watermark.variable_ids([SENSOR_OF_CHOICE])
+
+        # Days without sensor readings have no stats
+        day_rows = etl_source_coverage.day_rows(start_date, end_date, sensor_ids)
+
+        for first_day, last_day in etl_watermark.pending_windows(ETL_NAME, start_date, end_date, SENSOR_WINDOW_DAYS, resume, day_rows):
+            with etl_watermark.track(ETL_NAME, first_day, last_day, id_vars=sensor_ids) as partition:
+                if copy_reads:
+                    columns = extract_columns(first_day, last_day)
+                    logger.info(f"Extracted raw data consisting of {len(columns['value'])} records for {first_day} to {last_day}")
+                    if not columns['value']:
+                        continue
+                    transformed_data = transform_columns(columns)
+                else:
+                    if fan_out_reads:
+                        raw_data = extract_data_fan_out(first_day, last_day)
+                    else:
+                        raw_data = extract_data(str(first_day), str(last_day))
+                    logger.info(f"Extracted raw data consisting of {len(raw_data)} records for {first_day} to {last_day}")
+                    if not raw_data:
+                        continue
+                    transformed_data = transform_data(raw_data)
+
+                logger.info(f"Transformed into {len(transformed_data)} hourly records.")
+
+                load_data(transformed_data)
+                partition.add_rows(transformed_data, 'dt')
+
+        logger.info(f"Succesfully loaded data.")
+    except Exception as e:
+        logger.error(f"Couldn't find data Received error: {str(e)}")
+        raise # Ensures that the failure is not being swallowed silently. The caller can detect it and act accordingly
+
+
+def run_incremental(after_ms, cutoff_ms=None):
+    '''
+    Fold the readings newer than after_ms into the existing hours.
+    With cutoff_ms, readings dated after it are left for a later run: once merged, the hours
+    never take a reading dated before last_reading_ms again.
+    '''
+    logger.info(f"Started ETL script for readings after {after_ms}")
+
+    try :
+        raw_data = extract_data(None, None, after_ms, cutoff_ms)
         if not raw_data:
             logger.warning(f"Could not find raw data.")
             return
@@ -202,11 +526,12 @@ def run_etl(start_date=None, end_date=None):
         transformed_data = transform_data(raw_data)
         logger.info(f"Transformed into {len(transformed_data)} hourly records.")
         
-        load_data(transformed_data)
+        # Merging is only safe when the extracted readings were never loaded before
+        load_data(transformed_data, merge=True)
         logger.info(f"Succesfully loaded data.")
     except Exception as e:
         logger.error(f"Couldn't find data Received error: {str(e)}")
-        raise # Ensures that the failure is not being swallowed silently. The caller can detect it and act accordingly
+        raise
 
 
 
@@ -216,14 +541,19 @@ if __name__ == "__main__":
 
     # Logging - Tracks what happens at every step
     logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger(__name__) # Built in name given by python (related to filename)
-
-    if len(sys.argv) == 2:
-        start_date = sys.argv[1]
-        run_etl(start_date)
-    elif len(sys.argv) == 3:
-        start_date = sys.argv[1]
-        end_date = sys.argv[2]
-        run_etl(start_date, end_date)
+
+    incremental = '--incremental' in sys.argv
+    resume = '--resume' in sys.argv
+    fan_out_reads = '--fan-out' in sys.argv
+    copy_reads = '--copy' in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if len(args) == 1:
+        start_date = args[0]
+        run_etl(start_date, resume=resume, incremental=incremental, fan_out_reads=fan_out_reads, copy_reads=copy_reads)
+    elif len(args) == 2:
+        start_date = args[0]
+        end_date = args[1]
+        run_etl(start_date, end_date, resume=resume, incremental=incremental, fan_out_reads=fan_out_reads, copy_reads=copy_reads)
     else:
-        run_etl()
\ No newline at end of file
+        run_etl(resume=resume, incremental=incremental, fan_out_reads=fan_out_reads, copy_reads=copy_reads)
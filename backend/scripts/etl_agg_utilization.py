@@ -4,199 +4,285 @@ Calculates running hours vs. downtime hours per day based on log activity gaps.
 
 A gap of >10 minutes between log entries is considered downtime.
 
+The raw logs are not read here: everything is derived from the 10-minute activity buckets
+of agg_activity_10min (run etl_agg_activity_buckets.py first for the same days).
+A gap longer than 10 minutes can only fall between two buckets, so the first and last
+timestamp of every bucket are enough to rebuild the running sessions exactly.
+Besides agg_machine_activity_daily this fills:
+    agg_machine_activity_hourly: running seconds and log entries per hour
+    agg_machine_state_timeline:  merged PARADA / IDLE / OPERACION blocks (Gantt) per day,
+                                 from the number of log entries of each 10-minute bucket
+
 Usage:
     python -m backend.scripts.etl_agg_utilization                       # Full backfill
     python -m backend.scripts.etl_agg_utilization 2021-09-14            # Single day
     python -m backend.scripts.etl_agg_utilization 2021-09-01 2021-09-30 # Date range
+    python -m backend.scripts.etl_agg_utilization 2021-09-01 2021-09-30 --resume
 
 Args:
     from_date: Start date (optional). If missing, processes all available data.
     to_date:   End date (optional). If missing, processes single day (from_date).
+    --resume:  Skip the days already processed according to etl_watermark.
 '''
 
 import logging
 import sys
+from collections import defaultdict
+from datetime import datetime, timedelta
 
-from sqlalchemy.orm import Session
-from backend.database import prod_engine, agg_engine
+from backend.database import agg_engine
 from sqlalchemy import text
-from backend.models import AggMachineActivityDaily
+from backend.models import AggMachineActivityDaily, AggMachineActivityHourly, AggMachineStateTimeline
+from backend.scripts.bulk_loader import upsert, replace_days
+from backend.scripts.etl_common import date_to_ms, days_in_range
+from backend.scripts import etl_watermark
 
 logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ETL_NAME = 'etl_agg_utilization'
+
+# Stage that fills agg_activity_10min
+SOURCE_ETL_NAME = 'etl_agg_activity_buckets'
+
+# Days per extraction query
+UTILIZATION_WINDOW_DAYS = 31
+
+# A gap longer than this between two log entries ends a running session
+SESSION_GAP_SECONDS = 600
+
+BUCKET_SECONDS = 600
+
+# Log entries per 10-minute bucket, up to which the machine is IDLE (0 is PARADA)
+IDLE_MAX_CHANGES = 30
+
+
+def get_date_range():
+    '''
+    Query the activity buckets for the min and max dates when no dates are provided.
+    Used for full backfill.
+    '''
+    try:
+        with agg_engine.connect() as conn:
+            row = conn.execute(text('''
+                SELECT MIN(dt) AS min_date, MAX(dt) AS max_date
+                FROM agg_activity_10min
+            ''')).fetchone()
+            if row and row.min_date and row.max_date:
+                return str(row.min_date), str(row.max_date)
+            return None, None
+    except Exception as e:
+        logger.error(f"Failed to get date range: {str(e)}")
+        raise
+
 
-def extract_data(from_date=None, to_date=None):
+def extract_data(from_date, to_date=None):
     '''
-    Extract running/downtime hours from production database.
-    
+    Read the activity buckets of a range of days from the aggregated database.
+
     Params:
-        from_date: Start date filter (optional)
-        to_date:   End date filter (optional)
-    
+        from_date: First day
+        to_date:   Last day (inclusive), defaults to from_date
+
     Returns:
-        List of dicts with dt, running_hours, and down_hours per day.
+        List of dicts with dt, bucket_ts, readings_count, first_ms and last_ms, ordered by bucket.
     '''
     try:
-        with prod_engine.connect() as conn:
-            query = '''WITH cambios AS (
-            -- 1. Common database: Float and string union
-            SELECT
-                to_timestamp(TRUNC(CAST(a.date AS bigint)/1000)) AS dt
-            FROM variable_log_float a
-            '''
-            if(from_date):
-                if(to_date):
-                    query +='''
-                    WHERE to_timestamp(TRUNC(CAST(a.date AS bigint)/1000))::date
-                    BETWEEN :from_date AND :to_date
-                    '''
-                else:
-                    query +='''
-                    WHERE to_timestamp(TRUNC(CAST(a.date AS bigint)/1000))::date
-                    = :from_date
-                    '''
-            query += '''
-            UNION ALL
-
-            SELECT
-                to_timestamp(TRUNC(CAST(a.date AS bigint)/1000)) AS dt
-            FROM variable_log_string a
-            '''
-            if(from_date):
-                if(to_date):
-                    query += '''
-                    WHERE to_timestamp(TRUNC(CAST(a.date AS bigint)/1000))::date
-                    BETWEEN :from_date AND :to_date
-                    '''
-                else:
-                    query+='''
-                    WHERE to_timestamp(TRUNC(CAST(a.date AS bigint)/1000))::date
-                        = :from_date
-                    '''
-
-            query +='''
-            ),
-            ordenado AS (
-                -- 2. Sorting
-                SELECT
-                    dt,
-                    date(dt) AS fecha,
-                    LAG(dt) OVER (PARTITION BY date(dt) ORDER BY dt) AS dt_anterior
-                FROM cambios
-            ),
-
-            -- Calculation of operations (running time)
-            marcado_ops AS (
-                SELECT fecha, dt, CASE WHEN dt_anterior IS NULL OR EXTRACT(EPOCH FROM (dt - dt_anterior)) > 600 THEN 1 ELSE 0 END AS nueva_sesion
-                FROM ordenado
-            ),
-            bloques_ops AS (
-                SELECT fecha, dt, SUM(nueva_sesion) OVER (PARTITION BY fecha ORDER BY dt) AS bloque_id
-                FROM marcado_ops
-            ),
-            Duracion_Operacion AS (
-                SELECT fecha, EXTRACT(EPOCH FROM (MAX(dt) - MIN(dt))) AS duracion_segundos
-                FROM bloques_ops
-                GROUP BY fecha, bloque_id
-            ),
-            Tiempo_Running AS (
-                SELECT fecha, COALESCE(SUM(duracion_segundos), 0) AS running_segundos
-                FROM Duracion_Operacion
-                GROUP BY fecha
-            )
-
-            -- ==========================================
-            -- Final format and percentages (24 hours = 86400 s)
-            -- ==========================================
-            SELECT
-                r.fecha AS dia,
-                
-                -- Conversion to hours (Running)
-                ROUND( (COALESCE(r.running_segundos, 0) / 3600.0), 2) AS running_horas,
-                
-                -- Conversion to hours (Down)
-                ROUND( ((86400.0 - COALESCE(r.running_segundos, 0)) / 3600.0), 2) AS down_horas
-            FROM (
-                -- Select all dates with logs for coverage assurement
-                SELECT DISTINCT fecha 
-                FROM ordenado
-            ) AS All_Dates
-            LEFT JOIN Tiempo_Running r ON All_Dates.fecha = r.fecha
-
-            ORDER BY dia;
-            '''
-            params = {
-                'from_date' : from_date,
-                'to_date' : to_date
-            }
-            results = conn.execute(text(query), params)
-            
+        with agg_engine.connect() as conn:
+            rows = conn.execute(text('''
+                SELECT dt, bucket_ts, readings_count, first_ms, last_ms
+                FROM agg_activity_10min
+                WHERE dt BETWEEN :from_date AND :to_date
+                ORDER BY bucket_ts
+            '''), {'from_date': from_date, 'to_date': to_date or from_date}).fetchall()
+
             return [
                 {
-                'dt' : r.dia,
-                'running_hours' : r.running_horas,
-                'down_hours' : r.down_horas
+                    'dt': r.dt,
+                    'bucket_ts': r.bucket_ts,
+                    'readings_count': r.readings_count,
+                    'first_ms': r.first_ms,
+                    'last_ms': r.last_ms
                 }
-            for r in results
+                for r in rows
             ]
     except Exception as e:
         logger.error(f"ERROR: {str(e)}")
         raise
-    
-def load_data(transformed_data):
+
+
+def running_sessions(buckets):
+    '''
+    Running sessions of one day as (start, end) epoch seconds.
+    Consecutive buckets belong to the same session unless the gap between the last entry
+    of one and the first entry of the next is longer than SESSION_GAP_SECONDS.
+    Timestamps are truncated to whole seconds, like the original SQL.
+    '''
+    sessions = []
+    for bucket in buckets:
+        first_s, last_s = bucket['first_ms'] // 1000, bucket['last_ms'] // 1000
+        if sessions and first_s - sessions[-1][1] <= SESSION_GAP_SECONDS:
+            sessions[-1][1] = last_s
+        else:
+            sessions.append([first_s, last_s])
+    return sessions
+
+
+def classify_state(readings_count):
+    '''State of a 10-minute bucket from its number of log entries'''
+    if readings_count == 0:
+        return 'PARADA'
+    if readings_count <= IDLE_MAX_CHANGES:
+        return 'IDLE'
+    return 'OPERACION'
+
+
+def state_timeline(day, buckets):
+    '''
+    Merged state blocks covering the whole day. Buckets without log entries are PARADA.
+    '''
+    counts = {bucket['bucket_ts']: bucket['readings_count'] for bucket in buckets}
+    day_start = datetime(day.year, day.month, day.day)
+
+    blocks = []
+    for i in range(86400 // BUCKET_SECONDS):
+        bucket_ts = day_start + timedelta(seconds=i * BUCKET_SECONDS)
+        state = classify_state(counts.get(bucket_ts, 0))
+        bucket_end = bucket_ts + timedelta(seconds=BUCKET_SECONDS)
+        if blocks and blocks[-1]['state'] == state:
+            blocks[-1]['end_ts'] = bucket_end
+        else:
+            blocks.append({'dt': day, 'state': state, 'start_ts': bucket_ts, 'end_ts': bucket_end})
+
+    for block in blocks:
+        block['duration_seconds'] = int((block['end_ts'] - block['start_ts']).total_seconds())
+    return blocks
+
+
+def transform_data(buckets):
+    '''
+    Derive daily and hourly utilization and the state timeline from the activity buckets.
+    Only days with at least one bucket are returned.
+
+    Returns:
+        (daily, hourly, timeline): lists of dicts for the three tables.
+    '''
+    buckets_by_day = defaultdict(list)
+    for bucket in buckets:
+        buckets_by_day[bucket['dt']].append(bucket)
+
+    daily, hourly, timeline = [], [], []
+    for day, day_buckets in sorted(buckets_by_day.items()):
+        sessions = running_sessions(day_buckets)
+        running_seconds = sum(end - start for start, end in sessions)
+
+        daily.append({
+            'dt': day,
+            'running_hours': round(running_seconds / 3600.0, 2),
+            'down_hours': round((86400 - running_seconds) / 3600.0, 2)
+        })
+
+        # Sessions never cross midnight, split them over the hours of the day
+        day_start_s = date_to_ms(day) // 1000
+        hour_running = [0] * 24
+        for start, end in sessions:
+            while start < end:
+                hour = (start - day_start_s) // 3600
+                piece_end = min(end, day_start_s + (hour + 1) * 3600)
+                hour_running[hour] += piece_end - start
+                start = piece_end
+
+        hour_readings = [0] * 24
+        for bucket in day_buckets:
+            hour_readings[bucket['bucket_ts'].hour] += bucket['readings_count']
+
+        hourly += [
+            {
+                'hour_ts': datetime(day.year, day.month, day.day, hour),
+                'running_seconds': hour_running[hour],
+                'readings_count': hour_readings[hour]
+            }
+            for hour in range(24)
+        ]
+
+        timeline += state_timeline(day, day_buckets)
+
+    return daily, hourly, timeline
+
+
+def load_data(transformed_data, hourly=None, timeline=None, days=None):
     '''
     Load records into the aggregated database.
-    Uses merge to upsert (update if exists, insert if not).
-    
+    Uses a batched upsert (update if exists, insert if not).
+    The state timeline replaces all blocks of the given days.
+
     Params:
-        transformed_data: List of dicts from extract_data()
+        transformed_data: Daily records from transform_data()
+        hourly:           Hourly records from transform_data() (optional)
+        timeline:         State blocks from transform_data() (optional, needs days)
+        days:             Days covered by the load
     '''
-    session = Session(agg_engine)
+    records = [
+        {
+            'dt': record['dt'],
+            'state_planned_down': record['down_hours'],
+            'state_running': record['running_hours'],
+        }
+        for record in transformed_data
+    ]
+
     try:
-        
-        for record in transformed_data:
-            session_object = AggMachineActivityDaily(
-                dt = record['dt'],
-                state_planned_down = record['down_hours'],
-                state_running = record['running_hours'], 
-            )
-            session.merge(session_object)
-        
-        session.commit()
-
-    
+        loaded = upsert(AggMachineActivityDaily, records, conflict_columns=['dt'])
+        if hourly:
+            upsert(AggMachineActivityHourly, hourly, conflict_columns=['hour_ts'])
+        if timeline is not None and days:
+            replace_days(AggMachineStateTimeline, timeline, day_column='dt', days=days,
+                         columns=['dt', 'state', 'start_ts', 'end_ts', 'duration_seconds'])
+        return loaded
+
     except Exception as e:
         logger.error(f"Error for loading data: {str(e)}")
-        session.rollback()
         raise
-    finally:
-        session.close()
-    
 
 
-def run_etl():
+def run_etl(start_date=None, end_date=None, resume=False, window_days=UTILIZATION_WINDOW_DAYS):
     '''
     Main orchestration function.
     '''
-    if len(sys.argv) > 1:
-        if len(sys.argv) == 3:
-            raw_data = extract_data(sys.argv[1], sys.argv[2])
-            logger.info(f"Started ETL script for dates between {sys.argv[1]} && {sys.argv[2]}")
-        else:
-            raw_data = extract_data(sys.argv[1])
-            logger.info(f"Started ETL script for {sys.argv[1]}")
+    if start_date is None:
+        logger.info("No dates provided, fetching full date range...")
+        start_date, end_date = get_date_range()
+        if not start_date:
+            logger.error("Could not determine date range from database")
+            return
+        logger.info(f"Started ETL script for full backfill from {start_date} to {end_date}")
+    elif end_date is None:
+        end_date = start_date
+        logger.info(f"Started ETL script for {start_date}")
     else:
-        raw_data = extract_data()
-        logger.info(f"Started ETL script for full backfill")
-        
+        logger.info(f"Started ETL script for dates between {start_date} && {end_date}")
+
+    total_records = 0
+    # Every day, like the buckets: the coverage index only counts the tracked variables
+    for first_day, last_day in etl_watermark.pending_windows(ETL_NAME, start_date, end_date, window_days, resume):
+        # Same source as the buckets, their fingerprints are reused instead of reading the raw logs
+        fingerprints = etl_watermark.stored_fingerprints(SOURCE_ETL_NAME, first_day, last_day)
 
-    
-    logger.info(f"Successfully loaded {len(raw_data)} rows")
-    # Transformation not needed since it is sufficiently transformed in the load query
-    load_data(raw_data)
-    logger.info(f"Successfully loaded data")
+        with etl_watermark.track(ETL_NAME, first_day, last_day, fingerprints=fingerprints) as partition:
+            daily, hourly, timeline = transform_data(extract_data(first_day, last_day))
+            total_records += load_data(daily, hourly, timeline, days_in_range(first_day, last_day))
+            partition.add_rows(daily, 'dt')
+
+    logger.info(f"Successfully loaded {total_records} rows")
 
 
 if __name__ == "__main__":
-    
-    logger = logging.getLogger(__name__)
-    run_etl()
+    resume = '--resume' in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if len(args) == 1:
+        run_etl(args[0], resume=resume)
+    elif len(args) == 2:
+        run_etl(args[0], args[1], resume=resume)
+    else:
+        run_etl(resume=resume)
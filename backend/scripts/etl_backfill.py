@@ -0,0 +1,192 @@
+'''
+Partitioned parallel backfill for any ETL module.
+
+Splits the date range into partitions of PARTITION_DAYS days and runs the module's
+run_etl(first_day, last_day) for every partition on a process pool. Each worker is a separate
+process (own interpreter, own engines) limited to one production connection, and the number of
+workers never exceeds the batch share of the global production connection budget
+(backend/connection_governor.py), so the backfill cannot exhaust the production server. The partitions load through the bulk loader like a normal run
+(upserts / day replacement), so they can finish in any order, and each records its own
+watermarks. Progress, throughput and ETA are logged after every finished partition.
+
+    EXAMPLE BELOW:
+    python -m backend.scripts.etl_backfill etl_agg_alerts 2021-01-01 2022-12-31
+    python -m backend.scripts.etl_backfill etl_agg_energy_daily 2021-01-01 2022-12-31 --workers=6 --partition-days=14
+    python -m backend.scripts.etl_backfill etl_agg_program_history --resume
+
+Args:
+    etl_name         : ETL module in backend/scripts, e.g. etl_agg_alerts
+    start_date       : Optional, the full source range of the ETL by default
+    end_date         : Optional, defaults to start_date
+    --workers=N      : Worker processes (default ETL_BACKFILL_WORKERS or 4)
+    --partition-days : Days per partition (default 31)
+    --resume         : Leave out the days already done according to etl_watermark
+
+Settings (environment):
+    ETL_BACKFILL_WORKERS : Default number of worker processes (4)
+    PROD_CONNECTION_BUDGET, PROD_API_RESERVED_SLOTS : Global connection budget, see connection_governor.py
+'''
+
+import importlib
+import inspect
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from backend.database import prod_engine, prod_governor
+from backend.scripts.etl_common import parse_date
+from backend.scripts import etl_source_coverage, etl_watermark
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = int(os.getenv("ETL_BACKFILL_WORKERS", "4"))
+
+PARTITION_DAYS = 31
+
+# Production connections of one worker process
+WORKER_PROD_POOL_SIZE = 1
+WORKER_PROD_MAX_OVERFLOW = 0
+
+
+def module_path(etl_name):
+    return f"backend.scripts.{etl_name}"
+
+
+def full_date_range(module):
+    '''Source range of an ETL module from its get_date_range()'''
+    if 'motors' in inspect.signature(module.get_date_range).parameters:
+        return module.get_date_range(module.get_motor_config())
+    return module.get_date_range()
+
+
+def _init_worker():
+    # Runs in every worker before the ETL module (and backend.database) is imported
+    logging.basicConfig(level=logging.INFO)
+
+
+def run_partition(etl_name, first_day, last_day):
+    '''
+    Worker: run one partition of an ETL in this process.
+    Raises if run_etl raises or leaves any day of the partition 'failed' or 'running'
+    in etl_watermark, so a window error the ETL only logged still fails the partition.
+
+    Returns:
+        (first_day, last_day, seconds)
+    '''
+    started = time.perf_counter()
+    module = importlib.import_module(module_path(etl_name))
+    module.run_etl(str(first_day), str(last_day))
+
+    states = etl_watermark.partition_states(etl_name, first_day, last_day)
+    unfinished = sorted(day for day, (status, _) in states.items()
+                        if status in (etl_watermark.STATUS_FAILED, etl_watermark.STATUS_RUNNING))
+    if unfinished:
+        raise RuntimeError(f"{len(unfinished)} days not done: {', '.join(str(day) for day in unfinished[:10])}"
+                           f"{'...' if len(unfinished) > 10 else ''}")
+    return first_day, last_day, time.perf_counter() - started
+
+
+def backfill(etl_name, start_date=None, end_date=None, workers=DEFAULT_WORKERS,
+             partition_days=PARTITION_DAYS, resume=False, connection_budget=None):
+    '''
+    Run an ETL over a date range in parallel partitions.
+
+    Params:
+        etl_name:          ETL module name, e.g. 'etl_agg_alerts'
+        start_date:        First day, the full source range of the ETL if None
+        end_date:          Last day (inclusive), defaults to start_date
+        workers:           Requested worker processes
+        partition_days:    Days per partition
+        resume:            Leave out the days already done according to etl_watermark
+        connection_budget: Production connections all workers together may hold,
+                           the batch slots of the connection governor by default
+
+    Returns:
+        List of the partitions that failed, as (first_day, last_day, error).
+        The command line exits with 1 when it is not empty.
+    '''
+    if start_date is None:
+        start_date, end_date = full_date_range(importlib.import_module(module_path(etl_name)))
+        if not start_date:
+            logger.error(f"Could not determine the date range of {etl_name}")
+            return []
+    end_date = end_date or start_date
+
+    # Partitions are sized by the source rows per day (etl_source_coverage), empty days are
+    # left to the ETL itself
+    days = etl_watermark.pending_days(etl_name, start_date, end_date, resume)
+    day_rows = etl_source_coverage.day_rows(start_date, end_date)
+    partitions = list(etl_watermark.group_windows(days, partition_days, day_rows))
+    if not partitions:
+        logger.info(f"{etl_name}: nothing to do between {start_date} and {end_date}")
+        return []
+
+    total_days = sum((parse_date(last) - parse_date(first)).days + 1 for first, last in partitions)
+    connection_budget = connection_budget or prod_governor.batch_slots
+    workers = max(1, min(workers, connection_budget // WORKER_PROD_POOL_SIZE, len(partitions)))
+    logger.info(f"{etl_name}: {len(partitions)} partitions ({total_days} days) on {workers} workers")
+
+    # The whole budget goes to the workers, this process keeps no idle production connection
+    prod_engine.dispose()
+
+    # Read by backend.database when the workers import it
+    os.environ["PROD_POOL_SIZE"] = str(WORKER_PROD_POOL_SIZE)
+    os.environ["PROD_MAX_OVERFLOW"] = str(WORKER_PROD_MAX_OVERFLOW)
+
+    started = time.perf_counter()
+    done_days = 0
+    failed = []
+
+    # Spawned workers start clean, no connections inherited from this process
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as pool:
+        futures = {
+            pool.submit(run_partition, etl_name, first, last): (first, last)
+            for first, last in partitions
+        }
+
+        for i, future in enumerate(as_completed(futures), start=1):
+            first, last = futures[future]
+            days = (parse_date(last) - parse_date(first)).days + 1
+            try:
+                _, _, seconds = future.result()
+                logger.info(f"Partition {first} to {last} done in {seconds:.1f} s")
+            except Exception as e:
+                logger.error(f"Partition {first} to {last} failed: {str(e)}")
+                failed.append((first, last, str(e)))
+
+            done_days += days
+            elapsed = time.perf_counter() - started
+            rate = done_days / elapsed if elapsed else 0.0
+            eta = (total_days - done_days) / rate if rate else 0.0
+            logger.info(f"Progress {i}/{len(partitions)} partitions, {done_days}/{total_days} days "
+                        f"({rate * 3600:.0f} days/h), ETA {eta / 60:.1f} min")
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"{etl_name}: backfill of {total_days} days finished in {elapsed / 60:.1f} min, "
+                f"{len(failed)} partitions failed")
+    return failed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg)
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+
+    if not 1 <= len(args) <= 3:
+        print(__doc__)
+        sys.exit(1)
+
+    failed = backfill(
+        args[0],
+        args[1] if len(args) > 1 else None,
+        args[2] if len(args) > 2 else None,
+        workers=int(options.get("workers", DEFAULT_WORKERS)),
+        partition_days=int(options.get("partition-days", PARTITION_DAYS)),
+        resume="--resume" in sys.argv
+    )
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,199 @@
+'''
+Small helpers shared by the ETL scripts: date parsing, UTC epoch-ms bounds and date windows.
+
+The production tables store `date` as epoch milliseconds. Filtering on raw ms bounds
+(date >= :start_ms AND date < :end_ms) lets PostgreSQL use the (id_var, date) index,
+while wrapping the column in to_timestamp(...)::date forces a scan of every row of the variable.
+Days are UTC days, like the energy ETL.
+
+prefetch_windows() overlaps the extraction of the next window with the transform and load
+of the current one (pipeline mode of the ETLs). fan_out() runs independent extraction queries
+(one per variable) concurrently on separate pooled connections.
+
+`catalog` resolves production variable names to ids in memory (see backend/variable_catalog.py),
+so the extraction queries filter on `id_var = ANY(:ids)` instead of joining `variable`.
+'''
+
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+
+from backend.database import prod_engine, prod_governor, prod_pool_size, prod_max_overflow
+from backend.variable_catalog import VariableCatalog
+
+logger = logging.getLogger(__name__)
+
+# Shared by all ETLs of a process, loaded on first use
+catalog = VariableCatalog(prod_engine)
+
+# Extracted windows waiting for their load in pipeline mode, bounds the memory used
+PIPELINE_DEPTH = 2
+
+# Concurrent production queries of one fan-out at most
+FAN_OUT_MAX_WORKERS = int(os.getenv("ETL_FAN_OUT_WORKERS", "4"))
+
+
+def parse_date(value):
+    '''date from a date, datetime or 'YYYY-MM-DD' string'''
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def date_to_ms(day):
+    '''Epoch ms of 00:00 UTC of a day'''
+    day = parse_date(day)
+    return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def day_bounds_ms(start_day, end_day=None):
+    '''
+    Half-open epoch-ms range [start_ms, end_ms) covering start_day to end_day (inclusive).
+    '''
+    end_day = parse_date(end_day or start_day)
+    return date_to_ms(start_day), date_to_ms(end_day + timedelta(days=1))
+
+
+def ms_to_day(ms):
+    '''UTC day of an epoch-ms timestamp'''
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).date()
+
+
+def days_in_range(start_day, end_day):
+    '''All days from start_day to end_day (inclusive)'''
+    start_day, end_day = parse_date(start_day), parse_date(end_day)
+    return [start_day + timedelta(days=i) for i in range((end_day - start_day).days + 1)]
+
+
+def iter_windows(start_day, end_day, window_days):
+    '''
+    Split start_day..end_day into consecutive windows of at most window_days days.
+    Yields (first_day, last_day) tuples, both inclusive.
+    '''
+    current, end_day = parse_date(start_day), parse_date(end_day)
+    while current <= end_day:
+        last = min(current + timedelta(days=window_days - 1), end_day)
+        yield current, last
+        current = last + timedelta(days=1)
+
+
+class Prefetched:
+    '''Extraction of one window, done ahead of its load by prefetch_windows()'''
+
+    def __init__(self, first_day, last_day, fingerprints, data, error):
+        self.first_day = first_day
+        self.last_day = last_day
+        self.fingerprints = fingerprints
+        self._data = data
+        self._error = error
+
+    def result(self):
+        '''The extracted data, or the extraction error raised here in the caller'''
+        if self._error is not None:
+            raise self._error
+        return self._data
+
+
+def _extract_window(first_day, last_day, extract, fingerprint):
+    fingerprints = None
+    try:
+        # Fingerprints before reading, like etl_watermark.track()
+        if fingerprint is not None:
+            fingerprints = fingerprint(first_day, last_day)
+        return Prefetched(first_day, last_day, fingerprints, extract(first_day, last_day), None)
+    except Exception as e:
+        return Prefetched(first_day, last_day, fingerprints, None, e)
+
+
+def prefetch_windows(windows, extract, depth=PIPELINE_DEPTH, fingerprint=None):
+    '''
+    Extract windows ahead of the caller (producer/consumer pipeline).
+
+    A producer thread runs extract(first_day, last_day) for every window and puts the results
+    in a queue of at most `depth` windows, so the production query of the next window runs while
+    the caller transforms and loads the current one. When the queue is full the producer waits
+    (backpressure). With depth=0 every window is extracted in the calling thread when it is reached.
+
+    Params:
+        windows:     Iterable of (first_day, last_day)
+        extract:     Function (first_day, last_day) -> data
+        depth:       Extracted windows kept ready at most, 0 for no pipeline
+        fingerprint: Optional function (first_day, last_day) -> source fingerprints, called right
+                     before extract, for etl_watermark.track(fingerprints=...)
+
+    Yields:
+        Prefetched objects in window order. result() raises the extraction error, if any,
+        so it is handled by the caller like an error of its own extraction.
+    '''
+    if depth <= 0:
+        for first_day, last_day in windows:
+            yield _extract_window(first_day, last_day, extract, fingerprint)
+        return
+
+    results = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for first_day, last_day in windows:
+                if not put(_extract_window(first_day, last_day, extract, fingerprint)):
+                    return
+        except Exception as e:
+            # Error while listing the windows, handed over like an extraction error
+            put(Prefetched(None, None, None, None, e))
+        put(done)
+
+    producer = threading.Thread(target=produce, name="etl-extract", daemon=True)
+    producer.start()
+    waited = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            item = results.get()
+            waited += time.perf_counter() - started
+            if item is done:
+                break
+            if item.first_day is None:
+                item.result()
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+        logger.info(f"Pipeline: {waited:.1f} s waiting for extraction")
+
+
+def fan_out_workers(tasks):
+    '''
+    Concurrent queries for a fan-out of `tasks` queries: capped by the production pool of this
+    process and by the batch share of the global connection budget (connection_governor.py).
+    '''
+    return max(1, min(tasks, FAN_OUT_MAX_WORKERS, prod_pool_size + prod_max_overflow, prod_governor.batch_slots))
+
+
+def fan_out(extract, tasks):
+    '''
+    Run extract(*task) for every task concurrently, each on its own pooled connection.
+    Returns the results in task order, the first error is raised.
+    '''
+    workers = fan_out_workers(len(tasks))
+    if workers == 1:
+        return [extract(*task) for task in tasks]
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="etl-fan-out") as pool:
+        return list(pool.map(lambda task: extract(*task), tasks))
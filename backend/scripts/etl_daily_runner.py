@@ -2,27 +2,29 @@
 Daily ETL Runner - Demonstration Script
 
 Intended to run daily to keep aggregated tables up to date.
-The ETL queries v_data_status for the latest processed date and runs all ETL scripts
-from that date to the current date.
+The ETLs run in one process through etl_orchestrator.py, independent ones in parallel.
+Every ETL resumes on its own: its start date comes from its watermarks in etl_watermark
+(the first day it has not finished), and it is run with --resume so the days it already
+finished inside the range are skipped. A lagging or failed ETL therefore catches up
+without the others recomputing anything.
+ETLs without watermarks yet start from the latest date in v_data_status, as before.
 
+Only complete UTC days are processed, up to yesterday: a day run while it is still growing would be
+marked done with partial data. Today is kept up to date by the micro-batch ETL (etl_microbatch.py),
+the next daily run then overwrites it with the complete day.
+
+Before the run, days of the last ETL_DIRTY_LOOKBACK_DAYS days whose source rows changed after they
+were processed are marked stale (etl_dirty_partitions.py), so the resumed ETLs re-aggregate them.
 '''
 
-import subprocess
-from datetime import date, timedelta
+import logging
+from datetime import date, datetime, timedelta, timezone
 from typing import Optional
 from sqlalchemy import text
 
 from backend.database import AggregationSession
-
-
-# List of ETL modules to run
-ETL_MODULES = [
-    "backend.scripts.etl_agg_sensor_stats",
-    "backend.scripts.etl_agg_utilization",
-    "backend.scripts.etl_agg_program_history",
-    "backend.scripts.etl_agg_alerts",
-    "backend.scripts.etl_agg_energy_daily",
-]
+from backend.scripts import etl_dirty_partitions, etl_watermark
+from backend.scripts.etl_orchestrator import ETL_JOBS, job_watermarks, run_jobs, print_report
 
 
 def get_last_processed_date() -> Optional[date]:
@@ -40,61 +42,70 @@ def get_last_processed_date() -> Optional[date]:
         return None
 
 
-def run_all_etls(from_date: date, to_date: date):
+def get_start_date(etl_name: str, fallback: Optional[date]) -> Optional[date]:
+    """
+    First day an ETL still has to process.
+
+    Params:
+        etl_name: Name of the ETL in etl_watermark, e.g. 'etl_agg_alerts'
+        fallback: Shared last processed date, for ETLs without watermarks
+
+    Returns:
+        The resume date from etl_watermark, the day after fallback, or None.
+    """
+    resume_from = etl_watermark.resume_date(etl_name)
+    if resume_from is not None:
+        return resume_from
+    if fallback is not None:
+        return fallback + timedelta(days=1)
+    return None
+
+
+def run_all_etls(to_date: date):
     """
-    Run all ETL scripts for the given date range using subprocess.
+    Run every ETL from its own resume date up to to_date, in parallel where
+    the dependencies allow it (see etl_orchestrator.py).
     
     Params:
-        from_date: Start date for processing
         to_date: End date for processing
     """
-    from_str = str(from_date)
-    to_str = str(to_date)
-    
+    fallback = get_last_processed_date()
+
     print(f"\n{'='*60}")
-    print(f"Running all ETLs for: {from_str} to {to_str}")
+    print(f"Running all ETLs up to {to_date}")
     print(f"{'='*60}\n")
-    
-    for module in ETL_MODULES:
-        print(f"\n--- {module} ---")
-        try:
-            # Run each ETL as a subprocess with date range arguments
-            result = subprocess.run(
-                ["python", "-m", module, from_str, to_str]
-            )
-            
-            if result.returncode == 0:
-                print(f"✓ {module} completed")
-            else:
-                print(f"✗ {module} failed (exit code {result.returncode})")
-                    
-        except Exception as e:
-            print(f"✗ {module} failed: {e}")
+
+    def date_range(job):
+        # A job covering several ETLs starts at the one lagging the most
+        start_dates = [get_start_date(etl_name, fallback) for etl_name in job_watermarks(job)]
+        start_dates = [start for start in start_dates if start is not None]
+        if not start_dates:
+            print(f"{job['module']}: no existing data, run it individually for a full backfill")
+            return None
+        from_date = min(start_dates)
+        if from_date > to_date:
+            return None
+        return from_date, to_date
+
+    results = run_jobs(ETL_JOBS, date_range)
+    print_report(results)
 
 
 def main():
     """Main entry point for daily ETL execution."""
-    #today = date.today()
+    logging.basicConfig(level=logging.INFO)
 
-    # For test purposes we pretend today is 03/03/2022
-    today =  date(2022, 2, 24)  
-    last_date = get_last_processed_date()
-    
-    if last_date is None:
-        print("No existing data found. Run individual ETL scripts for full backfill.")
-        return
-    
-    # Start from the day after last processed date
-    from_date = last_date + timedelta(days=1)
-    
-    if from_date > today:
-        print(f"Already up to date! Last processed: {last_date}")
-        return
-    
-    print(f"Last processed date: {last_date}")
-    print(f"Processing new data: {from_date} → {today}")
-    
-    run_all_etls(from_date, today)
+    # Last complete UTC day, today belongs to the micro-batch ETL
+    yesterday = datetime.now(timezone.utc).date() - timedelta(days=1)
+
+    # Late-arriving source rows: the stale days become the resume dates of their ETLs
+    try:
+        start, _ = etl_dirty_partitions.default_range()
+        etl_dirty_partitions.mark_stale_partitions(start, yesterday)
+    except Exception as e:
+        logging.getLogger(__name__).warning(f"Change detection failed, continuing without it: {str(e)}")
+
+    run_all_etls(yesterday)
     
     print(f"\n{'='*60}")
     print("Daily ETL run complete!")
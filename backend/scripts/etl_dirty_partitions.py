@@ -0,0 +1,176 @@
+'''
+Change detection for late-arriving source data.
+
+Once an ETL has processed a day, its watermark keeps the fingerprint of the source rows it read
+(row count, latest date and sum of the dates, see etl_watermark.source_fingerprints). This job
+recomputes the fingerprints of recent days on the production server, with one aggregate per day
+and variable, and compares them with the stored ones for every ETL. Days whose source rows changed
+since they were processed are marked 'stale' in etl_watermark and re-aggregated, without
+recomputing anything else. Their copies in the local raw cache (raw_cache.py) are refreshed first.
+
+A day an ETL skipped because it had no source rows has no watermark. It counts as an empty day,
+so rows back-filled into it later mark it stale too (only between the first and last day the
+ETL has processed). Today is left to the micro-batch ETL (etl_microbatch.py).
+
+The daily runner marks the stale days before it starts (etl_daily_runner.py), its resumed runs
+then pick them up. Run on its own, this job re-aggregates them right away through the orchestrator.
+
+Usage:
+    python -m backend.scripts.etl_dirty_partitions                        # Last LOOKBACK_DAYS days
+    python -m backend.scripts.etl_dirty_partitions 2022-01-01 2022-02-24  # Date range
+    python -m backend.scripts.etl_dirty_partitions --check                # Only mark stale days
+
+Args:
+    start_date: First day to check (optional, default LOOKBACK_DAYS days before yesterday)
+    end_date:   Last day to check (optional, default yesterday)
+    --check:    Mark the stale days without re-aggregating them
+'''
+
+import logging
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+from backend.scripts.etl_common import parse_date
+from backend.scripts import etl_agg_activity_buckets, etl_agg_alerts, etl_agg_energy_daily, etl_agg_program_energy
+from backend.scripts import etl_agg_program_history, etl_agg_sensor_stats, etl_agg_utilization, etl_source_coverage
+from backend.scripts import etl_watermark, raw_cache
+from backend.scripts.etl_orchestrator import ETL_JOBS, job_name, job_watermarks, run_jobs, print_report
+
+logger = logging.getLogger(__name__)
+
+# Days checked by default, back-fills older than that need an explicit range
+LOOKBACK_DAYS = int(os.getenv("ETL_DIRTY_LOOKBACK_DAYS", "30"))
+
+
+def etl_source_variables():
+    '''Source variables of the ETLs that read specific variables, the coverage index tracks their union'''
+    motor_ids = etl_agg_energy_daily.motor_params(etl_agg_energy_daily.get_motor_config())['motor_ids']
+    return {
+        etl_agg_alerts.ETL_NAME: [etl_agg_alerts.ALARM_VAR_ID],
+        etl_agg_energy_daily.ETL_NAME: motor_ids,
+        etl_agg_program_energy.ETL_NAME: [etl_agg_program_history.PROGRAM_VAR_ID] + motor_ids,
+        etl_agg_program_history.ETL_NAME: [etl_agg_program_history.PROGRAM_VAR_ID],
+        etl_agg_sensor_stats.ETL_NAME: etl_watermark.variable_ids([etl_agg_sensor_stats.SENSOR_OF_CHOICE]),
+    }
+
+
+def source_variables():
+    '''
+    Source variables of the fingerprints every ETL records, None for all variables.
+    Must match the id_vars the ETLs pass to etl_watermark.track().
+    '''
+    variables = etl_source_variables()
+    return {
+        etl_source_coverage.ETL_NAME: sorted(set().union(*variables.values())),
+        etl_agg_activity_buckets.ETL_NAME: None,
+        etl_agg_utilization.ETL_NAME: None,   # Reuses the fingerprints of the activity buckets
+        **variables,
+    }
+
+
+def find_stale_days(start_date, end_date):
+    '''
+    Compare the current source fingerprints with the ones recorded by every ETL.
+
+    Returns:
+        Dict etl_name -> sorted list of stale days (ETLs without stale days are left out).
+    '''
+    parts = etl_watermark.variable_fingerprint_parts(start_date, end_date)
+    stale = {}
+
+    for etl_name, id_vars in source_variables().items():
+        states = etl_watermark.partition_states(etl_name, start_date, end_date)
+        processed = [day for day, (status, _) in states.items() if status == etl_watermark.STATUS_DONE]
+        if not processed:
+            continue
+
+        current = etl_watermark.combine_fingerprints(parts, id_vars)
+        first_day, last_day = min(processed), max(processed)
+        days = []
+        for day, fingerprint in sorted(current.items()):
+            if day < first_day or day > last_day:
+                continue
+            status, stored = states.get(day, (None, etl_watermark.EMPTY_FINGERPRINT))
+            # Days not 'done' are processed again anyway, days without fingerprint cannot be compared
+            if status not in (None, etl_watermark.STATUS_DONE) or stored is None:
+                continue
+            if stored != fingerprint:
+                days.append(day)
+
+        if days:
+            stale[etl_name] = days
+    return stale
+
+
+def mark_stale_partitions(start_date, end_date):
+    '''
+    Mark the days whose source changed as 'stale', so resumed runs process them again.
+    Returns the stale days per etl_name.
+    '''
+    logger.info(f"Checking source fingerprints from {start_date} to {end_date}")
+    stale = find_stale_days(start_date, end_date)
+    for etl_name, days in stale.items():
+        etl_watermark.save_watermarks(etl_name, days, etl_watermark.STATUS_STALE)
+        logger.info(f"{etl_name}: {len(days)} stale days: {', '.join(str(day) for day in days[:10])}"
+                    f"{'...' if len(days) > 10 else ''}")
+    if not stale:
+        logger.info("No stale days")
+        return stale
+
+    # The cached copies of these days miss the late rows, the resumed runs would read them again
+    refreshed = raw_cache.refresh(sorted({day for days in stale.values() for day in days}))
+    if refreshed:
+        logger.info(f"Refreshed {refreshed} cached table-days")
+    return stale
+
+
+def reaggregate(stale):
+    '''
+    Re-run the ETLs for their stale days only (resume=True skips every day still 'done').
+    The coverage index goes first, the others use it to skip empty days.
+    '''
+    coverage_days = stale.get(etl_source_coverage.ETL_NAME)
+    if coverage_days:
+        etl_source_coverage.run_etl(str(coverage_days[0]), str(coverage_days[-1]), resume=True)
+
+    def date_range(job):
+        days = [day for etl_name in job_watermarks(job) for day in stale.get(etl_name, [])]
+        if not days:
+            return None
+        return min(days), max(days)
+
+    jobs = [job for job in ETL_JOBS if job_name(job) != etl_source_coverage.ETL_NAME]
+    results = run_jobs(jobs, date_range)
+    print_report(results)
+
+
+def default_range():
+    '''LOOKBACK_DAYS days up to yesterday, today is still growing'''
+    yesterday = datetime.now(timezone.utc).date() - timedelta(days=1)
+    return yesterday - timedelta(days=LOOKBACK_DAYS - 1), yesterday
+
+
+def run_etl(start_date=None, end_date=None, check_only=False):
+    '''Main orchestration function'''
+    if start_date is None:
+        start_date, end_date = default_range()
+    start_date, end_date = parse_date(start_date), parse_date(end_date or start_date)
+
+    stale = mark_stale_partitions(start_date, end_date)
+    if stale and not check_only:
+        reaggregate(stale)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    check_only = '--check' in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if len(args) == 1:
+        run_etl(args[0], check_only=check_only)
+    elif len(args) == 2:
+        run_etl(args[0], args[1], check_only=check_only)
+    else:
+        run_etl(check_only=check_only)
@@ -0,0 +1,292 @@
+'''
+Near-real-time ETL: a long-running process that polls the production server every POLL_SECONDS
+and folds the new readings into today's aggregates, so the dashboards lag by well under a minute
+instead of a day.
+
+Every stream keeps the raw epoch-ms timestamp it has processed up to in etl_stream_watermark.
+A poll only reads rows up to now - ARRIVAL_LAG_MS, rows are usually logged a few seconds late.
+    sensor:  new readings of the sensor are merged into their hours (mergeable upsert of
+             etl_agg_sensor_stats, its own watermark is last_reading_ms in agg_sensor_stats)
+    alerts:  when new alarm snapshots arrived, the counts and details of the open day are recomputed
+    energy:  every poll, the open hour is recomputed; the last reading of each motor is held
+             until the cutoff, so the energy grows even without new readings
+    program: every poll, the program durations of the open day are recomputed up to the cutoff
+
+Energy, alerts and program durations are recomputed from the start of the open hour or day and
+overwrite their rows, so a failed or repeated poll never counts anything twice. Only the sensor
+stats are merged additively. The micro-batch does not touch etl_watermark: the daily runner
+processes each day once it is complete (see etl_daily_runner.py) and overwrites it exactly.
+
+Usage:
+    python -m backend.scripts.etl_microbatch                 # Poll every POLL_SECONDS
+    python -m backend.scripts.etl_microbatch --interval=10   # Poll every 10 seconds
+    python -m backend.scripts.etl_microbatch --once          # Single poll, e.g. from cron
+
+Args:
+    --interval: Seconds between two polls (default ETL_MICROBATCH_POLL_SECONDS, 20)
+    --once:     Run one poll and exit
+'''
+
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+from backend.database import prod_engine, agg_engine
+from backend.models import EtlStreamWatermark
+from backend.scripts.alert_classifier import AlertClassifier
+from backend.scripts.bulk_loader import upsert
+from backend.scripts.etl_common import date_to_ms, ms_to_day, days_in_range
+from backend.scripts import etl_agg_alerts, etl_agg_energy_daily, etl_agg_program_history, etl_agg_sensor_stats
+from backend.scripts import etl_watermark
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two polls
+POLL_SECONDS = float(os.getenv("ETL_MICROBATCH_POLL_SECONDS", "20"))
+
+# Rows newer than now - ARRIVAL_LAG_MS are left for the next poll
+ARRIVAL_LAG_MS = int(os.getenv("ETL_MICROBATCH_LAG_MS", "5000"))
+
+MS_PER_HOUR = 3600 * 1000
+
+
+# WATERMARKS
+def get_stream_watermarks():
+    '''Dict stream name -> last processed epoch ms'''
+    with agg_engine.connect() as conn:
+        rows = conn.execute(text('''
+            SELECT stream_name, last_ms
+            FROM etl_stream_watermark
+        ''')).fetchall()
+    return {row.stream_name: row.last_ms for row in rows}
+
+
+def save_stream_watermark(stream_name, last_ms):
+    upsert(EtlStreamWatermark, [{
+        'stream_name': stream_name,
+        'last_ms': last_ms,
+        'updated_at': datetime.now()
+    }], conflict_columns=['stream_name'])
+
+
+def has_new_rows(id_vars, after_ms, cutoff_ms):
+    '''True if any of the variables has a row in (after_ms, cutoff_ms], index lookups only'''
+    with prod_engine.connect() as conn:
+        row = conn.execute(text('''
+            SELECT
+                EXISTS (
+                    SELECT 1 FROM variable_log_float
+                    WHERE id_var = ANY(:id_vars) AND date > :after_ms AND date <= :cutoff_ms
+                )
+                OR EXISTS (
+                    SELECT 1 FROM variable_log_string
+                    WHERE id_var = ANY(:id_vars) AND date > :after_ms AND date <= :cutoff_ms
+                ) AS found
+        '''), {'id_vars': list(id_vars), 'after_ms': after_ms, 'cutoff_ms': cutoff_ms}).fetchone()
+    return bool(row.found)
+
+
+# STREAMS
+def refresh_sensor(since_ms, cutoff_ms):
+    '''Merge the readings newer than the last folded one into their hours'''
+    after_ms = etl_agg_sensor_stats.get_last_reading_ms()
+    if after_ms is None:
+        logger.warning("No mergeable sensor stats yet, run etl_agg_sensor_stats once first")
+        return
+    # Readings newer than the cutoff may still have late neighbours, they wait for the next poll
+    etl_agg_sensor_stats.run_incremental(after_ms, cutoff_ms)
+
+
+def extract_motor_readings(motors, start_ms, end_ms):
+    '''
+    Valid readings of every motor in [start_ms, end_ms), starting with the last reading before
+    start_ms dated at start_ms, in the shape integrate_energy() expects.
+    '''
+    with prod_engine.connect() as conn:
+        rows = conn.execute(text('''
+            WITH motor_cfg AS (
+                SELECT id_var, motor
+                FROM unnest(CAST(:motor_ids AS int[]), CAST(:motors AS text[])) AS cfg(id_var, motor)
+            )
+            SELECT mc.motor, CAST(:start_ms AS bigint) AS date, prev.value
+            FROM motor_cfg mc
+            CROSS JOIN LATERAL (
+                SELECT f.value::float8 AS value
+                FROM variable_log_float f
+                WHERE f.id_var = mc.id_var
+                    AND f.date < :start_ms
+                    AND f.value IS NOT NULL
+                    AND f.value = f.value
+                    AND f.value NOT IN ('Infinity'::real, '-Infinity'::real)
+                ORDER BY f.date DESC
+                LIMIT 1
+            ) prev
+
+            UNION ALL
+
+            SELECT mc.motor, f.date, f.value::float8
+            FROM variable_log_float f
+            JOIN motor_cfg mc ON mc.id_var = f.id_var
+            WHERE f.date >= :start_ms
+                AND f.date < :end_ms
+                AND f.value IS NOT NULL
+                AND f.value = f.value
+                AND f.value NOT IN ('Infinity'::real, '-Infinity'::real)
+
+            ORDER BY 1, 2
+        '''), {'start_ms': start_ms, 'end_ms': end_ms, **etl_agg_energy_daily.motor_params(motors)}).fetchall()
+
+    readings = defaultdict(list)
+    for row in rows:
+        readings[row.motor].append((row.date, row.value))
+    return readings
+
+
+def refresh_energy(since_ms, cutoff_ms):
+    '''Recompute the hours from the one containing since_ms up to the cutoff'''
+    motors = etl_agg_energy_daily.get_motor_config()
+    if not motors:
+        return
+    start_ms = since_ms // MS_PER_HOUR * MS_PER_HOUR
+    readings = extract_motor_readings(motors, start_ms, cutoff_ms)
+    nominal_kws = {m['motor']: m['nominal_kw'] for m in motors}
+
+    motor_data = etl_agg_energy_daily.integrate_energy(readings, nominal_kws, start_ms, cutoff_ms)
+    data, per_motor = etl_agg_energy_daily.transform_data(motor_data)
+    if data:
+        etl_agg_energy_daily.load_data(data, per_motor)
+
+
+def make_refresh_alerts():
+    # Compiled once for the life of the process, like one run of etl_agg_alerts
+    classifier = AlertClassifier()
+    classifier.load_lookup()
+
+    def refresh_alerts(since_ms, cutoff_ms):
+        '''Recompute the daily counts and details of the days from since_ms to the cutoff'''
+        days = days_in_range(ms_to_day(since_ms), ms_to_day(cutoff_ms))
+        alerts_by_day = defaultdict(list)
+        for alert in etl_agg_alerts.extract_alerts(days[0], days[-1]):
+            alerts_by_day[alert['day']].append(alert)
+
+        daily_count_data = []
+        details_data = []
+        for day in days:
+            day_counts, day_details = etl_agg_alerts.split_alerts(alerts_by_day[day], day, classifier)
+            daily_count_data += day_counts
+            details_data += day_details
+
+        etl_agg_alerts.load_daily_count(daily_count_data, days)
+        etl_agg_alerts.load_details(details_data, days)
+        classifier.save_new()
+
+    return refresh_alerts
+
+
+def refresh_program(since_ms, cutoff_ms):
+    '''Recompute the program durations of the days from since_ms, the last program held until the cutoff'''
+    days = days_in_range(ms_to_day(since_ms), ms_to_day(cutoff_ms))
+    state = etl_agg_program_history.get_checkpoint(days[0]) or etl_agg_program_history.extract_previous_state(days[0])
+    changes = [
+        change for change in etl_agg_program_history.extract_data(days[0], days[-1])
+        if change['change_ms'] <= cutoff_ms
+    ]
+
+    records, _ = etl_agg_program_history.transform_data(changes, state, date_to_ms(days[0]), cutoff_ms)
+    etl_agg_program_history.load_data(records, days)
+
+
+def build_streams():
+    '''
+    The streams of one micro-batch process.
+        id_vars:    Source variables checked for new rows
+        every_poll: Refresh even without new rows (values held until the cutoff grow with time)
+    '''
+    motors = etl_agg_energy_daily.get_motor_config()
+    return [
+        {
+            'name': 'sensor',
+            'id_vars': etl_watermark.variable_ids([etl_agg_sensor_stats.SENSOR_OF_CHOICE]),
+            'refresh': refresh_sensor,
+            'every_poll': False
+        },
+        {
+            'name': 'alerts',
+            'id_vars': [etl_agg_alerts.ALARM_VAR_ID],
+            'refresh': make_refresh_alerts(),
+            'every_poll': False
+        },
+        {
+            'name': 'energy',
+            'id_vars': etl_agg_energy_daily.motor_params(motors)['motor_ids'],
+            'refresh': refresh_energy,
+            'every_poll': True
+        },
+        {
+            'name': 'program',
+            'id_vars': [etl_agg_program_history.PROGRAM_VAR_ID],
+            'refresh': refresh_program,
+            'every_poll': True
+        },
+    ]
+
+
+# ORCHESTRATION
+def poll_once(streams, watermarks):
+    '''
+    Refresh every stream with the rows up to now - ARRIVAL_LAG_MS.
+    A failed stream keeps its watermark and is retried by the next poll.
+    '''
+    cutoff_ms = int(time.time() * 1000) - ARRIVAL_LAG_MS
+    # A stream without watermark starts with the current UTC day
+    day_start_ms = date_to_ms(ms_to_day(cutoff_ms))
+
+    for stream in streams:
+        since_ms = watermarks.get(stream['name'], day_start_ms)
+        if since_ms >= cutoff_ms:
+            continue
+        try:
+            if not stream['every_poll'] and not has_new_rows(stream['id_vars'], since_ms, cutoff_ms):
+                continue
+            started = time.perf_counter()
+            stream['refresh'](since_ms, cutoff_ms)
+            save_stream_watermark(stream['name'], cutoff_ms)
+            watermarks[stream['name']] = cutoff_ms
+            logger.info(f"{stream['name']}: refreshed up to {ms_to_day(cutoff_ms)} "
+                        f"{datetime.fromtimestamp(cutoff_ms / 1000, tz=timezone.utc):%H:%M:%S} "
+                        f"in {time.perf_counter() - started:.1f} s")
+        except Exception as e:
+            logger.error(f"{stream['name']}: refresh failed: {str(e)}")
+
+
+def run(poll_seconds=POLL_SECONDS, once=False):
+    '''Poll until interrupted'''
+    streams = build_streams()
+    watermarks = get_stream_watermarks()
+    logger.info(f"Micro-batch ETL started: {', '.join(s['name'] for s in streams)}, every {poll_seconds:.0f} s")
+
+    try:
+        while True:
+            started = time.monotonic()
+            poll_once(streams, watermarks)
+            if once:
+                return
+            time.sleep(max(0.0, poll_seconds - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        logger.info("Micro-batch ETL stopped")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    once = '--once' in sys.argv
+    poll_seconds = POLL_SECONDS
+    for arg in sys.argv[1:]:
+        if arg.startswith('--interval='):
+            poll_seconds = float(arg.split('=', 1)[1])
+
+    run(poll_seconds, once)
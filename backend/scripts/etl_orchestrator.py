@@ -0,0 +1,207 @@
+'''
+In-process ETL orchestrator.
+
+Imports the ETL modules and runs their run_etl(start_date, end_date, resume=True) functions
+in a bounded thread pool, instead of one `python -m` subprocess per module in sequence.
+All jobs share the engines (and connection pools) of backend.database and pay the
+import cost once. A job starts as soon as every job it depends on has succeeded;
+jobs whose dependencies failed are skipped. Failed jobs are retried with exponential backoff.
+A run_etl that catches the error of a window still raises once its other windows are done,
+so the resumed retry only processes the days that failed.
+A timing report per module is printed at the end.
+
+    EXAMPLE BELOW:
+    python -m backend.scripts.etl_orchestrator 2022-02-01 2022-02-24
+    python -m backend.scripts.etl_orchestrator 2022-02-01 2022-02-24 --workers=2
+
+Settings (environment):
+    ETL_MAX_WORKERS   : Jobs running at the same time (default 3)
+    ETL_MAX_RETRIES   : Extra attempts for a failing job (default 2)
+    ETL_RETRY_BACKOFF : Seconds before the first retry, doubled on every retry (default 5)
+'''
+
+import importlib
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = int(os.getenv("ETL_MAX_WORKERS", "3"))
+MAX_RETRIES = int(os.getenv("ETL_MAX_RETRIES", "2"))
+RETRY_BACKOFF = float(os.getenv("ETL_RETRY_BACKOFF", "5"))
+
+
+# ETL modules and the modules they read from (by etl_name, the last part of the module path).
+# shared_scan reads variable_log_float once for the sensor stats, energy, program energy and
+# program history ETLs, "watermarks" lists the etl_names it records progress under.
+# etl_source_coverage runs first so the others can skip empty days, but it is not a hard
+# dependency: without the index they simply process every day.
+ETL_JOBS = [
+    {"module": "backend.scripts.etl_source_coverage", "depends_on": []},
+    {"module": "backend.scripts.shared_scan", "depends_on": [],
+     "watermarks": ["etl_agg_sensor_stats", "etl_agg_energy_daily",
+                    "etl_agg_program_energy", "etl_agg_program_history"]},
+    {"module": "backend.scripts.etl_agg_activity_buckets", "depends_on": []},
+    {"module": "backend.scripts.etl_agg_utilization", "depends_on": ["etl_agg_activity_buckets"]},
+    {"module": "backend.scripts.etl_agg_alerts", "depends_on": []},
+]
+
+
+def job_name(job: dict) -> str:
+    """etl_name of a job, e.g. 'etl_agg_alerts'"""
+    return job["module"].rsplit(".", 1)[-1]
+
+
+def job_watermarks(job: dict) -> List[str]:
+    """etl_names the job records its watermarks under"""
+    return job.get("watermarks", [job_name(job)])
+
+
+def check_dependencies(jobs: List[dict]):
+    """Raise ValueError for unknown dependencies or cycles"""
+    names = {job_name(job) for job in jobs}
+    depends = {job_name(job): set(job["depends_on"]) for job in jobs}
+
+    for name, deps in depends.items():
+        unknown = deps - names
+        if unknown:
+            raise ValueError(f"{name} depends on unknown jobs: {sorted(unknown)}")
+
+    # Kahn's algorithm, whatever cannot be ordered is part of a cycle
+    remaining = dict(depends)
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps & remaining.keys()]
+        if not ready:
+            raise ValueError(f"Dependency cycle between: {sorted(remaining)}")
+        for name in ready:
+            del remaining[name]
+
+
+def run_with_retries(job: dict, start_date, end_date, max_retries: int, backoff: float) -> dict:
+    """
+    Import the module of a job and run its run_etl, retrying with exponential backoff.
+
+    Returns:
+        Result dict with name, status ('ok' or 'failed'), attempts, seconds and error.
+    """
+    name = job_name(job)
+    started = time.perf_counter()
+    error = None
+
+    for attempt in range(1, max_retries + 2):
+        try:
+            module = importlib.import_module(job["module"])
+            module.run_etl(str(start_date), str(end_date), resume=True)
+            return {"name": name, "status": "ok", "attempts": attempt,
+                    "seconds": time.perf_counter() - started, "error": None}
+        except Exception as e:
+            error = str(e)
+            if attempt <= max_retries:
+                delay = backoff * 2 ** (attempt - 1)
+                logger.warning(f"{name} failed (attempt {attempt}): {error}. Retrying in {delay:.1f} s")
+                time.sleep(delay)
+            else:
+                logger.error(f"{name} failed after {attempt} attempts: {error}")
+
+    return {"name": name, "status": "failed", "attempts": max_retries + 1,
+            "seconds": time.perf_counter() - started, "error": error}
+
+
+def run_jobs(
+    jobs: List[dict],
+    date_range: Callable[[dict], Optional[Tuple]],
+    max_workers: int = MAX_WORKERS,
+    max_retries: int = MAX_RETRIES,
+    backoff: float = RETRY_BACKOFF
+) -> Dict[str, dict]:
+    """
+    Run the jobs in a thread pool, each one after the jobs it depends on.
+
+    Params:
+        jobs:        Job dicts with module and depends_on (see ETL_JOBS)
+        date_range:  Function job -> (start_date, end_date), or None if the job has nothing to do
+        max_workers: Jobs running at the same time
+        max_retries: Extra attempts for a failing job
+        backoff:     Seconds before the first retry, doubled on every retry
+
+    Returns:
+        Dict of etl_name -> result dict (status 'ok', 'failed', 'skipped' or 'up_to_date').
+    """
+    check_dependencies(jobs)
+
+    pending = {job_name(job): job for job in jobs}
+    results: Dict[str, dict] = {}
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            # Start every job whose dependencies are all finished
+            for name, job in list(pending.items()):
+                deps = job["depends_on"]
+                if any(dep not in results for dep in deps):
+                    continue
+                del pending[name]
+
+                failed = [dep for dep in deps if results[dep]["status"] in ("failed", "skipped")]
+                if failed:
+                    results[name] = {"name": name, "status": "skipped", "attempts": 0, "seconds": 0.0,
+                                     "error": f"dependency failed: {', '.join(failed)}"}
+                    continue
+
+                dates = date_range(job)
+                if dates is None:
+                    results[name] = {"name": name, "status": "up_to_date", "attempts": 0,
+                                     "seconds": 0.0, "error": None}
+                    continue
+
+                logger.info(f"Starting {name} for {dates[0]} to {dates[1]}")
+                future = pool.submit(run_with_retries, job, dates[0], dates[1], max_retries, backoff)
+                running[future] = name
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+
+    return results
+
+
+def print_report(results: Dict[str, dict]):
+    """Per-module status, attempts and wall time"""
+    print(f"\n{'module':<30} {'status':<11} {'attempts':>8} {'seconds':>9}")
+    print("-" * 61)
+    for result in results.values():
+        print(f"{result['name']:<30} {result['status']:<11} {result['attempts']:>8} {result['seconds']:>9.1f}")
+        if result["error"]:
+            print(f"    {result['error']}")
+    print("-" * 61)
+    print(f"{'total (sum of jobs)':<51} {sum(r['seconds'] for r in results.values()):>9.1f}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    workers = MAX_WORKERS
+    for arg in sys.argv[1:]:
+        if arg.startswith("--workers="):
+            workers = int(arg.split("=", 1)[1])
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+
+    if len(args) not in (1, 2):
+        print("Usage: python -m backend.scripts.etl_orchestrator start_date [end_date] [--workers=N]")
+        sys.exit(1)
+
+    start, end = args[0], args[-1]
+    started = time.perf_counter()
+    results = run_jobs(ETL_JOBS, lambda job: (start, end), max_workers=workers)
+    print_report(results)
+    print(f"Wall time: {time.perf_counter() - started:.1f} s")
+
+    sys.exit(1 if any(r["status"] == "failed" for r in results.values()) else 0)
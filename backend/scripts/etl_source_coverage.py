@@ -0,0 +1,282 @@
+'''
+ETL (Extract, Transform and Load) script for the source coverage index.
+Counts the raw log entries of the tracked variables (the ones the other ETLs read, see
+tracked_variables()) in variable_log_float and variable_log_string per UTC day, with the first
+and last raw timestamp, into source_coverage. Only the (id_var, date) index ranges of these
+variables are read, never the rows of the other variables.
+
+The other ETLs read the index through day_rows() before extracting: the ETLs that start fresh
+every day skip the days the index knows to be empty for their variables, without querying the
+production server, and the rows per day close the work windows early on busy days (see
+etl_watermark.pending_windows). ETLs that carry state across days (energy, program energy) only
+use it to size their windows. Days that are not indexed yet (and today, which is still growing)
+are never skipped. The API date picker (v_data_status, /api/v1/available_dates) reads the same table.
+
+The index is maintained incrementally: with --resume only the days that are not indexed yet
+are counted, plus today. Windows whose days are all in the local raw cache are counted there.
+
+Usage:
+    python -m backend.scripts.etl_source_coverage                       # Full backfill
+    python -m backend.scripts.etl_source_coverage 2021-09-14            # Single day
+    python -m backend.scripts.etl_source_coverage 2021-09-01 2021-09-30 # Date range
+    python -m backend.scripts.etl_source_coverage 2021-09-01 2021-09-30 --resume
+
+Args:
+    start_date: Start date (optional). If missing, processes all available data.
+    end_date:   End date (optional). If missing, processes single day (start_date).
+    --resume:   Only count the days not indexed yet (and today).
+'''
+
+import logging
+import sys
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+from backend.database import prod_engine, agg_engine
+from backend.models import SourceCoverage
+from backend.scripts.bulk_loader import replace_days
+from backend.scripts.etl_common import day_bounds_ms, ms_to_day, days_in_range, parse_date
+from backend.scripts import etl_watermark, raw_cache
+
+logger = logging.getLogger(__name__)
+
+ETL_NAME = 'etl_source_coverage'
+
+# Days per extraction query
+COVERAGE_WINDOW_DAYS = 7
+
+MS_PER_DAY = etl_watermark.MS_PER_DAY
+
+
+def get_date_range():
+    '''
+    Query the source DB for the min and max dates when no dates are provided.
+    Used for full backfill.
+    '''
+    try:
+        with prod_engine.connect() as conn:
+            row = conn.execute(text('''
+                SELECT MIN(min_ms) AS min_ms, MAX(max_ms) AS max_ms
+                FROM (
+                    SELECT MIN(date) AS min_ms, MAX(date) AS max_ms FROM variable_log_float
+                    UNION ALL
+                    SELECT MIN(date), MAX(date) FROM variable_log_string
+                ) bounds
+            ''')).fetchone()
+            if row and row.min_ms is not None and row.max_ms is not None:
+                return str(ms_to_day(row.min_ms)), str(ms_to_day(row.max_ms))
+            return None, None
+    except Exception as e:
+        logger.error(f"Failed to get date range: {str(e)}")
+        raise
+
+
+def combine_tables(counts, keys):
+    '''
+    Add up the per-table counts of rows with the same keys (e.g. bucket_ms and id_var).
+
+    Returns:
+        List of dicts with the keys, readings_count, first_ms and last_ms, ordered by the keys.
+    '''
+    combined = {}
+    for row in counts:
+        key = tuple(row[name] for name in keys)
+        total = combined.get(key)
+        if total is None:
+            combined[key] = {**{name: row[name] for name in keys}, 'readings_count': row['readings_count'],
+                             'first_ms': row['first_ms'], 'last_ms': row['last_ms']}
+        else:
+            total['readings_count'] += row['readings_count']
+            total['first_ms'] = min(total['first_ms'], row['first_ms'])
+            total['last_ms'] = max(total['last_ms'], row['last_ms'])
+    return [combined[key] for key in sorted(combined)]
+
+
+def tracked_variables():
+    '''Production variable ids the ETLs read, the variables the index counts'''
+    # Imported here, the ETL modules import this module for day_rows()
+    from backend.scripts.etl_dirty_partitions import etl_source_variables
+    return sorted(set().union(*etl_source_variables().values()))
+
+
+def extract_counts(start_date, end_date, bucket_ms, by_variable=False, id_vars=None):
+    '''
+    Count the log entries of a range of days per table and time bucket (and variable),
+    from the raw cache when every day is cached, otherwise on the production server.
+    Each table is aggregated on its own; the sum of the dates is kept for the fingerprints.
+    With id_vars only these variables are counted (None for all variables).
+
+    Returns:
+        List of dicts with table, bucket_ms, readings_count, first_ms, last_ms and sum_ms (and id_var).
+    '''
+    cached = raw_cache.bucket_counts(start_date, end_date, bucket_ms, by_variable, id_vars)
+    if cached is not None:
+        return cached
+
+    variable_column = "id_var," if by_variable else ""
+    var_filter = "AND id_var = ANY(:id_vars)" if id_vars is not None else ""
+    group_by = "1, 2" if by_variable else "1"
+    start_ms, end_ms = day_bounds_ms(start_date, end_date)
+    try:
+        counts = []
+        with prod_engine.connect() as conn:
+            for table in etl_watermark.SOURCE_TABLES:
+                query = f'''
+                SELECT
+                    date / {int(bucket_ms)} AS bucket,
+                    {variable_column}
+                    COUNT(*) AS cnt,
+                    MIN(date) AS first_ms,
+                    MAX(date) AS last_ms,
+                    SUM(date) AS sum_ms
+                FROM {table}
+                WHERE date >= :start_ms AND date < :end_ms
+                {var_filter}
+                GROUP BY {group_by};
+                '''
+                rows = conn.execute(text(query), {
+                    'start_ms': start_ms, 'end_ms': end_ms,
+                    'id_vars': list(id_vars) if id_vars is not None else None
+                }).fetchall()
+
+                for row in rows:
+                    row_counts = {
+                        'table': table,
+                        'bucket_ms': int(row.bucket) * bucket_ms,
+                        'readings_count': int(row.cnt),
+                        'first_ms': row.first_ms,
+                        'last_ms': row.last_ms,
+                        'sum_ms': int(row.sum_ms)
+                    }
+                    if by_variable:
+                        row_counts['id_var'] = row.id_var
+                    counts.append(row_counts)
+        return counts
+
+    except Exception as e:
+        logger.error(f"Extraction failed for {start_date} to {end_date or start_date}: {str(e)}")
+        raise
+
+
+def extract_data(start_date, end_date=None, id_vars=None):
+    '''
+    Count the log entries per day and variable of a range of days.
+    id_vars defaults to tracked_variables().
+
+    Returns:
+        (rows, fingerprints): list of dicts with dt, id_var, readings_count, first_ms and last_ms,
+        and the source fingerprint of every day, derived from the same counts.
+    '''
+    end_date = end_date or start_date
+    if id_vars is None:
+        id_vars = tracked_variables()
+    counts = extract_counts(start_date, end_date, MS_PER_DAY, by_variable=True, id_vars=id_vars)
+    rows = [
+        {
+            'dt': ms_to_day(row['bucket_ms']),
+            'id_var': row['id_var'],
+            'readings_count': row['readings_count'],
+            'first_ms': row['first_ms'],
+            'last_ms': row['last_ms']
+        }
+        for row in combine_tables(counts, ['bucket_ms', 'id_var'])
+    ]
+    return rows, etl_watermark.count_fingerprints(start_date, end_date, counts)
+
+
+def load_data(data, days):
+    '''
+    Load the counts into the aggregated database.
+    Replaces all rows of the given days, so re-running a range is idempotent.
+    '''
+    try:
+        return replace_days(SourceCoverage, data, day_column='dt', days=days,
+                            columns=['dt', 'id_var', 'readings_count', 'first_ms', 'last_ms'])
+    except Exception as e:
+        logger.error(f"Load failed: {str(e)}")
+        raise
+
+
+def day_rows(start_date, end_date, id_vars=None):
+    '''
+    Raw log entries per day from the coverage index, for the days it has indexed.
+
+    Params:
+        id_vars: Only count these variables (None for all tracked variables)
+
+    Returns:
+        Dict day -> readings (0 for indexed days without data). Days that are not indexed yet
+        and days from today on are left out, the callers treat them as unknown.
+    '''
+    params = {
+        'etl_name': ETL_NAME, 'done': etl_watermark.STATUS_DONE,
+        'start_day': parse_date(start_date), 'end_day': parse_date(end_date)
+    }
+    var_filter = ""
+    if id_vars is not None:
+        var_filter = "AND c.id_var = ANY(:id_vars)"
+        params['id_vars'] = list(id_vars)
+
+    with agg_engine.connect() as conn:
+        rows = conn.execute(text(f'''
+            SELECT w.partition_date AS dt, COALESCE(SUM(c.readings_count), 0) AS readings
+            FROM etl_watermark w
+            LEFT JOIN source_coverage c
+                ON c.dt = w.partition_date
+                {var_filter}
+            WHERE w.etl_name = :etl_name
+            AND w.status = :done
+            AND w.partition_date BETWEEN :start_day AND :end_day
+            GROUP BY w.partition_date
+        '''), params).fetchall()
+
+    today = datetime.now(timezone.utc).date()
+    return {row.dt: int(row.readings) for row in rows if row.dt < today}
+
+
+def run_etl(start_date=None, end_date=None, resume=False, window_days=COVERAGE_WINDOW_DAYS):
+    '''
+    Main orchestration function.
+    '''
+    if start_date is None:
+        logger.info("No dates provided, fetching full date range...")
+        start_date, end_date = get_date_range()
+        if not start_date:
+            logger.error("Could not determine date range from database")
+            return
+        logger.info(f"Full backfill from {start_date} to {end_date}")
+    elif end_date is None:
+        logger.info(f"Processing single day: {start_date}")
+        end_date = start_date
+    else:
+        logger.info(f"Processing range: {start_date} to {end_date}")
+
+    # Today is still growing, it is counted again on every run
+    today = datetime.now(timezone.utc).date()
+    days = etl_watermark.pending_days(ETL_NAME, start_date, end_date, resume)
+    days = sorted(set(days) | {day for day in days_in_range(start_date, end_date) if day >= today})
+
+    id_vars = tracked_variables()
+    total_records = 0
+    for first_day, last_day in etl_watermark.group_windows(days, window_days):
+        # Fingerprints from the extracted counts, the logs are read only once
+        with etl_watermark.track(ETL_NAME, first_day, last_day, fingerprints_from_data=True) as partition:
+            data, partition.fingerprints = extract_data(first_day, last_day, id_vars)
+            total_records += load_data(data, days_in_range(first_day, last_day))
+            partition.add_rows(data, 'dt')
+
+    logger.info(f"ETL complete. Total coverage rows loaded: {total_records}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    resume = '--resume' in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if len(args) == 1:
+        run_etl(args[0], resume=resume)
+    elif len(args) == 2:
+        run_etl(args[0], args[1], resume=resume)
+    else:
+        run_etl(resume=resume)
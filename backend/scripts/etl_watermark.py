@@ -0,0 +1,390 @@
+'''
+Per-ETL watermarks, stored in the etl_watermark table of the aggregation DB.
+
+Every ETL records, for each day (partition) it processes, the epoch-ms range it covered,
+how many rows it loaded, a fingerprint of the source rows of that day and a status
+('running', 'done', 'failed' or 'stale'). A crashed or failed run leaves its days 'running'/'failed',
+and days whose source rows changed afterwards are marked 'stale' (see etl_dirty_partitions.py),
+so the next run with resume=True processes exactly the days that are not 'done' yet.
+Each ETL keeps its own watermarks, one lagging ETL no longer holds back (or re-runs) the others.
+
+    EXAMPLE BELOW:
+    for first_day, last_day in pending_windows('etl_agg_alerts', start, end, 31, resume=True):
+        with track('etl_agg_alerts', first_day, last_day, id_vars=[447]) as partition:
+            ...
+            partition.add_rows(records, 'day')
+'''
+
+import hashlib
+import logging
+import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from backend.database import prod_engine, agg_engine
+from backend.models import EtlWatermark
+from backend.scripts.bulk_loader import upsert
+from backend.scripts.etl_common import catalog, parse_date, day_bounds_ms, ms_to_day, days_in_range, iter_windows
+from backend.scripts import raw_cache
+
+logger = logging.getLogger(__name__)
+
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_STALE = 'stale'      # The source changed after the day was processed (etl_dirty_partitions.py)
+
+MS_PER_DAY = 86400 * 1000
+
+SOURCE_TABLES = ('variable_log_float', 'variable_log_string')
+
+# Source rows per window at most, when the rows per day are known (a single day may exceed it)
+WINDOW_MAX_ROWS = int(os.getenv("ETL_WINDOW_MAX_ROWS", "5000000"))
+
+
+# SOURCE FINGERPRINTS
+def variable_ids(names):
+    '''Production variable ids for a list of variable names'''
+    return list(catalog.ids_of(names).values())
+
+
+def _fingerprint(day_parts):
+    return hashlib.sha1('|'.join(day_parts).encode()).hexdigest()[:16]
+
+
+# Fingerprint of a day without source rows
+EMPTY_FINGERPRINT = _fingerprint([])
+
+
+def source_fingerprints(start_day, end_day, id_vars=None, cache=False):
+    '''
+    Fingerprint of the source rows of every day from start_day to end_day (inclusive).
+
+    Built from the row count, the latest date and the sum of the dates per day and table,
+    which changes whenever rows are added, removed or re-timestamped, and only needs the
+    (id_var, date) index. With id_vars=None every variable is included.
+    ETLs that read the raw cache pass cache=True: a table whose days are all cached is
+    fingerprinted from the cache, the copy the ETL actually reads.
+
+    Returns:
+        Dict of day -> fingerprint (16 hex characters), also for days without rows.
+    '''
+    start_ms, end_ms = day_bounds_ms(start_day, end_day)
+    var_filter = "AND id_var = ANY(:id_vars)" if id_vars is not None else ""
+
+    stats = []
+    with prod_engine.connect() as conn:
+        for table in SOURCE_TABLES:
+            cached = raw_cache.day_stats(table, start_day, end_day, id_vars) if cache else None
+            if cached is not None:
+                stats += [(day, table, n, max_ms, sum_ms) for day, (n, max_ms, sum_ms) in cached.items()]
+                continue
+
+            rows = conn.execute(text(f'''
+                SELECT
+                    date / {MS_PER_DAY} AS day_index,
+                    COUNT(*) AS n,
+                    MAX(date) AS max_ms,
+                    SUM(date) AS sum_ms
+                FROM {table}
+                WHERE date >= :start_ms AND date < :end_ms
+                {var_filter}
+                GROUP BY 1
+                ORDER BY 1
+            '''), {'start_ms': start_ms, 'end_ms': end_ms, 'id_vars': id_vars}).fetchall()
+
+            stats += [(ms_to_day(row.day_index * MS_PER_DAY), table, row.n, row.max_ms, int(row.sum_ms)) for row in rows]
+
+    return _day_fingerprints(days_in_range(start_day, end_day), stats)
+
+
+def variable_fingerprint_parts(start_day, end_day, id_vars=None, tables=SOURCE_TABLES):
+    '''
+    Row count, latest date and sum of the dates per day, table and variable, in one pass
+    per table. The source fingerprints of any set of variables are derived from them with
+    combine_fingerprints(), so checking every ETL does not need a query per ETL.
+    id_vars and tables restrict the variables (None for all) and the tables read.
+
+    Returns:
+        Dict of day -> {(table, id_var): (n, max_ms, sum_ms)}, also for days without rows.
+    '''
+    start_ms, end_ms = day_bounds_ms(start_day, end_day)
+    var_filter = "AND id_var = ANY(:id_vars)" if id_vars is not None else ""
+
+    parts = {day: {} for day in days_in_range(start_day, end_day)}
+    with prod_engine.connect() as conn:
+        for table in tables:
+            rows = conn.execute(text(f'''
+                SELECT
+                    date / {MS_PER_DAY} AS day_index,
+                    id_var,
+                    COUNT(*) AS n,
+                    MAX(date) AS max_ms,
+                    SUM(date) AS sum_ms
+                FROM {table}
+                WHERE date >= :start_ms AND date < :end_ms
+                {var_filter}
+                GROUP BY 1, 2
+            '''), {'start_ms': start_ms, 'end_ms': end_ms,
+                   'id_vars': list(id_vars) if id_vars is not None else None}).fetchall()
+
+            for row in rows:
+                parts[ms_to_day(row.day_index * MS_PER_DAY)][(table, row.id_var)] = (row.n, row.max_ms, int(row.sum_ms))
+
+    return parts
+
+
+def _day_fingerprints(days, stats):
+    # Fingerprint of every day from (day, table, n, max_ms, sum_ms) rows, rows of one day and table are added up
+    totals = {day: {} for day in days}
+    for day, table, n, max_ms, sum_ms in stats:
+        if table in totals[day]:
+            total_n, total_max, total_sum = totals[day][table]
+            totals[day][table] = (total_n + n, max(total_max, max_ms), total_sum + sum_ms)
+        else:
+            totals[day][table] = (n, max_ms, sum_ms)
+
+    fingerprints = {}
+    for day, by_table in totals.items():
+        day_parts = []
+        for table in SOURCE_TABLES:
+            if table in by_table:
+                n, max_ms, sum_ms = by_table[table]
+                day_parts.append(f"{table}:{n}:{max_ms}:{int(sum_ms)}")
+        fingerprints[day] = _fingerprint(day_parts)
+    return fingerprints
+
+
+def combine_fingerprints(parts, id_vars=None):
+    '''
+    Source fingerprints of the variables id_vars (None for all) from variable_fingerprint_parts(),
+    the same values source_fingerprints() returns for them.
+    '''
+    wanted = set(id_vars) if id_vars is not None else None
+    return _day_fingerprints(parts, [
+        (day, table, n, max_ms, sum_ms)
+        for day, by_variable in parts.items()
+        for (table, id_var), (n, max_ms, sum_ms) in by_variable.items()
+        if wanted is None or id_var in wanted
+    ])
+
+
+def count_fingerprints(start_day, end_day, counts):
+    '''
+    Source fingerprints of all variables from the per-table counts an ETL already extracted,
+    the same values source_fingerprints() returns, without reading the logs a second time.
+
+    Params:
+        counts: Dicts with table, bucket_ms, readings_count, last_ms and sum_ms, buckets
+                within a day (e.g. 10-minute or per-variable counts of the whole day)
+    '''
+    return _day_fingerprints(days_in_range(start_day, end_day), [
+        (ms_to_day(row['bucket_ms']), row['table'], row['readings_count'], row['last_ms'], row['sum_ms'])
+        for row in counts
+    ])
+
+
+# WATERMARK STATE
+def stored_fingerprints(etl_name, start_day, end_day):
+    '''Source fingerprints recorded by etl_name for its 'done' days from start_day to end_day'''
+    with agg_engine.connect() as conn:
+        rows = conn.execute(text('''
+            SELECT partition_date, source_fingerprint
+            FROM etl_watermark
+            WHERE etl_name = :etl_name
+            AND status = :done
+            AND partition_date BETWEEN :start_day AND :end_day
+        '''), {
+            'etl_name': etl_name, 'done': STATUS_DONE,
+            'start_day': parse_date(start_day), 'end_day': parse_date(end_day)
+        }).fetchall()
+    return {row.partition_date: row.source_fingerprint for row in rows}
+
+
+def partition_states(etl_name, start_day, end_day):
+    '''Dict day -> (status, source_fingerprint) of the watermarks of etl_name from start_day to end_day'''
+    with agg_engine.connect() as conn:
+        rows = conn.execute(text('''
+            SELECT partition_date, status, source_fingerprint
+            FROM etl_watermark
+            WHERE etl_name = :etl_name
+            AND partition_date BETWEEN :start_day AND :end_day
+        '''), {
+            'etl_name': etl_name, 'start_day': parse_date(start_day), 'end_day': parse_date(end_day)
+        }).fetchall()
+    return {row.partition_date: (row.status, row.source_fingerprint) for row in rows}
+
+
+def completed_days(etl_name, start_day, end_day):
+    '''Days between start_day and end_day (inclusive) already processed by etl_name'''
+    with agg_engine.connect() as conn:
+        rows = conn.execute(text('''
+            SELECT partition_date
+            FROM etl_watermark
+            WHERE etl_name = :etl_name
+            AND status = :done
+            AND partition_date BETWEEN :start_day AND :end_day
+        '''), {
+            'etl_name': etl_name, 'done': STATUS_DONE,
+            'start_day': parse_date(start_day), 'end_day': parse_date(end_day)
+        }).fetchall()
+    return {row.partition_date for row in rows}
+
+
+def pending_days(etl_name, start_day, end_day, resume=False):
+    '''
+    Days from start_day to end_day (inclusive) to process, in order.
+    With resume=True the days already 'done' for etl_name are left out.
+    '''
+    days = days_in_range(start_day, end_day)
+    if not resume:
+        return days
+
+    done = completed_days(etl_name, start_day, end_day)
+    if done:
+        logger.info(f"{etl_name}: skipping {len(done)} days already processed")
+    return [day for day in days if day not in done]
+
+
+def pending_windows(etl_name, start_day, end_day, window_days, resume=False, day_rows=None, skip_empty=True):
+    '''
+    Windows of at most window_days consecutive days to process.
+    With resume=True the days already 'done' for etl_name are left out, otherwise
+    this is the same as iter_windows(). Yields (first_day, last_day) tuples, both inclusive.
+
+    day_rows (from etl_source_coverage.day_rows()) gives the source rows of the days indexed by
+    the coverage ETL: days with 0 rows are left out and windows are closed at WINDOW_MAX_ROWS.
+    ETLs that carry values across days (energy, program energy) pass skip_empty=False: a day
+    without rows still gets the value held from the day before.
+    '''
+    if not resume and day_rows is None:
+        yield from iter_windows(start_day, end_day, window_days)
+        return
+
+    days = pending_days(etl_name, start_day, end_day, resume)
+    if day_rows is not None and skip_empty:
+        empty = [day for day in days if day_rows.get(day) == 0]
+        if empty:
+            logger.info(f"{etl_name}: skipping {len(empty)} days without source data")
+            days = [day for day in days if day_rows.get(day) != 0]
+
+    yield from group_windows(days, window_days, day_rows)
+
+
+def group_windows(days, window_days, day_rows=None, max_rows=WINDOW_MAX_ROWS):
+    '''
+    Group sorted days into windows of at most window_days consecutive days.
+    Yields (first_day, last_day) tuples, a gap between two days always starts a new window.
+    With day_rows (day -> source rows) a window is also closed once it holds max_rows rows.
+    '''
+    run = []
+    run_rows = 0
+    for day in days:
+        rows = day_rows.get(day, 0) if day_rows else 0
+        if run and ((day - run[-1]).days != 1 or run_rows + rows > max_rows):
+            yield run[0], run[-1]
+            run, run_rows = [], 0
+        run.append(day)
+        run_rows += rows
+        if len(run) == window_days:
+            yield run[0], run[-1]
+            run, run_rows = [], 0
+    if run:
+        yield run[0], run[-1]
+
+
+def resume_date(etl_name):
+    '''
+    First day etl_name has to process next: its earliest day that is not 'done',
+    else the day after its latest 'done' day. None if the ETL has no watermarks yet.
+    '''
+    with agg_engine.connect() as conn:
+        row = conn.execute(text('''
+            SELECT
+                MIN(partition_date) FILTER (WHERE status <> :done) AS first_open,
+                MAX(partition_date) FILTER (WHERE status = :done) AS last_done
+            FROM etl_watermark
+            WHERE etl_name = :etl_name
+        '''), {'etl_name': etl_name, 'done': STATUS_DONE}).fetchone()
+
+    if row is None:
+        return None
+    if row.first_open is not None:
+        return row.first_open
+    if row.last_done is not None:
+        return row.last_done + timedelta(days=1)
+    return None
+
+
+def save_watermarks(etl_name, days, status, rows_by_day=None, fingerprints=None):
+    '''Upsert the watermark of every day with the given status'''
+    now = datetime.now()
+    records = []
+    for day in days:
+        start_ms, end_ms = day_bounds_ms(day)
+        record = {
+            'etl_name': etl_name,
+            'partition_date': day,
+            'range_start_ms': start_ms,
+            'range_end_ms': end_ms,
+            'status': status,
+            'updated_at': now
+        }
+        if rows_by_day is not None:
+            record['rows_loaded'] = rows_by_day.get(day, 0)
+        if fingerprints is not None:
+            record['source_fingerprint'] = fingerprints.get(day)
+        records.append(record)
+
+    return upsert(EtlWatermark, records, conflict_columns=['etl_name', 'partition_date'])
+
+
+class PartitionRun:
+    '''Rows loaded per day during one tracked window'''
+
+    def __init__(self, days):
+        self.days = days
+        self.rows_by_day = {day: 0 for day in days}
+        # Set by the block when track() is called with fingerprints_from_data=True
+        self.fingerprints = None
+
+    def add_rows(self, records, day_key):
+        '''Count loaded records per day, day_key holds a date or a datetime'''
+        for record in records:
+            value = record[day_key]
+            day = value.date() if isinstance(value, datetime) else value
+            if day in self.rows_by_day:
+                self.rows_by_day[day] += 1
+
+
+@contextmanager
+def track(etl_name, first_day, last_day, id_vars=None, fingerprints=None, fingerprints_from_data=False):
+    '''
+    Record the processing of first_day..last_day for etl_name.
+
+    The source fingerprints are taken before the ETL reads the source, so rows arriving
+    during the run make the day look changed instead of silently covered.
+    ETLs that only read aggregated tables pass the fingerprints of their input stage instead
+    (see stored_fingerprints), so they never touch the raw logs.
+    With fingerprints_from_data=True nothing is read up front: the block sets
+    partition.fingerprints from the counts it extracted (see count_fingerprints).
+    The days are marked 'running' on entry, 'done' with their row counts on success,
+    and 'failed' if the block raises (the exception is re-raised).
+    '''
+    days = days_in_range(first_day, last_day)
+    if fingerprints is None and not fingerprints_from_data:
+        fingerprints = source_fingerprints(first_day, last_day, id_vars)
+    save_watermarks(etl_name, days, STATUS_RUNNING)
+
+    partition = PartitionRun(days)
+    try:
+        yield partition
+    except Exception:
+        save_watermarks(etl_name, days, STATUS_FAILED)
+        raise
+
+    if fingerprints_from_data:
+        fingerprints = partition.fingerprints
+    save_watermarks(etl_name, days, STATUS_DONE, partition.rows_by_day, fingerprints)
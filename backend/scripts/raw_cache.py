@@ -0,0 +1,268 @@
+'''
+Local columnar cache of the raw production logs.
+
+Closed days (before today, UTC) of variable_log_float and variable_log_string never change, so
+they are mirrored once into zstd-compressed Parquet files and read locally afterwards:
+
+    RAW_CACHE_DIR/variable_log_float/2022-02-23.parquet
+    RAW_CACHE_DIR/variable_log_string/2022-02-23.parquet
+
+Each file holds one table-day with the columns id_var, date (epoch ms) and value, sorted by
+(id_var, date) and written in small row groups. Instead of one file per variable and day
+(thousands of tiny files), the row group statistics on id_var let a read of a few variables
+skip the rest of the day.
+
+The extract stages (shared_scan.py, the alerts ETL and the activity buckets) call read_table()
+first and only query the production server when a day of the window is not cached.
+pyarrow is optional: without it available() is False and everything reads from production.
+
+Rows can still arrive late for a closed day. The ETLs that read the cache take their source
+fingerprints from it too (day_stats), so a stale copy shows up as a changed day in
+etl_dirty_partitions.py, which copies the day again (refresh) before it is re-aggregated.
+
+    EXAMPLE BELOW:
+    python -m backend.scripts.raw_cache fill 2021-01-01 2022-02-23
+    python -m backend.scripts.raw_cache status 2022-02-01 2022-02-28
+
+Settings (environment):
+    RAW_CACHE_DIR : Cache directory (default backend/raw_cache)
+'''
+
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+from backend.database import prod_engine
+from backend.scripts.etl_common import day_bounds_ms, days_in_range, parse_date
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.getenv("RAW_CACHE_DIR", os.path.join(os.path.dirname(__file__), "..", "raw_cache"))
+
+TABLES = ('variable_log_float', 'variable_log_string')
+
+# Rows per row group, small enough that most variables of a day get their own groups
+ROW_GROUP_SIZE = 20000
+
+
+def available():
+    '''True if pyarrow is installed'''
+    return pa is not None
+
+
+def _schema(table):
+    # float64 like the value::float8 of the production reads, so cached windows give the same results
+    value_type = pa.float64() if table == 'variable_log_float' else pa.string()
+    return pa.schema([('id_var', pa.int32()), ('date', pa.int64()), ('value', value_type)])
+
+
+def day_path(table, day):
+    return os.path.join(CACHE_DIR, table, f"{parse_date(day)}.parquet")
+
+
+def is_closed(day):
+    '''Only days before today (UTC) are complete and can be cached'''
+    return parse_date(day) < datetime.now(timezone.utc).date()
+
+
+def is_cached(table, day):
+    return os.path.exists(day_path(table, day))
+
+
+def missing_days(table, start_day, end_day):
+    '''Closed days of the range that are not cached yet'''
+    return [day for day in days_in_range(start_day, end_day) if is_closed(day) and not is_cached(table, day)]
+
+
+# FILL
+def fill_day(table, day):
+    '''
+    Copy one closed table-day from production into the cache.
+    Written to a temporary file first, so a crash never leaves a partial day behind.
+    Returns the number of rows cached.
+    '''
+    start_ms, end_ms = day_bounds_ms(day)
+    with prod_engine.connect() as conn:
+        rows = conn.execute(text(f'''
+            SELECT id_var, date, value
+            FROM {table}
+            WHERE date >= :start_ms AND date < :end_ms
+            ORDER BY id_var, date
+        '''), {'start_ms': start_ms, 'end_ms': end_ms}).fetchall()
+
+    schema = _schema(table)
+    arrow_table = pa.table(
+        [pa.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)],
+        schema=schema
+    )
+
+    path = day_path(table, day)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(arrow_table, path + ".tmp", compression="zstd", row_group_size=ROW_GROUP_SIZE)
+    os.replace(path + ".tmp", path)
+    return len(rows)
+
+
+def fill(start_day, end_day=None, tables=TABLES):
+    '''
+    Cache every closed day of the range that is not cached yet (incremental).
+    Returns the number of table-days written.
+    '''
+    if not available():
+        raise RuntimeError("pyarrow is not installed, the raw cache is not available")
+
+    written = 0
+    for table in tables:
+        for day in missing_days(table, start_day, end_day or start_day):
+            rows = fill_day(table, day)
+            written += 1
+            logger.info(f"Cached {table} {day}: {rows} rows")
+    return written
+
+
+def refresh(days, tables=TABLES):
+    '''
+    Copy the cached table-days among days from production again, e.g. when late rows
+    made them stale (etl_dirty_partitions.py). Days that are not cached are left out.
+    Returns the number of table-days written.
+    '''
+    if not available():
+        return 0
+
+    written = 0
+    for table in tables:
+        for day in days:
+            if is_cached(table, day):
+                rows = fill_day(table, day)
+                written += 1
+                logger.info(f"Refreshed {table} {day}: {rows} rows")
+    return written
+
+
+# READ
+def read_table(table, start_day, end_day=None, id_vars=None, columns=None):
+    '''
+    Rows of a table for a range of days from the cache, or None if pyarrow is missing
+    or any day of the range is not cached (the caller then reads from production).
+
+    Params:
+        table:   'variable_log_float' or 'variable_log_string'
+        id_vars: Only these variables (None for all)
+        columns: Only these columns (None for id_var, date and value)
+
+    Returns:
+        pyarrow Table sorted by date.
+    '''
+    if not available():
+        return None
+
+    days = days_in_range(start_day, end_day or start_day)
+    if not all(is_cached(table, day) for day in days):
+        return None
+
+    filters = [('id_var', 'in', list(id_vars))] if id_vars is not None else None
+    parts = [pq.read_table(day_path(table, day), columns=columns, filters=filters) for day in days]
+    result = pa.concat_tables(parts)
+    return result.sort_by([('date', 'ascending')])
+
+
+def read_rows(table, start_day, end_day=None, id_vars=None):
+    '''Same as read_table(), as a list of (id_var, date, value) tuples'''
+    result = read_table(table, start_day, end_day, id_vars)
+    if result is None:
+        return None
+    return list(zip(*(result.column(name).to_pylist() for name in ('id_var', 'date', 'value'))))
+
+
+def day_stats(table, start_day, end_day=None, id_vars=None):
+    '''
+    Row count, latest date and sum of the dates per day of a table, from the cache, or None
+    if any day is not cached (same rule as read_table()). See etl_watermark.source_fingerprints.
+
+    Returns:
+        Dict day -> (n, max_ms, sum_ms), days without rows are left out.
+    '''
+    if not available():
+        return None
+
+    days = days_in_range(start_day, end_day or start_day)
+    if not all(is_cached(table, day) for day in days):
+        return None
+
+    filters = [('id_var', 'in', list(id_vars))] if id_vars is not None else None
+    stats = {}
+    for day in days:
+        dates = pq.read_table(day_path(table, day), columns=['date'], filters=filters).column('date')
+        if len(dates):
+            # Summed as offsets from midnight, a day of epoch ms would overflow int64
+            day_start, _ = day_bounds_ms(day)
+            offsets = pc.sum(pc.subtract(dates, day_start)).as_py()
+            stats[day] = (len(dates), pc.max(dates).as_py(), len(dates) * day_start + offsets)
+    return stats
+
+
+def bucket_counts(start_day, end_day, bucket_ms, by_variable=False, id_vars=None):
+    '''
+    Log entries per table and time bucket, from the cache (None if not fully cached).
+    With by_variable=True the entries are counted per table, bucket and variable,
+    with id_vars only these variables are counted (None for all).
+
+    Returns:
+        List of dicts with table, bucket_ms, readings_count, first_ms, last_ms and sum_ms
+        (the sum of the dates, for etl_watermark.count_fingerprints) and id_var.
+    '''
+    columns = ['id_var', 'date'] if by_variable else ['date']
+    tables = {}
+    for table in TABLES:
+        result = read_table(table, start_day, end_day, id_vars, columns=columns)
+        if result is None:
+            return None
+        tables[table] = result.cast(pa.schema([(name, pa.int64()) for name in columns]))
+
+    keys = ['bucket', 'id_var'] if by_variable else ['bucket']
+    buckets = []
+    for table, result in tables.items():
+        bucket = pc.multiply(pc.divide(result.column('date'), bucket_ms), bucket_ms)
+        # Dates summed as offsets from the bucket start, a day of epoch ms would overflow int64
+        result = result.append_column('bucket', bucket).append_column('offset', pc.subtract(result.column('date'), bucket))
+        grouped = result.group_by(keys).aggregate([('date', 'count'), ('date', 'min'), ('date', 'max'), ('offset', 'sum')])
+
+        for row in grouped.to_pylist():
+            counts = {
+                'table': table,
+                'bucket_ms': row['bucket'],
+                'readings_count': row['date_count'],
+                'first_ms': row['date_min'],
+                'last_ms': row['date_max'],
+                'sum_ms': row['date_count'] * row['bucket'] + row['offset_sum']
+            }
+            if by_variable:
+                counts['id_var'] = row['id_var']
+            buckets.append(counts)
+    return buckets
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) not in (3, 4) or sys.argv[1] not in ('fill', 'status'):
+        print("Usage: python -m backend.scripts.raw_cache fill|status start_date [end_date]")
+        sys.exit(1)
+
+    start, end = sys.argv[2], sys.argv[-1]
+    if sys.argv[1] == 'fill':
+        logger.info(f"Cached {fill(start, end)} table-days in {CACHE_DIR}")
+    else:
+        for table in TABLES:
+            missing = missing_days(table, start, end)
+            print(f"{table}: {len(days_in_range(start, end)) - len(missing)} days cached, {len(missing)} closed days missing")
@@ -0,0 +1,301 @@
+'''
+Shared extraction of variable_log_float for several ETLs.
+
+The sensor stats, energy, program energy and program history ETLs all read variable_log_float
+for the same days, each for its own variables. SharedScan reads a window once, for the union of
+the variable ids of the registered consumers, ordered by time, and hands every batch of rows to
+each consumer (only the rows of its own variables). Consumers that need the last value before the
+window (carry_in = True) first receive one row per variable dated at the window start, read with
+one small index lookup per variable.
+
+A consumer is a ScanConsumer subclass (see the ETL modules) with:
+    etl_name : name of the ETL in etl_watermark
+    id_vars  : production variable ids it needs
+    carry_in : whether it needs the last value before the window
+    consume(rows): called with batches of (id_var, date_ms, value) tuples, ordered by date_ms
+    finish(first_day, last_day): transform and load, returns the loaded records and their day key
+
+When every day of a window is in the local raw cache (raw_cache.py) the rows are read from
+there; the carry-in lookups still go to the production server. The source fingerprints of every
+consumer are counted from the rows the scan dispatched, so they describe exactly what was read.
+
+The utilization input (etl_agg_activity_buckets) is not a consumer: it counts every variable
+in both log tables and aggregates on the server, streaming all rows would cost more than it saves.
+
+    EXAMPLE BELOW:
+    python -m backend.scripts.shared_scan 2022-02-23
+    python -m backend.scripts.shared_scan 2022-02-01 2022-02-28
+    python -m backend.scripts.shared_scan 2022-02-01 2022-02-28 --resume
+'''
+
+import logging
+import os
+import sys
+import time
+from abc import ABC, abstractmethod
+
+from sqlalchemy import text
+
+from backend.database import prod_engine
+from backend.scripts.etl_common import day_bounds_ms, days_in_range, ms_to_day
+from backend.scripts import etl_source_coverage, etl_watermark, raw_cache
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched from the server-side cursor per batch
+SCAN_BATCH_SIZE = int(os.getenv("SCAN_BATCH_SIZE", "50000"))
+
+# Days per shared scan
+SCAN_WINDOW_DAYS = 7
+
+
+class ScanConsumer(ABC):
+    '''Base class of the consumers of a SharedScan, subclasses set etl_name and implement both methods'''
+
+    etl_name = None
+    carry_in = False
+    # id_var -> (low, high): carried-in values outside [low, high) are skipped, like the ETL's own filter
+    carry_in_ranges = {}
+
+    def __init__(self, id_vars):
+        self.id_vars = set(id_vars)
+
+    @abstractmethod
+    def consume(self, rows):
+        '''Take a batch of (id_var, date_ms, value) tuples of its own variables, ordered by date_ms'''
+
+    @abstractmethod
+    def finish(self, first_day, last_day):
+        '''Transform and load the window, returns (loaded records, their day key)'''
+
+
+class SharedScan:
+    """
+    One time-ordered read of variable_log_float per window, dispatched to every consumer.
+
+    Usage:
+        scan = SharedScan()
+        scan.register(SensorStatsConsumer())
+        scan.register(EnergyConsumer())
+        scan.run('2022-02-01', '2022-02-07')
+    """
+
+    def __init__(self, batch_size=SCAN_BATCH_SIZE, engine=None):
+        self.batch_size = batch_size
+        self.engine = engine or prod_engine
+        self.consumers = []
+        self.day_stats = {}           # (day index, id_var) -> [n, max_ms, sum_ms] of the scanned rows
+
+    def register(self, consumer):
+        self.consumers.append(consumer)
+        return consumer
+
+    def _carry_in_ranges(self):
+        # Valid value range per carried-in variable, one lookup serves every consumer
+        ranges = {}
+        for consumer in self.consumers:
+            for id_var, value_range in consumer.carry_in_ranges.items():
+                if ranges.setdefault(id_var, value_range) != value_range:
+                    raise ValueError(f"Consumers disagree on the carry-in range of variable {id_var}")
+        return ranges
+
+    def _carry_in_rows(self, conn, id_vars, start_ms):
+        # Last valid value of each variable before the window, dated at the window start
+        ranges = self._carry_in_ranges()
+        id_vars = sorted(id_vars)
+        rows = conn.execute(text('''
+            SELECT v.id_var, CAST(:start_ms AS bigint) AS date, prev.value
+            FROM unnest(
+                CAST(:id_vars AS int[]),
+                CAST(:lows AS float8[]),
+                CAST(:highs AS float8[])
+            ) AS v(id_var, low, high)
+            CROSS JOIN LATERAL (
+                SELECT f.value::float8 AS value
+                FROM variable_log_float f
+                WHERE f.id_var = v.id_var
+                    AND f.date < :start_ms
+                    AND f.value IS NOT NULL
+                    AND f.value = f.value
+                    AND f.value NOT IN ('Infinity'::real, '-Infinity'::real)
+                    AND (v.low IS NULL OR (f.value >= v.low AND f.value < v.high))
+                ORDER BY f.date DESC
+                LIMIT 1
+            ) prev
+        '''), {
+            'id_vars': id_vars,
+            'lows': [ranges[id_var][0] if id_var in ranges else None for id_var in id_vars],
+            'highs': [ranges[id_var][1] if id_var in ranges else None for id_var in id_vars],
+            'start_ms': start_ms
+        }).fetchall()
+        return [tuple(row) for row in rows]
+
+    def _count(self, batch):
+        stats = self.day_stats
+        for id_var, date_ms, _ in batch:
+            key = (date_ms // etl_watermark.MS_PER_DAY, id_var)
+            counts = stats.get(key)
+            if counts is None:
+                stats[key] = [1, date_ms, date_ms]
+            else:
+                counts[0] += 1
+                counts[1] = max(counts[1], date_ms)
+                counts[2] += date_ms
+
+    def _dispatch(self, batch):
+        self._count(batch)
+        for consumer in self.consumers:
+            rows = [tuple(row) for row in batch if row[0] in consumer.id_vars]
+            if rows:
+                consumer.consume(rows)
+
+    def scan(self, first_day, last_day):
+        '''
+        Read the window once and dispatch the rows, counting them per day and variable in day_stats.
+        Returns the number of rows read.
+        '''
+        self.day_stats = {}
+        start_ms, end_ms = day_bounds_ms(first_day, last_day)
+        all_ids = set().union(*(consumer.id_vars for consumer in self.consumers))
+        carry_ids = set().union(*(consumer.id_vars for consumer in self.consumers if consumer.carry_in))
+
+        total = 0
+        with self.engine.connect() as conn:
+            if carry_ids:
+                carried = self._carry_in_rows(conn, carry_ids, start_ms)
+                for consumer in self.consumers:
+                    if consumer.carry_in:
+                        consumer.consume([row for row in carried if row[0] in consumer.id_vars])
+
+            cached = raw_cache.read_table('variable_log_float', first_day, last_day, all_ids)
+            if cached is not None:
+                for batch in cached.to_batches(self.batch_size):
+                    total += batch.num_rows
+                    self._dispatch(list(zip(*(batch.column(i).to_pylist() for i in range(3)))))
+                return total
+
+            # Server-side cursor, the window is never held in memory here as a whole
+            result = conn.execution_options(stream_results=True).execute(text('''
+                SELECT id_var, date, value::float8 AS value
+                FROM variable_log_float
+                WHERE id_var = ANY(:id_vars)
+                AND date >= :start_ms
+                AND date < :end_ms
+                ORDER BY date
+            '''), {'id_vars': sorted(all_ids), 'start_ms': start_ms, 'end_ms': end_ms})
+
+            for batch in result.partitions(self.batch_size):
+                total += len(batch)
+                self._dispatch(batch)
+
+        return total
+
+    def run(self, first_day, last_day):
+        '''
+        Scan one window and let every consumer transform and load it, with watermarks.
+        A failing consumer is marked failed without affecting the others.
+        Returns the names of the failed consumers.
+        '''
+        days = days_in_range(first_day, last_day)
+        for consumer in self.consumers:
+            etl_watermark.save_watermarks(consumer.etl_name, days, etl_watermark.STATUS_RUNNING)
+
+        started = time.perf_counter()
+        try:
+            rows = self.scan(first_day, last_day)
+            fingerprints = self._fingerprints(first_day, last_day)
+        except Exception:
+            for consumer in self.consumers:
+                etl_watermark.save_watermarks(consumer.etl_name, days, etl_watermark.STATUS_FAILED)
+            raise
+        logger.info(f"Shared scan {first_day} to {last_day}: {rows} rows for "
+                    f"{len(self.consumers)} consumers in {time.perf_counter() - started:.1f} s")
+
+        failed = []
+        for consumer in self.consumers:
+            try:
+                records, day_key = consumer.finish(first_day, last_day)
+                partition = etl_watermark.PartitionRun(days)
+                partition.add_rows(records, day_key)
+                etl_watermark.save_watermarks(consumer.etl_name, days, etl_watermark.STATUS_DONE,
+                                              partition.rows_by_day, fingerprints[consumer.etl_name])
+            except Exception as e:
+                logger.error(f"{consumer.etl_name} failed for {first_day} to {last_day}: {str(e)}")
+                etl_watermark.save_watermarks(consumer.etl_name, days, etl_watermark.STATUS_FAILED)
+                failed.append(consumer.etl_name)
+        return failed
+
+
+    def _fingerprints(self, first_day, last_day):
+        '''
+        Source fingerprints of every consumer, the same values etl_watermark.source_fingerprints()
+        returns: variable_log_float from the rows of the scan, variable_log_string (not scanned,
+        usually without rows of these variables) from one query for the union of the variables.
+        '''
+        all_ids = set().union(*(consumer.id_vars for consumer in self.consumers))
+        parts = etl_watermark.variable_fingerprint_parts(first_day, last_day, sorted(all_ids),
+                                                         tables=['variable_log_string'])
+        for (day_index, id_var), (n, max_ms, sum_ms) in self.day_stats.items():
+            parts[ms_to_day(day_index * etl_watermark.MS_PER_DAY)][('variable_log_float', id_var)] = (n, max_ms, sum_ms)
+
+        return {consumer.etl_name: etl_watermark.combine_fingerprints(parts, consumer.id_vars)
+                for consumer in self.consumers}
+
+
+def default_consumers():
+    '''One consumer per ETL reading variable_log_float'''
+    # Imported here, the ETL modules import this module for ScanConsumer
+    from backend.scripts.etl_agg_sensor_stats import SensorStatsConsumer
+    from backend.scripts.etl_agg_energy_daily import EnergyConsumer
+    from backend.scripts.etl_agg_program_energy import ProgramEnergyConsumer
+    from backend.scripts.etl_agg_program_history import ProgramHistoryConsumer
+
+    return [SensorStatsConsumer(), EnergyConsumer(), ProgramEnergyConsumer(), ProgramHistoryConsumer()]
+
+
+def run_etl(start_date, end_date=None, resume=False, window_days=SCAN_WINDOW_DAYS):
+    '''
+    Run all default consumers over a date range, one shared scan per window.
+    Consumers keep their state between consecutive windows (e.g. the active program).
+    With resume=True only the days that are not done yet for at least one consumer are scanned.
+    Raises RuntimeError with the consumers that failed in some window, once every window has run.
+    '''
+    consumers = default_consumers()
+    end_date = end_date or start_date
+    days = days_in_range(start_date, end_date)
+
+    if resume:
+        done_for_all = set(days)
+        for consumer in consumers:
+            done_for_all &= etl_watermark.completed_days(consumer.etl_name, start_date, end_date)
+        days = [day for day in days if day not in done_for_all]
+
+    # Empty days are still scanned (the program history needs every day), but busy days
+    # close a window early
+    all_ids = set().union(*(consumer.id_vars for consumer in consumers))
+    day_rows = etl_source_coverage.day_rows(start_date, end_date, all_ids)
+
+    failed = set()
+    for first_day, last_day in etl_watermark.group_windows(days, window_days, day_rows):
+        scan = SharedScan()
+        for consumer in consumers:
+            scan.register(consumer)
+        failed.update(scan.run(first_day, last_day))
+
+    if failed:
+        raise RuntimeError(f"Failed consumers: {', '.join(sorted(failed))}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    resume = '--resume' in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if len(args) == 1:
+        run_etl(args[0], resume=resume)
+    elif len(args) == 2:
+        run_etl(args[0], args[1], resume=resume)
+    else:
+        print("Usage: python -m backend.scripts.shared_scan start_date [end_date] [--resume]")
+        sys.exit(1)
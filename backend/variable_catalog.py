@@ -0,0 +1,112 @@
+# In-memory catalog of the production `variable` table (id, name, datatype)
+# Used by the ETLs and the API to resolve variable names to ids without joining `variable`
+# in every query: the queries only get plain `id_var = ANY(:ids)` predicates.
+
+import threading
+import time
+
+from sqlalchemy import text
+
+
+CATALOG_TTL_SECONDS = 3600         # The variable table rarely changes
+COVERAGE_TTL_SECONDS = 900         # First / last reading per variable
+
+
+class VariableCatalog:
+    """
+    Loads the variable table once and reloads it when it is older than ttl_seconds.
+    Lookups are served from memory and are safe to call from several threads.
+
+    Example:
+        catalog = VariableCatalog(prod_engine)
+        catalog.id_of('TEMPERATURA_BASE')          # 612
+        catalog.ids_of(['MOTOR_1', 'MOTOR_2'])     # {'MOTOR_1': 601, 'MOTOR_2': 602}
+    """
+
+    def __init__(self, engine, ttl_seconds=CATALOG_TTL_SECONDS, coverage_ttl_seconds=COVERAGE_TTL_SECONDS):
+        self.engine = engine
+        self.ttl_seconds = ttl_seconds
+        self.coverage_ttl_seconds = coverage_ttl_seconds
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._by_name = {}
+        self._loaded_at = None
+        self._coverage = {}
+        self._coverage_at = None
+
+    def refresh(self):
+        """Reload the variable table"""
+        with self.engine.connect() as conn:
+            rows = conn.execute(text('''
+                SELECT id, name, datatype
+                FROM variable
+                ORDER BY id
+            ''')).fetchall()
+
+        by_id = {row.id: {'id': row.id, 'name': row.name, 'datatype': row.datatype} for row in rows}
+        with self._lock:
+            self._by_id = by_id
+            self._by_name = {var['name']: var['id'] for var in by_id.values()}
+            self._loaded_at = time.monotonic()
+
+    def _fresh(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl_seconds:
+            self.refresh()
+
+    def id_of(self, name):
+        """Id of a variable name, None if unknown"""
+        self._fresh()
+        return self._by_name.get(name)
+
+    def ids_of(self, names):
+        """Dict name -> id for the known names (unknown names are left out)"""
+        self._fresh()
+        return {name: self._by_name[name] for name in names if name in self._by_name}
+
+    def name_of(self, id_var):
+        self._fresh()
+        var = self._by_id.get(id_var)
+        return var['name'] if var else None
+
+    def variables(self):
+        """All variables as dicts with id, name and datatype, ordered by id"""
+        self._fresh()
+        return list(self._by_id.values())
+
+    def coverage(self):
+        """
+        First and last reading (epoch ms) of every variable in either log table, cached.
+        Two index lookups per variable and table on (id_var, date), no full scan.
+
+        Returns:
+            Dict id -> {'first_ms', 'last_ms'}, variables without readings are left out.
+        """
+        with self._lock:
+            if self._coverage_at is not None and time.monotonic() - self._coverage_at <= self.coverage_ttl_seconds:
+                return self._coverage
+
+        ids = [var['id'] for var in self.variables()]
+        with self.engine.connect() as conn:
+            rows = conn.execute(text('''
+                SELECT
+                    v.id_var,
+                    LEAST(
+                        (SELECT MIN(f.date) FROM variable_log_float f WHERE f.id_var = v.id_var),
+                        (SELECT MIN(s.date) FROM variable_log_string s WHERE s.id_var = v.id_var)
+                    ) AS first_ms,
+                    GREATEST(
+                        (SELECT MAX(f.date) FROM variable_log_float f WHERE f.id_var = v.id_var),
+                        (SELECT MAX(s.date) FROM variable_log_string s WHERE s.id_var = v.id_var)
+                    ) AS last_ms
+                FROM unnest(CAST(:ids AS int[])) AS v(id_var)
+            '''), {'ids': ids}).fetchall()
+
+        coverage = {
+            row.id_var: {'first_ms': row.first_ms, 'last_ms': row.last_ms}
+            for row in rows
+            if row.first_ms is not None
+        }
+        with self._lock:
+            self._coverage = coverage
+            self._coverage_at = time.monotonic()
+        return coverage
@@ -0,0 +1,87 @@
+'''
+The raw cache must return what production holds: read_rows() against the rows of a
+production-shaped fixture (SQLite stand-in for variable_log_float and variable_log_string),
+and the counts and fingerprint parts derived from the cache against the same rows.
+'''
+
+import random
+from datetime import date
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+
+pytest.importorskip("pyarrow")
+
+from backend.scripts import raw_cache
+from backend.scripts.etl_common import date_to_ms, ms_to_day
+
+DAYS = [date(2022, 2, 22), date(2022, 2, 23)]
+
+
+def production_rows(seed=1):
+    '''Readings of a few variables over DAYS, full double precision and some NULL values'''
+    rng = random.Random(seed)
+    float_rows, string_rows = [], []
+    for day in DAYS:
+        start_ms = date_to_ms(day)
+        for id_var in (447, 581, 601, 602):
+            for _ in range(200):
+                date_ms = start_ms + rng.randrange(86400 * 1000)
+                value = None if rng.random() < 0.02 else rng.uniform(-1e4, 1e4) / 3
+                float_rows.append((id_var, date_ms, value))
+        for _ in range(50):
+            string_rows.append((447, start_ms + rng.randrange(86400 * 1000), f'[["E{rng.randrange(99)}", "x"]]'))
+    return {'variable_log_float': float_rows, 'variable_log_string': string_rows}
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    rows = production_rows()
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE variable_log_float (id_var integer, date bigint, value double precision)"))
+        conn.execute(text("CREATE TABLE variable_log_string (id_var integer, date bigint, value text)"))
+        for table, table_rows in rows.items():
+            conn.execute(text(f"INSERT INTO {table} VALUES (:id_var, :date, :value)"),
+                         [{'id_var': i, 'date': d, 'value': v} for i, d, v in table_rows])
+
+    monkeypatch.setattr(raw_cache, "prod_engine", engine)
+    monkeypatch.setattr(raw_cache, "CACHE_DIR", str(tmp_path))
+    assert raw_cache.fill(DAYS[0], DAYS[-1]) == len(DAYS) * len(raw_cache.TABLES)
+    return rows
+
+
+@pytest.mark.parametrize("id_vars", [None, [581], [601, 602]])
+def test_read_rows_matches_production(cache, id_vars):
+    for table, table_rows in cache.items():
+        expected = [row for row in table_rows if id_vars is None or row[0] in id_vars]
+        cached = raw_cache.read_rows(table, DAYS[0], DAYS[-1], id_vars)
+        # Same values bit for bit, the float readings are not rounded to float32
+        assert sorted(cached, key=lambda row: (row[1], row[0])) == sorted(expected, key=lambda row: (row[1], row[0]))
+
+
+def test_day_stats_match_production(cache):
+    for table, table_rows in cache.items():
+        expected = {}
+        for _, date_ms, _ in table_rows:
+            n, max_ms, sum_ms = expected.get(ms_to_day(date_ms), (0, 0, 0))
+            expected[ms_to_day(date_ms)] = (n + 1, max(max_ms, date_ms), sum_ms + date_ms)
+        assert raw_cache.day_stats(table, DAYS[0], DAYS[-1]) == expected
+
+
+def test_bucket_counts_match_production(cache):
+    bucket_ms = 600 * 1000
+    expected = {}
+    for table, table_rows in cache.items():
+        for id_var, date_ms, _ in table_rows:
+            key = (table, date_ms // bucket_ms * bucket_ms, id_var)
+            n, first_ms, last_ms, sum_ms = expected.get(key, (0, date_ms, date_ms, 0))
+            expected[key] = (n + 1, min(first_ms, date_ms), max(last_ms, date_ms), sum_ms + date_ms)
+
+    counts = raw_cache.bucket_counts(DAYS[0], DAYS[-1], bucket_ms, by_variable=True)
+    assert {
+        (row['table'], row['bucket_ms'], row['id_var']):
+            (row['readings_count'], row['first_ms'], row['last_ms'], row['sum_ms'])
+        for row in counts
+    } == expected
@@ -0,0 +1,111 @@
+'''
+Merged sensor stats must match a full recompute: merge_states() in Python and the Chan merge of
+MERGE_SET in the upsert of etl_agg_sensor_stats.load_data(merge=True).
+
+MERGE_SET is SQL. Its count, mean, m2, min and max expressions are plain arithmetic, they are
+evaluated here in Python with agg_sensor_stats.* bound to the stored row and EXCLUDED.* to the new one.
+'''
+
+import math
+import random
+import re
+
+import pytest
+
+from backend.scripts.etl_agg_sensor_stats import MERGE_SET, add_reading, merge_states, new_state
+
+STATE_KEYS = ('readings_count', 'mean_value', 'm2_value', 'min_value', 'max_value')
+
+
+def fold(values):
+    '''Single pass over the readings, the full recompute'''
+    state = new_state()
+    for value in values:
+        add_reading(state, value)
+    return state
+
+
+def _least(*args):
+    # LEAST / GREATEST ignore NULLs in PostgreSQL
+    values = [a for a in args if a is not None]
+    return min(values) if values else None
+
+
+def _greatest(*args):
+    values = [a for a in args if a is not None]
+    return max(values) if values else None
+
+
+def merge_with_sql(stored, new):
+    '''Evaluate the MERGE_SET expressions of STATE_KEYS for a stored and a new row'''
+    env = {'LEAST': _least, 'GREATEST': _greatest}
+    env.update({f'old_{key}': stored[key] for key in STATE_KEYS})
+    env.update({f'new_{key}': new[key] for key in STATE_KEYS})
+
+    merged = {}
+    for key in STATE_KEYS:
+        expression = MERGE_SET[key].replace('agg_sensor_stats.', 'old_').replace('EXCLUDED.', 'new_')
+        expression = re.sub(r'::float8', '', expression)
+        merged[key] = eval(expression, {'__builtins__': {}}, env)
+    return merged
+
+
+def assert_same_state(actual, expected):
+    assert actual['readings_count'] == expected['readings_count']
+    assert actual['min_value'] == expected['min_value']
+    assert actual['max_value'] == expected['max_value']
+    assert math.isclose(actual['mean_value'], expected['mean_value'], rel_tol=1e-9, abs_tol=1e-9)
+    assert math.isclose(actual['m2_value'], expected['m2_value'], rel_tol=1e-9, abs_tol=1e-6)
+
+
+def random_split(values, rng, parts):
+    '''Split values into `parts` consecutive partitions, some of them empty or single readings'''
+    cuts = sorted(rng.randint(0, len(values)) for _ in range(parts - 1))
+    bounds = [0] + cuts + [len(values)]
+    return [values[bounds[i]:bounds[i + 1]] for i in range(parts)]
+
+
+@pytest.mark.parametrize('seed', range(25))
+def test_merge_states_matches_recompute(seed):
+    rng = random.Random(seed)
+    values = [rng.uniform(-50, 350) for _ in range(rng.randint(0, 300))]
+
+    merged = new_state()
+    for part in random_split(values, rng, rng.randint(1, 8)):
+        merged = merge_states(merged, fold(part))
+
+    assert_same_state(merged, fold(values))
+
+
+@pytest.mark.parametrize('seed', range(25))
+def test_merge_set_matches_recompute(seed):
+    rng = random.Random(seed)
+    values = [rng.uniform(-50, 350) for _ in range(rng.randint(1, 300))]
+
+    # The upsert only merges rows that exist: empty partitions never produce a row
+    parts = [part for part in random_split(values, rng, rng.randint(1, 8)) if part]
+    stored = fold(parts[0])
+    for part in parts[1:]:
+        stored = merge_with_sql(stored, fold(part))
+
+    assert_same_state(stored, fold(values))
+
+
+def test_empty_partitions():
+    values = [21.5, 22.0, 23.25]
+    assert_same_state(merge_states(new_state(), fold(values)), fold(values))
+    assert_same_state(merge_states(fold(values), new_state()), fold(values))
+    assert merge_states(new_state(), new_state())['readings_count'] == 0
+
+
+def test_single_element_partitions():
+    values = [21.5, 22.0, 23.25, 19.0, 25.5]
+    merged = new_state()
+    stored = fold(values[:1])
+    for i, value in enumerate(values):
+        merged = merge_states(merged, fold([value]))
+        if i:
+            stored = merge_with_sql(stored, fold([value]))
+
+    assert_same_state(merged, fold(values))
+    assert_same_state(stored, fold(values))